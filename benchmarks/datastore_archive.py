@@ -0,0 +1,143 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Size, time and peak memory of datastore archives for each compression setting,
+compared with the old uncompressed in-memory tarball.
+Builds a synthetic signal-cli datastore: compressible session and recipient files,
+plus incompressible attachments.
+
+python benchmarks/datastore_archive.py [--sessions N] [--attachment-mb MB]
+"""
+
+import argparse
+import functools
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+from tarfile import TarFile
+from typing import Any, Callable
+
+NUMBER = "+15555550100"
+SETTINGS = [
+    ("none", 0),
+    ("gzip", 1),
+    ("gzip", 6),
+    ("gzip", 9),
+    ("zstd", 3),
+    ("zstd", 10),
+    ("zstd", 19),
+]
+
+
+def make_datastore(root: Path, sessions: int, attachment_mb: int) -> None:
+    account = root / "data" / f"{NUMBER}.d"
+    (account / "sessions").mkdir(parents=True)
+    (account / "attachments").mkdir()
+    (root / "data" / NUMBER).write_text(
+        '{"username": "%s", "registered": true}' % NUMBER
+    )
+    for i in range(sessions):
+        record = f'{{"address": "+1555{i:07d}", "device": 1, "record": "{os.urandom(96).hex()}"}}'
+        (account / "sessions" / str(i)).write_text(record * 4)
+    recipients = ",".join(
+        f'{{"id": {i}, "number": "+1555{i:07d}", "profileKey": null}}'
+        for i in range(sessions)
+    )
+    (account / "recipients-store").write_text(f'{{"recipients": [{recipients}]}}')
+    for i in range(attachment_mb):
+        (account / "attachments" / str(i)).write_bytes(os.urandom(1024 * 1024))
+
+
+def legacy_archive() -> bytes:
+    "what tarball_data used to do"
+    buffer = BytesIO()
+    tarball = TarFile(fileobj=buffer, mode="w")
+    tarball.add(f"data/{NUMBER}")
+    tarball.add(f"data/{NUMBER}.d")
+    tarball.close()
+    buffer.seek(0)
+    return buffer.read()
+
+
+def legacy_extract(data: bytes, out: str) -> None:
+    tarball = TarFile(fileobj=BytesIO(data))
+    tarball.getmembers()
+    tarball.extractall(out)
+
+
+def measure(func: Callable[[], Any]) -> tuple[Any, float, int]:
+    "Returns func's result, seconds taken and peak memory allocated while running it"
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def report(
+    name: str, archive_func: Callable[[], Any], extract_func: Callable[[bytes], None]
+) -> None:
+    archived, archive_s, archive_peak = measure(archive_func)
+    data = bytes(archived)  # asyncpg hands back bytes
+    del archived
+    _, extract_s, extract_peak = measure(functools.partial(extract_func, data))
+    print(
+        f"{name:<10} {len(data) / 1024:9.0f} {archive_s:10.3f} {archive_peak / 1024:9.0f}"
+        f" {extract_s:10.3f} {extract_peak / 1024:9.0f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--attachment-mb", type=int, default=8)
+    args = parser.parse_args()
+    os.environ["DATABASE_URL"] = ""
+    # pylint: disable=import-outside-toplevel
+    from forest import datastore
+
+    root = Path(tempfile.mkdtemp())
+    make_datastore(root, args.sessions, args.attachment_mb)
+    os.chdir(root)
+    store = datastore.SignalDatastore(NUMBER)
+    out = str(root / "out")
+
+    def extract(data: bytes) -> None:
+        with TarFile.open(
+            fileobj=datastore.decompressed_reader(data), mode="r|"
+        ) as tar:
+            tar.extractall(out)
+
+    print(
+        f"{'format':<10} {'size kb':>9} {'archive s':>10} {'peak kb':>9}"
+        f" {'extract s':>10} {'peak kb':>9}"
+    )
+    rows: list[tuple[str, Callable[[], Any], Callable[[bytes], None]]] = [
+        ("legacy", legacy_archive, lambda data: legacy_extract(data, out))
+    ]
+    for compression, level in SETTINGS:
+        if compression == "zstd" and not datastore.zstandard:
+            continue
+
+        def archive(compression: str = compression, level: int = level) -> Any:
+            os.environ["DATASTORE_COMPRESSION"] = compression
+            os.environ["DATASTORE_COMPRESSION_LEVEL"] = str(level)
+            return store.tarball_data()
+
+        rows.append((f"{compression} {level}", archive, extract))
+    for name, archive_func, extract_func in rows:
+        report(name, archive_func, extract_func)
+        shutil.rmtree(out)
+    shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
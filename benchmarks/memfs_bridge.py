@@ -0,0 +1,122 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+MB/s of reads and writes through the ctypes FUSE bridge into memfs. "legacy" copies
+like the bridge used to (string_at on write, create_string_buffer on read), "views"
+passes memoryviews both ways.
+Calls the bridge directly, and also through a real mount if /dev/fuse and
+fusermount are available. Needs libfuse.
+
+python benchmarks/memfs_bridge.py [--mb MB] [--io-kb KB]
+"""
+
+import argparse
+import ctypes
+import multiprocessing
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from typing import Any
+
+from forest import fuse, mem
+
+
+class LegacyFUSE(fuse.FUSE):
+    "copies like the bridge used to"
+
+    def read(self, path: Any, buf: Any, size: int, offset: int, fip: Any) -> int:
+        fh = fip.contents if self.raw_fi else fip.contents.fh
+        ret = bytes(
+            self.operations("read", self._decode_optional_path(path), size, offset, fh)
+        )
+        if not ret:
+            return 0
+        data = ctypes.create_string_buffer(ret, len(ret))
+        ctypes.memmove(buf, data, len(ret))
+        return len(ret)
+
+    def write(self, path: Any, buf: Any, size: int, offset: int, fip: Any) -> int:
+        data = ctypes.string_at(buf, size)
+        fh = fip.contents if self.raw_fi else fip.contents.fh
+        return self.operations(
+            "write", self._decode_optional_path(path), data, offset, fh
+        )
+
+
+def bridge_mbps(cls: type, total: int, io: int) -> tuple[float, float]:
+    "write then read total bytes through cls's callbacks, without mounting"
+    backend = mem.Memory()
+    backend.create("/file", stat.S_IFREG | 0o644)
+    bridge = cls.__new__(cls)
+    bridge.operations, bridge.raw_fi, bridge.encoding = backend, True, "utf-8"
+    info = ctypes.pointer(fuse.fuse_file_info())
+    kernel = ctypes.cast(ctypes.create_string_buffer(io), ctypes.POINTER(ctypes.c_byte))
+    start = time.perf_counter()
+    for offset in range(0, total, io):
+        bridge.write(b"/file", kernel, io, offset, info)
+    write_s = time.perf_counter() - start
+    start = time.perf_counter()
+    for offset in range(0, total, io):
+        bridge.read(b"/file", kernel, io, offset, info)
+    read_s = time.perf_counter() - start
+    mb = total / 1024 / 1024
+    return mb / write_s, mb / read_s
+
+
+def serve(mountpoint: str, legacy: bool) -> None:
+    backend = mem.Memory(keep_cache=False)
+    if legacy:
+        backend.zero_copy_writes = False
+    cls = LegacyFUSE if legacy else fuse.FUSE
+    cls(backend, mountpoint, foreground=True, raw_fi=True, direct_io=True)
+
+
+def mount_mbps(legacy: bool, total: int, io: int) -> tuple[float, float]:
+    "write then read total bytes through a mount, bypassing the page cache"
+    with tempfile.TemporaryDirectory() as mountpoint:
+        proc = multiprocessing.Process(target=serve, args=(mountpoint, legacy))
+        proc.start()
+        try:
+            while not os.path.ismount(mountpoint):
+                time.sleep(0.05)
+            chunk = os.urandom(io)
+            path = f"{mountpoint}/file"
+            start = time.perf_counter()
+            with open(path, "wb", buffering=0) as f:
+                for _ in range(0, total, io):
+                    f.write(chunk)
+            write_s = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(path, "rb", buffering=0) as f:
+                while f.read(io):
+                    pass
+            read_s = time.perf_counter() - start
+        finally:
+            subprocess.run(["fusermount", "-u", mountpoint], check=False)
+            proc.join(10)
+    mb = total / 1024 / 1024
+    return mb / write_s, mb / read_s
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mb", type=int, default=256)
+    parser.add_argument("--io-kb", type=int, default=128)
+    args = parser.parse_args()
+    total, io = args.mb * 1024 * 1024, args.io_kb * 1024
+    can_mount = os.path.exists("/dev/fuse") and shutil.which("fusermount")
+    print(f"{'':<16} {'write MB/s':>10} {'read MB/s':>10}")
+    for name, legacy in [("legacy", True), ("views", False)]:
+        write, read = bridge_mbps(LegacyFUSE if legacy else fuse.FUSE, total, io)
+        print(f"{name + ' bridge':<16} {write:>10.0f} {read:>10.0f}")
+        if can_mount:
+            write, read = mount_mbps(legacy, total, io)
+            print(f"{name + ' mount':<16} {write:>10.0f} {read:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Latency of memfs operations, called the way FUSE calls them (through Memory.__call__),
+at a few directory depths. "legacy" resolves paths by walking the directory tree
+like Memory used to, "index" is the path index.
+Needs libfuse to import forest.mem, but doesn't mount anything.
+
+python benchmarks/memfs_ops.py [-n OPS]
+"""
+
+import argparse
+import stat
+import time
+from typing import Any, Callable
+
+from forest import mem
+
+DEPTHS = [1, 4, 8, 16]
+
+
+class LegacyMemory(mem.Memory):
+    "path lookups as they were before the index"
+
+    def get_file(self, path: str) -> Any:
+        if path[-1] == "/":
+            return None
+        patharray = path.split("/")
+        filename = patharray.pop()
+        dirname = "/".join(path.split("/")[:-1])
+        location = self.get_dir(dirname)
+        if location and filename in location.files:
+            return location.files[filename]
+        return None
+
+    def get_dir(self, path: str) -> Any:
+        path = path.rstrip("/")
+        patharray = path.split("/")
+        if len(patharray) <= 1:
+            return self.filesystem["/"]
+        patharray.pop(0)
+        location = self.filesystem["/"]
+        while patharray:
+            dirpath = patharray.pop(0)
+            if dirpath in location.directories:
+                location = location.directories[dirpath]
+            else:
+                return None
+        return location
+
+
+def populate(backend: mem.Memory, depth: int) -> str:
+    "Make a file depth directories down, with some siblings along the way"
+    path = ""
+    for level in range(depth):
+        for sibling in range(8):
+            backend("create", f"{path}/file{sibling}", stat.S_IFREG | 0o644)
+        path = f"{path}/dir{level}"
+        backend("mkdir", path, 0o755)
+    backend("create", f"{path}/target", stat.S_IFREG | 0o644)
+    backend("write", f"{path}/target", b"x" * 4096, 0, 0)
+    return f"{path}/target"
+
+
+def time_op(n: int, func: Callable[[], Any]) -> float:
+    "microseconds per call"
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=100_000)
+    args = parser.parse_args()
+    print(f"{'backend':<8} {'depth':>5} {'getattr us':>11} {'read us':>9}")
+    for depth in DEPTHS:
+        for name, cls in [("legacy", LegacyMemory), ("index", mem.Memory)]:
+            backend = cls()
+            path = populate(backend, depth)
+            getattr_us = time_op(args.n, lambda: backend("getattr", path, None))
+            read_us = time_op(args.n, lambda: backend("read", path, 4096, 0, 0))
+            print(f"{name:<8} {depth:>5} {getattr_us:>11.2f} {read_us:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
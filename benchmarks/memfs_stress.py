@@ -0,0 +1,96 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Parallel readers and writers through a real memfs mount, with libfuse's
+single-threaded (-s) and multithreaded loops. Checks every file's contents
+afterwards, and reports MB/s for each mode.
+Needs libfuse, /dev/fuse and fusermount.
+
+python benchmarks/memfs_stress.py [--threads N] [--mb-per-thread MB]
+"""
+
+import argparse
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from forest import fuse, mem
+
+IO_SIZE = 64 * 1024
+
+
+def serve(mountpoint: str, nothreads: bool) -> None:
+    fuse.FUSE(mem.Memory(), mountpoint, foreground=True, nothreads=nothreads)
+
+
+def mounted(mountpoint: str, nothreads: bool) -> multiprocessing.Process:
+    proc = multiprocessing.Process(target=serve, args=(mountpoint, nothreads))
+    proc.start()
+    deadline = time.time() + 10
+    while not os.path.ismount(mountpoint):
+        if time.time() > deadline or not proc.is_alive():
+            raise RuntimeError("memfs didn't mount")
+        time.sleep(0.05)
+    return proc
+
+
+def worker(path: str, total: int, errors: list) -> None:
+    "write total bytes to path, then read them back while the other threads do the same"
+    pattern = os.path.basename(path).encode() * IO_SIZE
+    try:
+        with open(path, "wb") as f:
+            for _ in range(0, total, IO_SIZE):
+                f.write(pattern[:IO_SIZE])
+        with open(path, "rb") as f:
+            while chunk := f.read(IO_SIZE):
+                if chunk != pattern[: len(chunk)]:
+                    errors.append(f"{path} read back wrong data")
+                    return
+    except OSError as e:
+        errors.append(f"{path}: {e}")
+
+
+def run(threads: int, total: int, nothreads: bool) -> float:
+    "MB/s written and read back through the mount"
+    with tempfile.TemporaryDirectory() as mountpoint:
+        proc = mounted(mountpoint, nothreads)
+        try:
+            errors: list = []
+            workers = [
+                threading.Thread(
+                    target=worker, args=(f"{mountpoint}/{i}", total, errors)
+                )
+                for i in range(threads)
+            ]
+            start = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            if errors:
+                raise RuntimeError(errors)
+            for i in range(threads):
+                assert os.path.getsize(f"{mountpoint}/{i}") == total
+        finally:
+            subprocess.run(["fusermount", "-u", mountpoint], check=False)
+            proc.join(10)
+    return 2 * threads * total / elapsed / 1024 / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--mb-per-thread", type=int, default=16)
+    args = parser.parse_args()
+    total = args.mb_per_thread * 1024 * 1024
+    for name, nothreads in [("single-threaded", True), ("multithreaded", False)]:
+        print(f"{name:<16} {run(args.threads, total, nothreads):8.0f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+MB/s of memfs file writes and reads, sequential and at random offsets, through
+Memory's write and read. "legacy" stores files in one bytearray like Memory used to
+(so its random writes truncate the file, which is wrong, but that's what it did).
+Needs libfuse to import forest.mem, but doesn't mount anything.
+
+python benchmarks/memfs_throughput.py [--mb MB] [--io-kb KB]
+"""
+
+import argparse
+import random
+import stat
+import time
+from typing import Any, Callable
+
+from forest import mem
+
+
+class LegacyMemory(mem.Memory):
+    "file contents as they were before extents"
+
+    def create(self, path: str, mode: int) -> int:
+        fd = super().create(path, mode)
+        self.get_file(path).data = bytearray()
+        return fd
+
+    def read(self, path: str, size: int, offset: int, fh: int) -> bytes:
+        fileobj = self.get_file(path)
+        return bytes(fileobj.data[offset : (offset + size)])
+
+    def write(self, path: str, data: bytes, offset: int, fh: int) -> int:
+        st = self.get_file(path)
+        st.data[offset:] = data
+        st.properties.st_size = len(st.data)
+        st.properties.st_blocks = len(st.data) // mem.BLOCK_SIZE
+        return len(data)
+
+
+def throughput(total: int, func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return total / (time.perf_counter() - start) / 1024 / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mb", type=int, default=16)
+    parser.add_argument("--io-kb", type=int, default=4)
+    args = parser.parse_args()
+    io = args.io_kb * 1024
+    total = args.mb * 1024 * 1024
+    count = total // io
+    chunk = bytes(io)
+    offsets = [random.randrange(count) * io for _ in range(count)]
+    print(
+        f"{'backend':<8} {'seq write':>10} {'rand write':>11}"
+        f" {'seq read':>9} {'rand read':>10}  (MB/s)"
+    )
+    for name, cls in [("legacy", LegacyMemory), ("extents", mem.Memory)]:
+        backend = cls()
+        backend.create("/file", stat.S_IFREG | 0o644)
+
+        def seq_write() -> None:
+            for i in range(count):
+                backend.write("/file", chunk, i * io, 0)
+
+        def rand_write() -> None:
+            for offset in offsets:
+                backend.write("/file", chunk, offset, 0)
+
+        def seq_read() -> None:
+            for i in range(count):
+                backend.read("/file", io, i * io, 0)
+
+        def rand_read() -> None:
+            for offset in offsets:
+                backend.read("/file", io, offset, 0)
+
+        results = [throughput(total, seq_write), throughput(total, rand_write)]
+        seq_write()  # the legacy random writes truncated the file
+        results += [throughput(total, seq_read), throughput(total, rand_read)]
+        print(f"{name:<8} " + " ".join(f"{mbps:>10.0f}" for mbps in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Queries/sec through PGInterface's named query methods. "legacy" resolves methods in
+__getattribute__ and evals the statement on every call like PGInterface used to,
+"compiled" uses the methods bound at construction.
+"dispatch" stubs out the database to time just the method call path. "postgres" runs
+against --dsn (default DATABASE_URL) on a scratch table, with --concurrency callers.
+
+python benchmarks/pghelp_queries.py [-n QUERIES] [--dsn DSN] [--concurrency N]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, Callable
+
+from forest import pghelp
+
+BenchPGExpressions = pghelp.PGExpressions(
+    table="pghelp_bench",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, value BIGINT);",
+    drop_table="DROP TABLE IF EXISTS {self.table};",
+    put_value="INSERT INTO {self.table} (id, value) VALUES($1, $2) \
+        ON CONFLICT (id) DO UPDATE SET value = $2;",
+    get_value="SELECT value FROM {self.table} WHERE id=$1;",
+    count="SELECT count(*) FROM {self.table};",
+)
+
+
+class LegacyInterface(pghelp.PGInterface):
+    "method lookup and execution as they were before compiled statements"
+
+    def compile_queries(self) -> None:
+        pass
+
+    async def execute(self, qstring: str, *args: Any, **kwargs: Any) -> Any:
+        if not self.pool:
+            await self.connect_pg()
+        assert self.pool
+        async with self.pool.acquire() as connection:
+            result = await connection._execute(  # pylint: disable=protected-access
+                qstring, args, 0, 180, return_status=True
+            )
+            return result[0]
+
+    def __getattribute__(self, key: str) -> Any:
+        try:
+            return object.__getattribute__(self, key)
+        except AttributeError:
+            pass
+        executer = self.execute
+        statement = self.queries.get_query(key)
+        if "$1" in statement or "{" in statement and "}" in statement:
+
+            def executer_with_args(*args: Any) -> Any:
+                rebuilt_statement = eval(f'f"{statement}"')  # pylint: disable=eval-used
+                resp = executer(rebuilt_statement, *args)
+                self.truncate(f"{resp}")
+                self.truncate(str(args))
+                return resp
+
+            return executer_with_args
+
+        def executer_without_args() -> Any:
+            return executer(statement)
+
+        return executer_without_args
+
+
+class StubbedLegacy(LegacyInterface):
+    async def execute(self, qstring: str, *args: Any, **kwargs: Any) -> Any:
+        return []
+
+
+class StubbedCompiled(pghelp.PGInterface):
+    async def execute(self, qstring: str, *args: Any, **kwargs: Any) -> Any:
+        return []
+
+
+async def qps(n: int, concurrency: int, query: Callable[[int], Any]) -> float:
+    async def caller(start: int) -> None:
+        for i in range(start, n, concurrency):
+            await query(i)
+
+    began = time.perf_counter()
+    await asyncio.gather(*(caller(i) for i in range(concurrency)))
+    return n / (time.perf_counter() - began)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20_000)
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL", ""))
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    print(f"{'path':<9} {'interface':<9} {'get_value q/s':>14} {'count q/s':>10}")
+    for name, cls in [("legacy", StubbedLegacy), ("compiled", StubbedCompiled)]:
+        interface = cls(BenchPGExpressions, "bench")
+        get = await qps(args.n, 1, lambda i: interface.get_value(str(i % 100)))
+        count = await qps(args.n, 1, lambda i: interface.count())
+        print(f"{'dispatch':<9} {name:<9} {get:>14.0f} {count:>10.0f}")
+    if not args.dsn:
+        print("no --dsn or DATABASE_URL, skipping postgres")
+        return
+    setup = pghelp.PGInterface(BenchPGExpressions, args.dsn)
+    await setup.drop_table()
+    await setup.create_table()
+    for i in range(100):
+        await setup.put_value(str(i), i)
+    try:
+        for name, cls in [
+            ("legacy", LegacyInterface),
+            ("compiled", pghelp.PGInterface),
+        ]:
+            interface = cls(BenchPGExpressions, args.dsn)
+            await interface.count()  # connect and warm up the pool
+            get = await qps(
+                args.n, args.concurrency, lambda i: interface.get_value(str(i % 100))
+            )
+            count = await qps(args.n, args.concurrency, lambda i: interface.count())
+            print(f"{'postgres':<9} {name:<9} {get:>14.0f} {count:>10.0f}")
+    finally:
+        await setup.drop_table()
+        await pghelp.close_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+End-to-end messages/sec for each event loop and JSON codec combination.
+A fake signal client feeds /ping messages through decode_signal_line and
+answers each send command the bot writes with a result, so every message
+goes through decoding, dispatch, the outbox, encoding and the roundtrip wait.
+
+python benchmarks/runtime.py [-n MESSAGES] [--window IN_FLIGHT]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Any, Optional
+
+LOOPS = ["asyncio", "uvloop"]
+CODECS = ["json", "orjson", "ujson"]
+RPC_ID = re.compile(rb'"id":\s*"([^"]+)"')
+
+
+def receive_line(i: int) -> str:
+    "an auxin-cli receive notification"
+    message = {
+        "timestamp": int(time.time() * 1000),
+        "content": {"source": {"dataMessage": {"body": f"/ping {i}"}}},
+        "remote_address": {
+            "address": {
+                "Both": ["+15555550101", "412e180d-c500-4c60-b370-14f6693d8ea7"]
+            }
+        },
+    }
+    return json.dumps({"jsonrpc": "2.0", "method": "receive", "params": message})
+
+
+class FakeClient:
+    "Stands in for auxin-cli's stdin and stdout"
+
+    def __init__(self, lines: list[str], window: int) -> None:
+        self.stdout = asyncio.StreamReader()
+        self.pending = iter(lines)
+        self.total = len(lines)
+        self.sent = 0
+        self.done = asyncio.Event()
+        for line in itertools.islice(self.pending, window):
+            self.stdout.feed_data(line.encode() + b"\n")
+
+    def write(self, data: bytes) -> None:
+        if b'"send"' not in data:
+            return
+        match = RPC_ID.search(data)
+        rpc_id = match.group(1).decode() if match else ""
+        result = {"timestamp": int(time.time() * 1000)}
+        reply = {"jsonrpc": "2.0", "result": result, "id": rpc_id}
+        self.stdout.feed_data(json.dumps(reply).encode() + b"\n")
+        next_line = next(self.pending, None)
+        if next_line:
+            self.stdout.feed_data(next_line.encode() + b"\n")
+        self.sent += 1
+        if self.sent == self.total:
+            self.done.set()
+
+    async def drain(self) -> None:
+        await asyncio.sleep(0)
+
+    def is_closing(self) -> bool:
+        return False
+
+
+async def run(count: int, window: int) -> float:
+    # pylint: disable=import-outside-toplevel
+    from forest.core import QuestionBot
+
+    client = FakeClient([receive_line(i) for i in range(count)], window)
+
+    class BenchBot(QuestionBot):
+        async def start_process(self) -> None:
+            asyncio.create_task(self.write_commands(client))  # type: ignore
+            await self.read_signal_stdout(client.stdout)
+
+        def update_and_check_rate_limit(self) -> bool:
+            return True
+
+    start = time.perf_counter()
+    bot = BenchBot("+15555550100")
+    await client.done.wait()
+    await asyncio.gather(*bot.pending_response_tasks)
+    elapsed = time.perf_counter() - start
+    await bot.client_session.close()
+    return count / elapsed
+
+
+def child(loop: str, codec_name: str, count: int, window: int) -> Optional[float]:
+    # pylint: disable=import-outside-toplevel
+    from forest import codec
+
+    if codec.use(codec_name) != codec_name:
+        return None
+    if loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            return None
+        uvloop.install()
+    return asyncio.run(run(count, window))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--messages", type=int, default=5000)
+    parser.add_argument("--window", type=int, default=32, help="messages in flight")
+    parser.add_argument("--child", nargs=2, metavar=("LOOP", "CODEC"))
+    args = parser.parse_args()
+    if args.child:
+        loop, codec_name = args.child
+        print(json.dumps(child(loop, codec_name, args.messages, args.window)))
+        return
+    env: dict[str, Any] = {**os.environ, "LOGLEVEL": "WARNING"}
+    env.pop("FAST_RUNTIME", None)
+    print(f"{'loop':<8} {'codec':<7} {'msgs/sec':>9}")
+    for loop, codec_name in itertools.product(LOOPS, CODECS):
+        command = [sys.executable, __file__, "--child", loop, codec_name]
+        command += ["-n", str(args.messages), "--window", str(args.window)]
+        proc = subprocess.run(
+            command, env=env, stdout=subprocess.PIPE, text=True, check=True
+        )
+        rate = json.loads(proc.stdout.strip().splitlines()[-1])
+        result = f"{rate:9.0f}" if rate else f"{'n/a':>9}"
+        print(f"{loop:<8} {codec_name:<7} {result}")
+
+
+if __name__ == "__main__":
+    main()
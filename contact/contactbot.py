@@ -296,11 +296,13 @@ class Forest(PayBot):
         destination = utils.signal_format(signal_num)
         if not (_id and destination):
             return "that doesn't look like valid numbers"
-        return await self.routing_manager.execute(
+        resp = await self.routing_manager.execute(
             "insert into routing (id, destination, status) "
             f"values ('{_id}', '{destination}', 'assigned') on conflict (id) do update "
             f"set destination='{destination}', status='assigned' "
         )
+        await self.routing_manager.invalidate(["get_id", "get_destination"])
+        return resp
 
     if not utils.get_secret("ORDER"):
         del do_order, do_pay
@@ -332,6 +334,9 @@ class Forest(PayBot):
         await self.datastore.account_interface.migrate()
         await self.group_routing_manager.execute("DROP TABLE IF EXISTS group_routing")
         await self.group_routing_manager.create_table()
+        await self.group_routing_manager.invalidate(
+            ["get_group_id_for_sms_route", "get_sms_route_for_group"]
+        )
 
 
 async def inbound_sms_handler(request: web.Request) -> web.Response:
@@ -7,6 +7,16 @@ DATABASE_URL = utils.get_secret("DATABASE_URL")
 
 RoutingPGExpressions = PGExpressions(
     table="routing",
+    # looked up for every message. a destination can outlive its expiration by
+    # up to the TTL
+    cache_ttl={"get_id": 30, "get_destination": 30},
+    invalidates={
+        "set_destination": ["get_id", "get_destination"],
+        "set_expiration_ms": ["get_destination"],
+        "sweep_expired_destinations": ["get_destination"],
+        "delete": ["get_id", "get_destination"],
+        "delete_many": ["get_id", "get_destination"],
+    },
     migrate="ALTER TABLE IF EXISTS {self.table} ADD IF NOT EXISTS status CHARACTER VARYING(16);",
     create_table="CREATE TABLE IF NOT EXISTS {self.table} \
         (id TEXT PRIMARY KEY, \
@@ -20,6 +30,7 @@ RoutingPGExpressions = PGExpressions(
     set_expiration_ms="UPDATE {self.table} SET expiration_ms=$2 WHERE id=$1;",
     sweep_expired_destinations="UPDATE {self.table} SET expiration_ms=NULL, status='available' WHERE expiration_ms IS NOT NULL AND expiration_ms < (extract(epoch from now()) * 1000);",
     delete="DELETE FROM {self.table} WHERE id=$1",  # if you want to turn a number into a signal account
+    delete_many="DELETE FROM {self.table} WHERE id = ANY($1)",
     get_available="SELECT id FROM {self.table} WHERE status='available';",
     # routing
     get_destination="SELECT destination FROM {self.table} WHERE id=$1 AND (expiration_ms > extract(epoch from now()) * 1000 OR expiration_ms is NULL);",
@@ -28,6 +39,14 @@ RoutingPGExpressions = PGExpressions(
 
 GroupRoutingPGExpressions = PGExpressions(
     table="group_routing",
+    cache_ttl={"get_group_id_for_sms_route": 300, "get_sms_route_for_group": 300},
+    invalidates={
+        "set_sms_route_for_group": [
+            "get_group_id_for_sms_route",
+            "get_sms_route_for_group",
+        ],
+        "delete_table": ["get_group_id_for_sms_route", "get_sms_route_for_group"],
+    },
     create_table="CREATE TABLE IF NOT EXISTS {self.table} \
         (id SERIAL PRIMARY KEY, their_sms CHARACTER VARYING(16), \
         our_sms CHARACTER VARYING(16), \
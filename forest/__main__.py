@@ -0,0 +1,119 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+python -m forest [BOT_NUMBER] runs a QuestionBot.
+python -m forest --startup-profile prints where cold start time goes:
+module import times, then the first-use cost of lazily loaded subsystems.
+Running bots log how long bot init and the datastore download took once they're up.
+Set STARTUP_BUDGET_MS to exit nonzero when importing forest.core takes longer than that.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module: str) -> list[tuple[str, int, int]]:
+    """Import module in a fresh interpreter with -X importtime.
+    Returns (name, self us, cumulative us) for top-level imports and forest modules"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        # depth 1 is what the profiled module imports itself
+        if len(indent) <= 3 or name.startswith(("forest", "mc_util", "captcha")):
+            times.append((name, int(self_us), int(cumulative_us)))
+    return times
+
+
+def first_use_times() -> list[tuple[str, float]]:
+    """Time the explicit init and first use of each subsystem that's loaded lazily.
+    Some of these write files: the full-service ssl context writes its certificates
+    and file logging opens debug.log. Run them in a scratch directory so profiling
+    doesn't leave those behind or overwrite a real deployment's"""
+    # pylint: disable=import-outside-toplevel
+    from forest import core, message, payments_monitor, utils
+
+    def mc_util() -> None:
+        core.mc_util.pmob2mob(1)
+
+    def autosave() -> None:
+        try:
+            __import__("forest.autosave")
+        except OSError:  # no libfuse
+            pass
+
+    steps: list[tuple[str, Callable[[], object]]] = [
+        ("message quote table", message.unicode_quotes),
+        ("mc_util protobufs", mc_util),
+        ("captcha", core.get_captcha),
+        ("full-service ssl context", payments_monitor.get_ssl_context),
+        ("memfs (autosave, fuse)", autosave),
+        ("prometheus_async", lambda: __import__("prometheus_async.aio")),
+        ("file logging", utils.start_file_logging),
+    ]
+    timings = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            for name, step in steps:
+                start = time.perf_counter()
+                step()
+                timings.append((name, time.perf_counter() - start))
+        finally:
+            os.chdir(cwd)
+    return timings
+
+
+def startup_profile() -> int:
+    imports = import_times("forest.core")
+    total_import_ms = max(cumulative for _, _, cumulative in imports) / 1000
+    print(f"{'self ms':>9} {'cumul ms':>9}  import")
+    for name, self_us, cumulative_us in sorted(imports, key=lambda row: -row[2]):
+        if cumulative_us >= 1000:
+            print(f"{self_us / 1000:9.1f} {cumulative_us / 1000:9.1f}  {name}")
+    print(f"\n{'ms':>9}  init / first use")
+    inits = first_use_times()
+    for name, seconds in inits:
+        print(f"{seconds * 1000:9.1f}  {name}")
+    total_init_ms = sum(seconds for _, seconds in inits) * 1000
+    print(
+        f"\nimport forest.core: {total_import_ms:.1f}ms, lazy init: {total_init_ms:.1f}ms"
+    )
+    from forest import utils  # pylint: disable=import-outside-toplevel
+
+    budget = float(utils.get_secret("STARTUP_BUDGET_MS") or 0)
+    if budget and total_import_ms > budget:
+        print(f"over startup budget of {budget:g}ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--startup-profile", action="store_true")
+    args, rest = parser.parse_known_args()
+    if args.startup_profile:
+        sys.exit(startup_profile())
+    # Signal reads the bot number from sys.argv[1]
+    sys.argv = [sys.argv[0], *rest]
+    from forest.core import QuestionBot, run_bot  # pylint: disable=ungrouped-imports
+
+    run_bot(QuestionBot)
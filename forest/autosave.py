@@ -3,19 +3,42 @@
 # Copyright (c) 2021 The Forest Team
 
 import asyncio
+import io
 import logging
+import multiprocessing
 import os
-import time
+import threading
 from pathlib import Path
 from subprocess import PIPE, Popen
-from typing import Any
+from io import BytesIO
+from multiprocessing.connection import Connection
+from typing import Any, Optional
 
 import aioprocessing
 from aiohttp import web
+from prometheus_client import Gauge
 
-from forest import fuse, mem, utils
+from forest import datastore, fuse, mem, utils
+from forest.coordinator import UploadCoordinator
 
 _memfs_process = None
+# filled in by start_memfs: requests for snapshots of memfs, and the snapshots
+_snapshot_requests: Optional[aioprocessing.AioQueue] = None
+_snapshots: Optional[aioprocessing.AioQueue] = None
+_snapshot_lock: Optional[asyncio.Lock] = None
+# memfs streams archives it builds back to us over this pipe
+_archives: Optional[Connection] = None
+# archives are sent in messages of this size
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+# give up on an archive if memfs doesn't send anything for this many seconds
+ARCHIVE_TIMEOUT = 60.0
+
+memfs_used = Gauge("memfs_used_bytes", "bytes of file data held by memfs")
+memfs_peak = Gauge("memfs_peak_bytes", "most bytes of file data memfs has held")
+memfs_quota = Gauge("memfs_quota_bytes", "most bytes memfs may hold, 0 if unlimited")
+
+
+upload_coordinator: Optional[UploadCoordinator] = None
 
 
 # this is the first thing that runs on aiohttp app startup, before datastore.download
@@ -26,8 +49,13 @@ async def start_memfs(app: web.Application) -> None:
     this means we can log signal-cli's interactions with fs,
     and store them in mem_queue.
     """
+    global _snapshot_requests, _snapshots, _snapshot_lock, _archives  # pylint: disable=global-statement
     logging.info("starting memfs")
     app["mem_queue"] = mem_queue = aioprocessing.AioQueue()
+    _snapshot_requests = snapshot_requests = aioprocessing.AioQueue()
+    _snapshots = snapshots = aioprocessing.AioQueue()
+    _snapshot_lock = asyncio.Lock()
+    _archives, archive_writer = multiprocessing.Pipe(duplex=False)
     if not os.path.exists("/dev/fuse"):
         # you *must* have fuse already loaded if running locally
         proc = Popen(
@@ -36,7 +64,7 @@ async def start_memfs(app: web.Application) -> None:
             stderr=PIPE,
         )
         proc.wait()
-        (stdout, stderr) = proc.communicate()  # pylint: disable=unused-variable
+        stdout, stderr = proc.communicate()  # pylint: disable=unused-variable
         if stderr:
             raise Exception(
                 f"Could not load fuse module! You may need to recompile.\t\n{stderr.decode()}"
@@ -46,52 +74,223 @@ async def start_memfs(app: web.Application) -> None:
         """Start the memfs process"""
         mountpath = Path(utils.ROOT_DIR) / path
         logging.info("Starting memfs with PID: %s on dir: %s", os.getpid(), mountpath)
-        backend = mem.Memory(logqueue=mem_queue)  # type: ignore
+
+        def serve(backend: Any) -> None:
+            threading.Thread(
+                target=serve_snapshots,
+                args=(backend, snapshot_requests, snapshots, archive_writer),
+                daemon=True,
+            ).start()
+
+        events = fuse.EventBatcher(  # type: ignore
+            mem_queue,
+            max_events=int(utils.get_secret("MEMFS_EVENT_BATCH") or 64),
+            max_delay=float(utils.get_secret("MEMFS_EVENT_DELAY") or 0.1),
+        )
+        # comma-separated FUSE ops to send to the monitor, or "all"
+        log_ops = utils.get_secret("MEMFS_EVENTS") or "fsync"
+        backend = mem.Memory(  # type: ignore
+            logqueue=events,
+            on_init=serve,
+            log_ops=None if log_ops == "all" else set(log_ops.split(",")),
+            keep_cache=not utils.get_secret("MEMFS_NO_KEEP_CACHE"),
+            direct_io=bool(utils.get_secret("MEMFS_DIRECT_IO")),
+            # writes past this fail with ENOSPC instead of running us out of memory
+            quota=int(utils.get_secret("MEMFS_QUOTA_MB") or 0) * 1024 * 1024,
+        )
         logging.info("mountpoint already exists: %s", mountpath.exists())
         Path(utils.ROOT_DIR).mkdir(exist_ok=True, parents=True)
-        return fuse.FUSE(operations=backend, mountpoint=utils.ROOT_DIR + "/data")  # type: ignore
+        return fuse.FUSE(  # type: ignore
+            operations=backend, mountpoint=utils.ROOT_DIR + "/data", raw_fi=True
+        )
 
     async def launch() -> None:
         logging.info("about to launch memfs with aioprocessing")
         memfs = aioprocessing.AioProcess(target=memfs_proc)
         memfs.start()  # pylint: disable=no-member
+        # only memfs writes archives. without our copy, the pipe closes when it exits
+        archive_writer.close()
         app["memfs"] = memfs
         _memfs_process = memfs
 
     await launch()
 
 
-# input, operation, path, arguments, caller
-# ["->", "fsync", "/+14703226669", "(1, 2)", "/app/signal-cli", ["/app/signal-cli", "--config", "/app", "--username=+14703226669", "--output=json", "stdio", ""], 0, 0, 523]
-# ["<-", "fsync", "0"]
+class PipeWriter(io.RawIOBase):
+    "Sends everything written to it over a multiprocessing connection"
+
+    def __init__(self, connection: Connection) -> None:
+        super().__init__()
+        self.connection = connection
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self.connection.send_bytes(data)
+        return len(data)
+
+
+def send_archive(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    backend: Any,
+    paths: list[str],
+    prefix: str,
+    compression: str,
+    level: int,
+    archives: Connection,
+) -> None:
+    """
+    Runs in the memfs process. Snapshot paths, then stream them as a compressed
+    archive over archives, ending with an empty message
+    """
+    stream = io.BufferedWriter(PipeWriter(archives), ARCHIVE_CHUNK_SIZE)
+    try:
+        snapshot = backend.snapshot(paths)
+        entries = [(prefix + path, *entry) for path, *entry in snapshot]
+        with datastore.compressed_writer(stream, compression, level) as archive:  # type: ignore
+            datastore.write_tarball(entries, archive)
+        stream.flush()
+    finally:
+        archives.send_bytes(b"")
+
+
+def serve_snapshots(
+    backend: Any,
+    requests: aioprocessing.AioQueue,
+    results: aioprocessing.AioQueue,
+    archives: Connection,
+) -> None:
+    """
+    Runs in the memfs process, answering snapshot_files with the entries,
+    and archive_files with whether the archive it sent over archives is complete
+    """
+    while True:
+        kind, paths, *args = requests.get()
+        try:
+            if kind == "archive":
+                prefix, compression, level = args
+                send_archive(backend, paths, prefix, compression, level, archives)
+                results.put(True)
+            else:
+                results.put(backend.snapshot(paths))
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("%s of %s failed", kind, paths)
+            results.put(None)
+
+
+def receive_archive(
+    archives: Connection, timeout: float = ARCHIVE_TIMEOUT
+) -> Optional[memoryview]:
+    """
+    Collect an archive sent by send_archive. This blocks, so run it in a thread.
+    Returns None if memfs exits or stalls for timeout seconds partway through
+    """
+    buffer = BytesIO()
+    try:
+        while True:
+            if not archives.poll(timeout):
+                logging.error("memfs stalled for %ss, giving up on archive", timeout)
+                return None
+            if not (chunk := archives.recv_bytes()):
+                return buffer.getbuffer()
+            buffer.write(chunk)
+    except (EOFError, OSError):
+        logging.exception("memfs closed the archive pipe")
+        return None
+
+
+def memfs_paths(paths: list[str]) -> list[str]:
+    # paths in memfs are relative to where it's mounted, ./data
+    return ["/" + str(Path(path).relative_to("data")) for path in paths]
+
+
+async def archive_files(
+    paths: list[str], compression: str, level: int
+) -> Optional[memoryview]:
+    """
+    Have memfs build a compressed archive of the files under paths (relative to the
+    working directory, e.g. data/+1...) at a single point in time and send it to us,
+    instead of reading them back through the mount.
+    Returns None if memfs isn't running or the archive failed
+    """
+    global _snapshot_requests, _archives  # pylint: disable=global-statement
+    if not _snapshot_requests or not _snapshots or not _snapshot_lock or not _archives:
+        return None
+    request = ("archive", memfs_paths(paths), "data", compression, level)
+    async with _snapshot_lock:
+        await _snapshot_requests.coro_put(request)  # pylint: disable=no-member
+        data = await asyncio.to_thread(receive_archive, _archives)
+        if data is None:
+            # memfs is gone or stuck, and anything it sends later would answer the
+            # wrong request. stop asking it, so files are read through the mount
+            _snapshot_requests = _archives = None
+            return None
+        complete = await _snapshots.coro_get()  # pylint: disable=no-member
+    return data if complete else None
+
+
+async def snapshot_files(paths: list[str]) -> Optional[list[Any]]:
+    """
+    Copy the files under paths (relative to the working directory, e.g. data/+1...)
+    out of memfs at a single point in time, as datastore.Entry tuples.
+    Returns None if memfs isn't running
+    """
+    if not _snapshot_requests or not _snapshots or not _snapshot_lock:
+        return None
+    async with _snapshot_lock:
+        request = ("snapshot", memfs_paths(paths))
+        await _snapshot_requests.coro_put(request)  # pylint: disable=no-member
+        entries = await _snapshots.coro_get()  # pylint: disable=no-member
+    if entries is None:
+        return None
+    return [("data" + path, *entry) for path, *entry in entries]
+
+
+def record_memfs_usage(used: int, peak: int, quota: int) -> None:
+    memfs_used.set(used)
+    memfs_peak.set(peak)
+    memfs_quota.set(quota)
+    if quota and used > 0.9 * quota:
+        logging.warning("memfs is using %s of its %s byte quota", used, quota)
+
+
+# lists of [input, operation, path, arguments, caller], or ["usage", used, peak, quota], e.g.
+# [["->", "fsync", "/+14703226669", "(1, 2)", "/app/signal-cli", ["/app/signal-cli", "--config", "/app", "--username=+14703226669", "--output=json", "stdio", ""], 0, 0, 523]]
 async def start_memfs_monitor(app: web.Application) -> None:
     """
     monitor the memfs activity queue for file saves, sync with supabase
     """
 
+    async def upload() -> None:
+        if bot := app.get("bot"):
+            await bot.datastore.upload()
+
     async def upload_after_signalcli_writes() -> None:
+        global upload_coordinator  # pylint: disable=global-statement
         queue = app.get("mem_queue")
         if not queue:
             logging.info("no mem_queue, nothing to monitor")
             return
         logging.info("monitoring memfs")
-        counter = 0
+        upload_coordinator = UploadCoordinator(
+            upload,
+            debounce=float(utils.get_secret("AUTOSAVE_DEBOUNCE") or 2),
+            max_staleness=float(utils.get_secret("AUTOSAVE_MAX_STALENESS") or 30),
+        )
         while True:
-            queue_item = await queue.coro_get()
-            # iff fsync triggered by signal-cli
-            if (
-                queue_item[0:2] == ["->", "fsync"]
-                and queue_item[5][0] == utils.ROOT_DIR + "/signal-cli"
-            ):
-                # /+14703226669
-                # file_to_sync = queue_item[2]
-                # 14703226669
-                maybe_session = app.get("session")
-                if maybe_session:
-                    counter += 1
-                    if time.time() % (60 * 3) == 0:
-                        logging.info("background syncs in the past ~3min: %s", counter)
-                        counter = 0
-                    await maybe_session.datastore.upload()
+            # memfs sends events in batches
+            for queue_item in await queue.coro_get():
+                if queue_item[0] == "usage":
+                    record_memfs_usage(*queue_item[1:])
+                # iff fsync triggered by signal-cli
+                elif (
+                    queue_item[0:2] == ["->", "fsync"]
+                    and queue_item[5]
+                    and queue_item[5][0] == utils.ROOT_DIR + "/signal-cli"
+                ):
+                    # /+14703226669
+                    # file_to_sync = queue_item[2]
+                    # 14703226669
+                    upload_coordinator.trigger()
 
     app["mem_task"] = asyncio.create_task(upload_after_signalcli_writes())
@@ -0,0 +1,85 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+JSON encoding and decoding for signal client traffic, full-service and the KV stores.
+With FAST_RUNTIME, uses orjson or ujson if either is installed; otherwise stdlib json.
+Decoding errors are always raised as json.JSONDecodeError.
+"""
+import functools
+import json
+from types import ModuleType
+from typing import Any, Callable, Optional, Union
+
+from forest import utils
+
+JSONDecodeError = json.JSONDecodeError
+
+
+def _encode_dumps(obj: Any) -> bytes:
+    return _dumps(obj).encode()
+
+
+def _decode_dumpb(obj: Any) -> str:
+    return _dumpb(obj).decode()
+
+
+backend = "json"
+_dumps: Callable[[Any], str] = json.dumps
+_dumpb: Callable[[Any], bytes] = _encode_dumps
+_loads: Callable[[Union[str, bytes]], Any] = json.loads
+
+
+def _import(name: str) -> Optional[ModuleType]:
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+
+def use(name: str = "fast") -> str:
+    """
+    Switch to the "json", "orjson" or "ujson" backend, or "fast" for the
+    fastest one installed. Falls back to json if the backend isn't installed.
+    Returns the name of the backend in use.
+    """
+    global backend, _dumpb, _dumps, _loads  # pylint: disable=global-statement
+    candidates = ["orjson", "ujson"] if name == "fast" else [name]
+    for candidate in candidates:
+        module = _import(candidate) if candidate in ("orjson", "ujson") else None
+        if not module:
+            continue
+        if candidate == "orjson":
+            _dumpb = functools.partial(module.dumps, option=module.OPT_NON_STR_KEYS)
+            _dumps = _decode_dumpb
+        else:
+            _dumps = functools.partial(module.dumps, escape_forward_slashes=False)
+            _dumpb = _encode_dumps
+        _loads = module.loads
+        backend = candidate
+        return backend
+    _dumps, _dumpb, _loads = json.dumps, _encode_dumps, json.loads
+    backend = "json"
+    return backend
+
+
+def dumps(obj: Any) -> str:
+    return _dumps(obj)
+
+
+def dumpb(obj: Any) -> bytes:
+    "Encode straight to bytes, e.g. for writing to a pipe. orjson skips a copy"
+    return _dumpb(obj)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    try:
+        return _loads(data)
+    except JSONDecodeError:
+        raise
+    except ValueError as e:  # ujson
+        doc = data if isinstance(data, str) else data.decode(errors="replace")
+        raise JSONDecodeError(str(e), doc, 0) from e
+
+
+use("fast" if utils.get_secret("FAST_RUNTIME") else "json")
@@ -0,0 +1,89 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Debounced, single-flight datastore uploads for autosave. Kept out of autosave.py,
+which loads libfuse on import
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from prometheus_client import Counter
+
+upload_triggers = Counter("autosave_triggers", "fsyncs that requested an upload")
+upload_coalesced = Counter(
+    "autosave_coalesced", "upload requests merged into an already pending upload"
+)
+uploads_completed = Counter("autosave_uploads", "datastore uploads completed")
+
+
+class UploadCoordinator:
+    """
+    Debounces datastore uploads. Uploads once there haven't been new triggers for
+    `debounce` seconds, or once the oldest pending trigger is `max_staleness` seconds old.
+    Only one upload runs at a time; triggers during an upload collapse into
+    a single trailing upload.
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[], Awaitable[Any]],
+        debounce: float = 2.0,
+        max_staleness: float = 30.0,
+    ) -> None:
+        self.upload = upload
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        # monotonic time of the first and the latest trigger since the last upload started
+        self.dirty_since: Optional[float] = None
+        self.last_trigger = 0.0
+        self.wakeup = asyncio.Event()
+        self.upload_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    def trigger(self) -> None:
+        upload_triggers.inc()
+        now = time.monotonic()
+        if self.dirty_since is None:
+            self.dirty_since = now
+        else:
+            upload_coalesced.inc()
+        self.last_trigger = now
+        self.wakeup.set()
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.wait_and_upload())
+
+    async def wait_and_upload(self) -> None:
+        while self.dirty_since is not None:
+            deadline = min(
+                self.last_trigger + self.debounce, self.dirty_since + self.max_staleness
+            )
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.flush()
+
+    async def flush(self, force: bool = False) -> None:
+        "Upload if anything changed since the last upload started, or if force"
+        async with self.upload_lock:
+            if self.dirty_since is None and not force:
+                return
+            self.dirty_since = None
+            try:
+                await self.upload()
+                uploads_completed.inc()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("autosave upload failed")
+
+    async def shutdown(self) -> None:
+        "Stop waiting for triggers, let any upload in flight finish, then upload one last time"
+        if self.task and not self.task.done() and not self.upload_lock.locked():
+            self.task.cancel()
+        await self.flush(force=True)
@@ -10,7 +10,6 @@ import asyncio.subprocess as subprocess  # https://github.com/PyCQA/pylint/issue
 import base64
 import codecs
 import datetime
-import json
 import logging
 import os
 import signal
@@ -28,20 +27,30 @@ from asyncio.subprocess import PIPE
 from decimal import Decimal
 from functools import wraps
 from textwrap import dedent
-from typing import Any, Callable, Optional, Type, Union, Awaitable, Tuple
+from types import ModuleType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Optional,
+    Type,
+    Union,
+    Awaitable,
+    Tuple,
+)
 
 import aiohttp
 import termcolor
 from aiohttp import web
 from phonenumbers import NumberParseException
-from prometheus_async import aio
-from prometheus_client import Histogram, Summary
+from prometheus_client import Counter, Histogram, Summary
 from ulid2 import generate_ulid_as_base32 as get_uid
 
 # framework
-import mc_util
-from forest import autosave, datastore, payments_monitor, pghelp, utils, string_dist
+from forest import codec, datastore, payments_monitor, pghelp, utils, string_dist
+from forest.latency import LatencyDigest
 from forest.message import AuxinMessage, Message, StdioMessage
+from forest.throttle import Throttle
 
 JSON = dict[str, Any]
 Response = Union[str, list, dict[str, str], None]
@@ -49,14 +58,36 @@ AsyncFunc = Callable[..., Awaitable]
 
 roundtrip_histogram = Histogram("roundtrip_h", "Roundtrip message response time")  # type: ignore
 roundtrip_summary = Summary("roundtrip_s", "Roundtrip message response time")
+shed_counter = Counter(
+    "throttled_messages", "Messages shed by per-user throttling", ["action"]
+)
 
 MessageParser = AuxinMessage if utils.AUXIN else StdioMessage
+# raw blobs and outbound commands are logged a lot, so they're rate-sampled
+blob_logger = utils.get_sampled_logger("forest.blobs")
+command_logger = utils.get_sampled_logger("forest.commands")
 logging.info("Using message parser: %s", MessageParser)
 fee_pmob = int(1e12 * 0.0004)
-try:
-    import captcha
-except ImportError:
-    captcha = None  # type:ignore
+
+# heavy optional subsystems are imported on first use, see python -m forest --startup-profile
+if TYPE_CHECKING:
+    import mc_util
+    from forest import autosave
+else:
+    mc_util = utils.lazy_import("mc_util")
+    # memfs loads libfuse, so only import it if it's enabled
+    autosave = utils.lazy_import("forest.autosave") if utils.MEMFS else None
+
+
+@functools.cache
+def get_captcha() -> Optional[ModuleType]:
+    "captcha needs PIL, which is slow to import and may not be installed"
+    try:
+        import captcha  # pylint: disable=import-outside-toplevel
+
+        return captcha
+    except ImportError:
+        return None
 
 
 def rpc(
@@ -90,6 +121,9 @@ class Signal:
         logging.debug("bot number: %s", bot_number)
         self.bot_number = bot_number
         self.datastore = datastore.SignalDatastore(bot_number)
+        if autosave:
+            self.datastore.snapshot_files = autosave.snapshot_files
+            self.datastore.archive_files = autosave.archive_files
         self.proc: Optional[subprocess.Process] = None
         self.inbox: Queue[Message] = Queue()
         self.outbox: Queue[dict] = Queue()
@@ -107,7 +141,9 @@ class Signal:
         loop.add_signal_handler(signal.SIGINT, self.sync_signal_handler)
         logging.debug("added signal handler, downloading...")
         if utils.DOWNLOAD:
-            await self.datastore.download()
+            with utils.startup_phase("datastore download"):
+                await self.datastore.download()
+        utils.log_startup_timings()
         write_task: Optional[asyncio.Task] = None
         restart_count = 0
         max_backoff = 15
@@ -174,7 +210,10 @@ class Signal:
         """
         logging.info("starting async_shutdown")
         # if we're downloading, then we upload too
-        if utils.UPLOAD:
+        if utils.UPLOAD and autosave and autosave.upload_coordinator:
+            # wait for any autosave upload in progress instead of racing it
+            await autosave.upload_coordinator.shutdown()
+        elif utils.UPLOAD:
             await self.datastore.upload()
         # ideally also cancel Bot.restart_task
         if self.proc:
@@ -189,7 +228,7 @@ class Signal:
             await self.datastore.mark_freed()
         await pghelp.close_pools()
         # this still deadlocks. see https://github.com/forestcontact/forest-draft/issues/10
-        if autosave._memfs_process:
+        if autosave and autosave._memfs_process:
             executor = autosave._memfs_process._get_executor()
             logging.info(executor)
             executor.shutdown(wait=False, cancel_futures=True)
@@ -254,15 +293,15 @@ class Signal:
         if '{"jsonrpc":"2.0","result":[],"id":"receive"}' not in line:
             pass  # logging.debug("signal: %s", line)
         try:
-            blob = json.loads(line)
-        except json.JSONDecodeError:
+            blob = codec.loads(line)
+        except codec.JSONDecodeError:
             logging.info("signal: %s", line)
             return
         if "error" in blob:
             logging.info("signal: %s", line)
-            error = json.dumps(blob["error"])
+            error = codec.dumps(blob["error"])
             logging.error(
-                json.dumps(blob).replace(error, termcolor.colored(error, "red"))
+                codec.dumps(blob).replace(error, termcolor.colored(error, "red"))
             )
             if "traceback" in blob:
                 exception, *tb = blob["traceback"].split("\n")
@@ -281,7 +320,7 @@ class Signal:
     async def enqueue_blob_messages(self, blob: JSON) -> None:
         "turn rpc blobs into the appropriate number of Messages and put them in the inbox"
         message_blob: Optional[JSON] = None
-        logging.info(blob)
+        blob_logger.debug("blob: %s", blob)
         if "params" in blob:
             if isinstance(blob["params"], list):
                 for msg in blob["params"]:
@@ -447,7 +486,7 @@ class Signal:
 
     async def respond(self, target_msg: Message, msg: Response) -> str:
         """Respond to a message depending on whether it's a DM or group"""
-        logging.info(target_msg.source)
+        logging.debug("responding to %s", target_msg.source)
         if not target_msg.source:
             logging.error(target_msg.blob)
         if not utils.AUXIN and target_msg.group:
@@ -503,10 +542,10 @@ class Signal:
             if not command.get("method"):
                 logging.error("command without method: %s", command)
             if command.get("method") != "receive":
-                logging.info("input to signal: %s", json.dumps(command))
+                command_logger.info("input to signal: %s", command)
             if pipe.is_closing():
                 logging.error("signal stdin pipe is closed")
-            pipe.write(json.dumps(command).encode() + b"\n")
+            pipe.write(codec.dumpb(command) + b"\n")
             await pipe.drain()
 
 
@@ -548,7 +587,7 @@ def hide(command: Callable) -> Callable:
 Datapoint = tuple[int, str, float]  # timestamp in ms, command/info, latency in seconds
 
 
-class Bot(Signal):
+class Bot(Signal):  # pylint: disable=too-many-public-methods
     """Handles messages and command dispatch, as well as basic commands.
     Must be instantiated within a running async loop.
     Subclass this with your own commands.
@@ -560,6 +599,21 @@ class Bot(Signal):
         self.mobster = payments_monitor.Mobster()
         self.pongs: dict[str, str] = {}
         self.signal_roundtrip_latency: list[Datapoint] = []
+        # with ADMIN_METRICS_INTERVAL, latencies are sent to admin as periodic digests
+        self.latency_digest: Optional[LatencyDigest] = None
+        if utils.get_secret("ADMIN_METRICS_INTERVAL"):
+            self.latency_digest = LatencyDigest(
+                alert_threshold=float(utils.get_secret("ADMIN_METRICS_ALERT") or 0)
+            )
+        # with THROTTLE_RATE, each user gets THROTTLE_BURST messages refilled at that rate
+        self.throttle: Optional[Throttle] = None
+        if utils.get_secret("THROTTLE_RATE"):
+            self.throttle = Throttle(
+                rate=float(utils.get_secret("THROTTLE_RATE")),
+                burst=float(utils.get_secret("THROTTLE_BURST") or 5),
+            )
+        # the latest over-limit message from each user, answered once they're under the limit
+        self.coalesced_messages: dict[str, Message] = {}
         self.pending_response_tasks: list[asyncio.Task] = []
         self.commands = [
             name.removeprefix("do_") for name in dir(self) if name.startswith("do_")
@@ -582,6 +636,15 @@ class Bot(Signal):
             )
         )
         self.restart_task.add_done_callback(functools.partial(self.handle_task))
+        if self.latency_digest is not None:
+            self.latency_digest_task = asyncio.create_task(self.send_latency_digests())
+            self.latency_digest_task.add_done_callback(
+                functools.partial(
+                    self.handle_task,
+                    _func=self.send_latency_digests,
+                    attr="latency_digest_task",
+                )
+            )
 
     async def handle_messages(self) -> None:
         """
@@ -611,10 +674,42 @@ class Bot(Signal):
                     self.pending_requests[rpc_id] = asyncio.Future()
                     await self.outbox.put(sent_json_message)
                 continue
+            if not self.admit(message):
+                continue
             self.pending_response_tasks = [
                 task for task in self.pending_response_tasks if not task.done()
             ] + [asyncio.create_task(self.respond_and_collect_metrics(message))]
 
+    def admit(self, message: Message) -> bool:
+        """
+        Apply per-user throttling before handle_message. Over the limit, messages are
+        dropped, or with THROTTLE_COALESCE, only the latest one is kept and requeued
+        once the user has a token again. Payments, admins and non-text messages
+        are never throttled.
+        """
+        if not self.throttle or not message.full_text or message.payment:
+            return True
+        identity = message.uuid or message.source
+        if not identity or is_admin(message) or self.throttle.admit(identity):
+            return True
+        if not utils.get_secret("THROTTLE_COALESCE"):
+            shed_counter.labels("dropped").inc()
+            logging.info("dropping message from %s: over rate limit", identity)
+            return False
+
+        def release() -> None:
+            if latest := self.coalesced_messages.pop(identity, None):
+                self.inbox.put_nowait(latest)
+
+        if identity in self.coalesced_messages:
+            # only the latest message from this user will be answered
+            shed_counter.labels("coalesced").inc()
+        else:
+            delay = self.throttle.wait_time(identity)
+            asyncio.get_running_loop().call_later(delay, release)
+        self.coalesced_messages[identity] = message
+        return False
+
     # maybe this is merged with dispatch_message?
     async def respond_and_collect_metrics(self, message: Message) -> None:
         """
@@ -646,9 +741,36 @@ class Bot(Signal):
             roundtrip_histogram.observe(roundtrip_delta)  # type: ignore
             logging.info("noted roundtrip time: %s", roundtrip_delta)
             if utils.get_secret("ADMIN_METRICS"):
+                await self.report_latency(note, roundtrip_delta, python_delta)
+
+    async def report_latency(
+        self, note: str, roundtrip_delta: float, python_delta: Optional[float] = None
+    ) -> None:
+        """
+        Tell admin how long a command took. In digest mode, fold the latency into
+        the current digest instead and only message admin if it looks anomalous.
+        """
+        if self.latency_digest is None:
+            if python_delta is None:
+                await self.admin(f"{note} delta: {roundtrip_delta}")
+            else:
                 await self.admin(
                     f"command: {note}. python delta: {python_delta}s. roundtrip delta: {roundtrip_delta}s",
                 )
+            return
+        alert = self.latency_digest.observe(note, roundtrip_delta, python_delta)
+        if alert:
+            await self.admin(alert)
+
+    async def send_latency_digests(self) -> None:
+        """Every ADMIN_METRICS_INTERVAL seconds, send admin a latency summary"""
+        interval = float(utils.get_secret("ADMIN_METRICS_INTERVAL") or 3600)
+        while self.latency_digest is not None:
+            await asyncio.sleep(interval)
+            if self.latency_digest:
+                summary = self.latency_digest.summary()
+                self.latency_digest.reset()
+                await self.admin(f"latency over the last {interval:g}s:\n{summary}")
 
     def is_command(self, msg: Message) -> bool:
         # "mentions":[{"name":"+447927948360","number":"+447927948360","uuid":"fc4457f0-c683-44fe-b887-fe3907d7762e","start":0,"length":1}
@@ -769,7 +891,7 @@ class Bot(Signal):
 
     def get_recipients(self) -> list[dict[str, str]]:
         """Returns a list of all known recipients by parsing underlying datastore."""
-        return json.loads(
+        return codec.loads(
             open(f"data/{self.bot_number}.d/recipients-store").read()
         ).get("recipients", [])
 
@@ -896,7 +1018,8 @@ class PayBot(Bot):
             return
         amount_mob = float(mc_util.pmob2mob(amount_pmob))
         amount_usd_cents = round(amount_mob * await self.mobster.get_rate() * 100)
-        await self.mobster.ledger_manager.put_pmob_tx(
+        # written in one COPY with other payments arriving around the same time
+        await self.mobster.ledger_manager.buffer_pmob_tx(
             message.source,
             amount_usd_cents,
             amount_pmob,
@@ -983,10 +1106,10 @@ class PayBot(Bot):
         resp = await self.signal_rpc_request(
             "send", simulate=True, message="", destination="+15555555555"
         )
-        content_skeletor = json.loads(resp.blob["simulate_output"])
+        content_skeletor = codec.loads(resp.blob["simulate_output"])
         content_skeletor["dataMessage"]["body"] = None
         content_skeletor["dataMessage"]["payment"] = payment
-        return json.dumps(content_skeletor)
+        return codec.dumps(content_skeletor)
 
     async def build_gift_code(self, amount_pmob: int) -> list[str]:
         """Builds a gift code and returns a list of messages to send, given an amount in pMOB."""
@@ -1301,6 +1424,7 @@ class QuestionBot(PayBot):
     async def do_challenge(self, msg: Message) -> Response:
         """Challenges a user to do a simple math problem, optionally provided as an image to increase attacker complexity."""
         # the captcha module delivers graphical challenges of the same format
+        captcha = get_captcha()
         if captcha is not None:
             challenge, answer = captcha.get_challenge_and_answer()
             await self.send_message(
@@ -1386,6 +1510,13 @@ async def metrics(request: web.Request) -> web.Response:
     )
 
 
+async def prometheus_stats(request: web.Request) -> web.Response:
+    # prometheus_async is slow to import, so wait until metrics are scraped
+    from prometheus_async import aio  # pylint: disable=import-outside-toplevel
+
+    return await aio.web.server_stats(request)
+
+
 app = web.Application()
 
 
@@ -1402,7 +1533,7 @@ app.add_routes(
         web.get("/pongs/{pong}", pong_handler),
         web.post("/user/{phonenumber}", send_message_handler),
         web.post("/admin", admin_handler),
-        web.get("/metrics", aio.web.server_stats),
+        web.get("/metrics", prometheus_stats),
         web.get("/csv_metrics", metrics),
     ]
 )
@@ -1413,15 +1544,38 @@ app.add_routes(
 # 3. download
 # 4. start process
 
+
+async def start_file_logging(_app: web.Application) -> None:
+    utils.start_file_logging()
+
+
+app.on_startup.append(start_file_logging)
 app.on_startup.append(add_tiprat)
-if utils.MEMFS:
+if autosave:
     app.on_startup.append(autosave.start_memfs)
     app.on_startup.append(autosave.start_memfs_monitor)
 
 
+def install_fast_loop() -> bool:
+    "With FAST_RUNTIME, use uvloop for the event loop if it's installed"
+    if not utils.get_secret("FAST_RUNTIME"):
+        return False
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logging.warning("FAST_RUNTIME is set but uvloop isn't installed")
+        return False
+    uvloop.install()
+    logging.info("using uvloop and %s", codec.backend)
+    return True
+
+
 def run_bot(bot: Type[Bot], local_app: web.Application = app) -> None:
+    install_fast_loop()
+
     async def start_wrapper(our_app: web.Application) -> None:
-        our_app["bot"] = bot()
+        with utils.startup_phase("bot init"):
+            our_app["bot"] = bot()
 
     local_app.on_startup.append(start_wrapper)
     web.run_app(app, port=8080, host="0.0.0.0", access_log=None)
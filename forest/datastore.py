@@ -4,17 +4,24 @@
 
 import argparse
 import asyncio
+import gzip
+import hashlib
 import json
 import logging
 import os
 import shutil
 import socket
+import stat
 import sys
+import tempfile
 import time
-from io import BytesIO
+from contextlib import contextmanager
+from io import BufferedIOBase, BufferedReader, BytesIO
 from pathlib import Path
-from tarfile import TarFile
-from typing import Any, Callable, Optional
+from tarfile import DIRTYPE, TarFile, TarInfo
+from typing import Any, Awaitable, Callable, Iterable, Iterator, Optional, Union
+
+from prometheus_client import Histogram
 
 try:
     # normally in a package
@@ -30,10 +37,34 @@ except ImportError:
         sys.path.append("..")
         import pghelp  # type: ignore # pylint: disable=ungrouped-imports
         import utils  # type: ignore # pylint: disable=ungrouped-imports
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
 if utils.get_secret("MIGRATE"):
-    get_datastore = "SELECT account, datastore FROM {self.table} WHERE id=$1"
+    get_datastore = "SELECT account, datastore, manifest FROM {self.table} WHERE id=$1"
 else:
-    get_datastore = "SELECT datastore FROM {self.table} WHERE id=$1"
+    get_datastore = "SELECT datastore, manifest FROM {self.table} WHERE id=$1"
+
+# files are split into chunks of this size, stored once per sha256 in the chunks table
+CHUNK_SIZE = 256 * 1024
+
+# stored archives start with this, a format version, and a compression byte.
+# rows from before this don't have a header and are plain tarballs
+ARCHIVE_MAGIC = b"FDS"
+ARCHIVE_VERSION = 1
+COMPRESSION_BYTES = {"none": b"n", "gzip": b"g", "zstd": b"z"}
+
+# a file or directory to archive: (path, st_mode, mtime, contents or None for directories)
+Entry = tuple[str, int, float, Optional[bytes]]
+SnapshotFunc = Callable[[list[str]], Awaitable[Optional[list[Entry]]]]
+# (paths, compression, level) -> compressed archive of paths
+ArchiveFunc = Callable[[list[str], str, int], Awaitable[Optional[memoryview]]]
+
+archive_histogram = Histogram(
+    "datastore_archive_seconds", "Time to archive the datastore for upload"
+)
 
 
 class DatastoreError(Exception):
@@ -43,35 +74,77 @@ class DatastoreError(Exception):
 AccountPGExpressions = pghelp.PGExpressions(
     table="signal_accounts",
     # rename="ALTAR TABLE IF EXISTS prod_users RENAME TO {self.table}",
-    migrate="ALTER TABLE IF EXISTS {self.table} ADD IF NOT EXISTS datastore BYTEA, ADD IF NOT EXISTS notes TEXT",
+    migrate="ALTER TABLE IF EXISTS {self.table} ADD IF NOT EXISTS datastore BYTEA, ADD IF NOT EXISTS notes TEXT, ADD IF NOT EXISTS manifest JSONB",
+    count_columns="SELECT count(*) AS columns FROM information_schema.columns \
+            WHERE table_name = '{self.table}' \
+            AND column_name IN ('datastore', 'notes', 'manifest');",
     create_table="CREATE TABLE IF NOT EXISTS {self.table} \
             (id TEXT PRIMARY KEY, \
             datastore BYTEA, \
+            manifest JSONB, \
             last_update_ms BIGINT, \
             last_claim_ms BIGINT, \
             active_node_name TEXT, \
             notes TEXT);",
-    is_registered="SELECT datastore is not null as registered FROM {self.table} WHERE id=$1",
+    is_registered="SELECT (datastore is not null or manifest is not null) as registered FROM {self.table} WHERE id=$1",
     get_datastore=get_datastore,
     get_claim="SELECT active_node_name FROM {self.table} WHERE id=$1",
     mark_account_claimed="UPDATE {self.table} \
         SET active_node_name = $2, \
         last_claim_ms = (extract(epoch from now()) * 1000) \
         WHERE id=$1;",
-    mark_account_freed="UPDATE {self.table} SET last_claim_ms = 0, \
-        active_node_name = NULL WHERE id=$1;",
-    get_free_account="SELECT id, datastore FROM {self.table} \
-            WHERE active_node_name IS NULL \
-            AND last_claim_ms = 0 \
-            LIMIT 1;",
+    # only succeeds if nobody else has the account, returning the id if it did
+    claim_account="UPDATE {self.table} \
+        SET active_node_name = $2, \
+        last_claim_ms = (extract(epoch from now()) * 1000) \
+        WHERE id=$1 AND (active_node_name IS NULL OR active_node_name = $2) \
+        RETURNING id;",
+    # nodes waiting for the account LISTEN for the freed id
+    mark_account_freed="WITH freed AS (UPDATE {self.table} SET last_claim_ms = 0, \
+        active_node_name = NULL WHERE id=$1 RETURNING id) \
+        SELECT pg_notify('{self.table}_freed', id) FROM freed;",
+    # claims up to $2 free accounts for node $1 in one statement. rows another
+    # node is claiming right now are skipped instead of waited on
+    lease_free_accounts="UPDATE {self.table} \
+            SET active_node_name = $1, \
+            last_claim_ms = (extract(epoch from now()) * 1000) \
+            WHERE id IN (SELECT id FROM {self.table} \
+                WHERE active_node_name IS NULL \
+                AND last_claim_ms = 0 \
+                LIMIT $2 FOR UPDATE SKIP LOCKED) \
+            RETURNING id;",
     upload="INSERT INTO {self.table} (id, datastore, last_update_ms) \
             VALUES($1, $2, (extract(epoch from now()) * 1000)) \
             ON CONFLICT (id) DO UPDATE SET \
-            datastore = $2, last_update_ms = EXCLUDED.last_update_ms;",
-    free_accounts_not_updated_in_the_last_hour="UPDATE {self.table} \
-            SET last_claim_ms = 0, active_node_name = NULL \
-            WHERE last_update_ms < ((extract(epoch from now())-3600) * 1000);",
+            datastore = $2, manifest = NULL, last_update_ms = EXCLUDED.last_update_ms \
+            RETURNING last_update_ms;",
+    upload_manifest="INSERT INTO {self.table} (id, manifest, last_update_ms) \
+            VALUES($1, $2, (extract(epoch from now()) * 1000)) \
+            ON CONFLICT (id) DO UPDATE SET \
+            manifest = $2, datastore = NULL, last_update_ms = EXCLUDED.last_update_ms \
+            RETURNING last_update_ms;",
+    free_accounts_not_updated_in_the_last_hour="WITH stale AS (SELECT id, active_node_name \
+            FROM {self.table} WHERE last_update_ms < ((extract(epoch from now())-3600) * 1000) \
+            FOR UPDATE), \
+            freed AS (UPDATE {self.table} SET last_claim_ms = 0, active_node_name = NULL \
+            FROM stale WHERE {self.table}.id = stale.id \
+            RETURNING stale.id, stale.active_node_name AS node) \
+            SELECT pg_notify('{self.table}_freed', id) FROM freed WHERE node IS NOT NULL;",
     get_timestamp="select last_update_ms from {self.table} where id=$1",
+    list_ids="SELECT id FROM {self.table} ORDER BY id",
+    delete_account="DELETE FROM {self.table} WHERE id=$1",
+)
+
+
+ChunkPGExpressions = pghelp.PGExpressions(
+    table="signal_datastore_chunks",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} \
+            (hash TEXT PRIMARY KEY, data BYTEA NOT NULL);",
+    get_stored_hashes="SELECT hash FROM {self.table} WHERE hash = ANY($1)",
+    put_chunks="INSERT INTO {self.table} (hash, data) \
+            SELECT * FROM unnest($1::text[], $2::bytea[]) \
+            ON CONFLICT (hash) DO NOTHING;",
+    get_chunks="SELECT hash, data FROM {self.table} WHERE hash = ANY($1)",
 )
 
 
@@ -82,6 +155,258 @@ def get_account_interface() -> pghelp.PGInterface:
     )
 
 
+async def add_missing_columns(interface: pghelp.PGInterface) -> None:
+    """
+    Add columns (like manifest) that older signal_accounts tables don't have.
+    Every query that reads accounts needs them. ALTER TABLE locks the table
+    even when there's nothing to add, so check for them first
+    """
+    record = await interface.count_columns()
+    if not record or record[0].get("columns") != 3:
+        logging.info("adding missing columns to %s", interface.table)
+        await interface.migrate()
+
+
+def get_chunk_interface() -> pghelp.PGInterface:
+    return pghelp.PGInterface(
+        query_strings=ChunkPGExpressions,
+        database=utils.get_secret("DATABASE_URL"),
+    )
+
+
+def archive_compression() -> tuple[str, int]:
+    """
+    DATASTORE_COMPRESSION (zstd, gzip or none) and DATASTORE_COMPRESSION_LEVEL.
+    Defaults to zstd if zstandard is installed, gzip otherwise
+    """
+    compression = utils.get_secret("DATASTORE_COMPRESSION") or "zstd"
+    if compression == "zstd" and not zstandard:
+        compression = "gzip"
+    if compression not in COMPRESSION_BYTES:
+        raise DatastoreError(f"unknown DATASTORE_COMPRESSION {compression}")
+    default_level = {"zstd": 10, "gzip": 6, "none": 0}[compression]
+    level = int(utils.get_secret("DATASTORE_COMPRESSION_LEVEL") or default_level)
+    return compression, level
+
+
+@contextmanager
+def compressed_writer(
+    buffer: BytesIO, compression: str, level: int
+) -> Iterator[BufferedIOBase]:
+    "Write an archive header to buffer, then yield a stream that compresses into it"
+    if compression == "zstd" and not zstandard:
+        raise DatastoreError("zstd compression needs zstandard installed")
+    buffer.write(
+        ARCHIVE_MAGIC + bytes([ARCHIVE_VERSION]) + COMPRESSION_BYTES[compression]
+    )
+    if compression == "none":
+        yield buffer
+        return
+    stream: BufferedIOBase
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level)
+        stream = compressor.stream_writer(buffer, closefd=False)  # type: ignore
+    else:
+        stream = gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=level, mtime=0)
+    with stream:
+        yield stream
+
+
+def decompressed_reader(data: bytes) -> BufferedIOBase:
+    "Stream the tarball out of a stored archive, with or without a header"
+    buffer = BytesIO(data)  # shares data's memory until written to
+    header = buffer.read(len(ARCHIVE_MAGIC) + 2)
+    if not header.startswith(ARCHIVE_MAGIC):
+        buffer.seek(0)
+        return buffer
+    version, compression = header[-2], header[-1:]
+    if version != ARCHIVE_VERSION:
+        raise DatastoreError(f"unknown datastore archive version {version}")
+    if compression == COMPRESSION_BYTES["zstd"]:
+        if not zstandard:
+            raise DatastoreError("datastore is zstd compressed, install zstandard")
+        return BufferedReader(zstandard.ZstdDecompressor().stream_reader(buffer))
+    if compression == COMPRESSION_BYTES["gzip"]:
+        return gzip.GzipFile(fileobj=buffer, mode="rb")
+    return buffer
+
+
+def walk(path: str) -> Iterator[Path]:
+    "Yield path and everything under it, parents before children"
+    root = Path(path)
+    if not root.exists():
+        return
+    yield root
+    if root.is_dir():
+        yield from sorted(root.rglob("*"))
+
+
+def disk_entries(paths: list[str]) -> Iterator[Entry]:
+    "Read the files under paths, one at a time"
+    for path in (entry for root in paths for entry in walk(root)):
+        info = path.stat()
+        data = None if path.is_dir() else path.read_bytes()
+        yield str(path), info.st_mode, info.st_mtime, data
+
+
+def write_tarball(entries: Iterable[Entry], stream: BufferedIOBase) -> list[str]:
+    "Write entries to stream as a tarball, returning the names added"
+    with TarFile.open(fileobj=stream, mode="w|") as tarball:
+        for name, mode, mtime, data in entries:
+            info = TarInfo(name)
+            info.mode = stat.S_IMODE(mode)
+            info.mtime = int(mtime)
+            if data is None:
+                info.type = DIRTYPE
+                tarball.addfile(info)
+            else:
+                info.size = len(data)
+                tarball.addfile(info, BytesIO(data))
+        return tarball.getnames()
+
+
+def extract_tarball(data: bytes, root: str) -> list[str]:
+    "Extract a stored archive under root, returning the names extracted"
+    # stream mode reads members as it goes instead of seeking back and forth
+    with TarFile.open(fileobj=decompressed_reader(data), mode="r|") as tarball:
+        tarball.extractall(root)
+        return tarball.getnames()
+
+
+def archive_names(data: bytes) -> list[str]:
+    "Read through a stored archive without extracting it, returning the names in it"
+    with TarFile.open(fileobj=decompressed_reader(data), mode="r|") as tarball:
+        return [member.name for member in tarball]
+
+
+def build_manifest(entries: Iterable[Entry]) -> tuple[dict, dict[str, bytes]]:
+    """
+    Hash files in CHUNK_SIZE pieces.
+    Returns a manifest mapping each file to its mode and chunk hashes
+    (and listing directories, so empty ones are recreated), and the chunks by hash.
+    """
+    files: dict[str, dict] = {}
+    dirs: list[str] = []
+    chunks: dict[str, bytes] = {}
+    for name, mode, _, data in entries:
+        if data is None:
+            dirs.append(name)
+            continue
+        hashes = []
+        for start in range(0, len(data), CHUNK_SIZE):
+            chunk = data[start : start + CHUNK_SIZE]
+            digest = hashlib.sha256(chunk).hexdigest()
+            chunks[digest] = chunk
+            hashes.append(digest)
+        files[name] = {"mode": stat.S_IMODE(mode), "chunks": hashes}
+    return {"version": 1, "dirs": dirs, "files": files}, chunks
+
+
+def safe_path(root: str, name: str) -> Path:
+    "Refuse manifest entries that would be written outside of root"
+    if Path(name).is_absolute() or ".." in Path(name).parts:
+        raise DatastoreError(f"unsafe path in manifest: {name}")
+    return Path(root) / name
+
+
+def write_manifest(manifest: dict, chunks: dict[str, bytes], root: str) -> None:
+    "Recreate the files described by manifest under root"
+    for name in manifest["dirs"]:
+        safe_path(root, name).mkdir(parents=True, exist_ok=True)
+    for name, entry in manifest["files"].items():
+        path = safe_path(root, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            for digest in entry["chunks"]:
+                f.write(chunks[digest])
+        path.chmod(entry["mode"])
+
+
+class DatastoreCache:
+    """
+    Keeps the last archive (or manifest and its chunks) of each account on local disk,
+    keyed by the account's last_update_ms, so restarting on the same node can skip
+    downloading it again. These hold signal keys, so only we can read them
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = Path(root)
+
+    def path(self, number: str, timestamp: int, kind: str) -> Path:
+        return self.root / f"{number}.{timestamp}.{kind}"
+
+    def entries(self, number: str) -> list[Path]:
+        if not self.root.is_dir():
+            return []
+        return [path for path in self.root.glob(f"{number}.*") if path.is_file()]
+
+    def get(self, number: str, timestamp: int) -> Optional[tuple[str, bytes]]:
+        "The kind (archive or manifest) and contents cached for this version, if any"
+        for kind in ("archive", "manifest"):
+            try:
+                return kind, self.path(number, timestamp, kind).read_bytes()
+            except FileNotFoundError:
+                continue
+        return None
+
+    @staticmethod
+    def write(path: Path, data: Union[bytes, memoryview]) -> None:
+        "Atomically replace path with data, readable only by us"
+        tmp = path.with_name(path.name + ".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def put(
+        self, number: str, timestamp: int, kind: str, data: Union[bytes, memoryview]
+    ) -> None:
+        "Cache data as the current version, replacing older ones. This blocks"
+        self.root.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path = self.path(number, timestamp, kind)
+        self.write(path, data)
+        for old in self.entries(number):
+            if old != path:
+                old.unlink(missing_ok=True)
+
+    def get_chunks(self, number: str, hashes: Iterable[str]) -> dict[str, bytes]:
+        chunks = {}
+        for digest in hashes:
+            try:
+                chunks[digest] = (self.root / "chunks" / number / digest).read_bytes()
+            except FileNotFoundError:
+                pass
+        return chunks
+
+    def put_chunks(self, number: str, chunks: dict[str, bytes], keep: set[str]) -> None:
+        "Cache chunks for number, dropping the ones not in keep. This blocks"
+        chunk_dir = self.root / "chunks" / number
+        self.root.mkdir(mode=0o700, parents=True, exist_ok=True)
+        chunk_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        for path in chunk_dir.iterdir():
+            if path.name not in keep:
+                path.unlink(missing_ok=True)
+        for digest, chunk in chunks.items():
+            path = chunk_dir / digest
+            if not path.exists():
+                self.write(path, chunk)
+
+
+def get_cache() -> Optional[DatastoreCache]:
+    """
+    The DatastoreCache in DATASTORE_CACHE, if it's set. This should be outside of
+    ROOT_DIR, which setup_tmpdir may wipe. Never with AUTOSAVE, which keeps the
+    datastore in memfs so the keys don't touch the disk
+    """
+    root = utils.get_secret("DATASTORE_CACHE")
+    if not root:
+        return None
+    if utils.MEMFS:
+        logging.warning("not caching the datastore on disk with AUTOSAVE")
+        return None
+    return DatastoreCache(root)
+
+
 class SignalDatastore:
     """
     Download, claim, mount, and sync a signal datastore
@@ -89,6 +414,16 @@ class SignalDatastore:
 
     def __init__(self, number: str):
         self.account_interface = get_account_interface()
+        self.chunk_interface = get_chunk_interface()
+        # hashes of chunks we know are already in postgres
+        self.stored_chunks: set[str] = set()
+        self.migrated = False
+        self.chunk_table_ready = False
+        # with memfs, autosave sets this to take consistent snapshots of our files
+        self.snapshot_files: Optional[SnapshotFunc] = None
+        # and this, to have memfs archive them itself
+        self.archive_files: Optional[ArchiveFunc] = None
+        self.cache = get_cache()
         formatted_number = utils.signal_format(number)
         if isinstance(formatted_number, str):
             self.number: str = formatted_number
@@ -106,6 +441,12 @@ class SignalDatastore:
             logging.error(e)
             return False
 
+    async def migrate(self) -> None:
+        "Add the columns our queries need to signal_accounts, once per process"
+        if not self.migrated:
+            await add_missing_columns(self.account_interface)
+            self.migrated = True
+
     async def is_claimed(self) -> Optional[str]:
         record = await self.account_interface.get_claim(self.number)
         if not record:
@@ -116,24 +457,51 @@ class SignalDatastore:
             raise Exception(f"no record in db for {self.number}")
         return record[0].get("active_node_name")
 
+    async def claim(self) -> None:
+        """
+        Mark our account claimed by this node. If another node has it, wait for
+        that node to free it (which it announces with NOTIFY) for up to
+        DATASTORE_CLAIM_TIMEOUT seconds, then take it over anyway
+        """
+        hostname = socket.gethostname()
+        timeout = float(utils.get_secret("DATASTORE_CLAIM_TIMEOUT") or 30)
+        deadline = time.monotonic() + timeout
+        freed = asyncio.Event()
+
+        def on_freed(_conn: Any, _pid: int, _channel: str, number: str) -> None:
+            if number == self.number:
+                freed.set()
+
+        channel = f"{self.account_interface.table}_freed"
+        async with self.account_interface.listen(channel, on_freed):
+            while True:
+                freed.clear()
+                if await self.account_interface.claim_account(self.number, hostname):
+                    logging.info("claimed account")
+                    return
+                claim = await self.is_claimed()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.info("time's up, taking the account from %s", claim)
+                    break
+                # you can also try to kill the other process
+                logging.info("this account is claimed by %s, waiting", claim)
+                try:
+                    # check again now and then, in case we miss the notification
+                    await asyncio.wait_for(freed.wait(), min(remaining, 6))
+                except asyncio.TimeoutError:
+                    pass
+        await self.account_interface.mark_account_claimed(self.number, hostname)
+
     async def download(self) -> None:
         """Fetch our account datastore from postgresql and mark it claimed"""
         logging.info("datastore download entered")
+        await self.migrate()
         await self.account_interface.free_accounts_not_updated_in_the_last_hour()
-        for i in range(5):
-            logging.info("checking claim")
-            claim = await self.is_claimed()
-            if not claim:
-                logging.info("no account claim!")
-                break
-            # you can also try to kill the other process
-            logging.info(
-                "this account is claimed by %s, waiting",
-                claim,
-            )
-            await asyncio.sleep(6)
-            if i == 4:
-                logging.info("time's up")
+        await self.claim()
+        timestamp = await self.last_update_ms()
+        if await self.download_cached(timestamp):
+            return
         logging.info("downloading")
         record = await self.account_interface.get_datastore(self.number)
         if not record and utils.get_secret("MIGRATE"):
@@ -152,57 +520,194 @@ class SignalDatastore:
                     pass
                 open("data/" + loaded_data["username"], "w").write(json_data)
                 return
-        buffer = BytesIO(record[0].get("datastore"))
-        tarball = TarFile(fileobj=buffer)
-        fnames = [member.name for member in tarball.getmembers()]
+        if manifest := record[0].get("manifest"):
+            await self.extract_manifest(json.loads(manifest))
+            await self.cache_put(timestamp, "manifest", manifest.encode())
+        else:
+            data = record[0].get("datastore")
+            await self.extract_archive(data)
+            await self.cache_put(timestamp, "archive", data)
+        # open("last_downloaded_checksum", "w").write(zlib.crc32(buffer.seek(0).read()))
+        return
+
+    async def last_update_ms(self) -> Optional[int]:
+        record = await self.account_interface.get_timestamp(self.number)
+        return record[0].get("last_update_ms") if record else None
+
+    async def download_cached(self, timestamp: Optional[int]) -> bool:
+        "Restore our files from the local cache if it has the version in postgres"
+        if not self.cache or timestamp is None:
+            return False
+        cached = await asyncio.to_thread(self.cache.get, self.number, timestamp)
+        if not cached:
+            logging.info("datastore cache miss for version %s", timestamp)
+            return False
+        kind, data = cached
+        if kind == "manifest":
+            saved = await self.extract_manifest(json.loads(data))
+        else:
+            await self.extract_archive(data)
+            saved = len(data)
+        logging.info(
+            "datastore cache hit for version %s, saved downloading %s kb",
+            timestamp,
+            round(saved / 1024, 1),
+        )
+        return True
+
+    async def cache_put(
+        self, timestamp: Optional[int], kind: str, data: Union[bytes, memoryview]
+    ) -> None:
+        if not self.cache or timestamp is None:
+            return
+        try:
+            await asyncio.to_thread(self.cache.put, self.number, timestamp, kind, data)
+        except OSError as e:
+            # the cache is only an optimization
+            logging.warning("couldn't cache datastore: %s", e)
+
+    async def extract_archive(self, data: bytes) -> None:
+        # extract in a thread so the event loop keeps going
+        fnames = await asyncio.to_thread(extract_tarball, data, utils.ROOT_DIR)
         logging.debug(fnames[:2])
         logging.info(
             "expected file %s exists: %s",
             self.filepath,
             self.filepath in fnames,
         )
-        tarball.extractall(utils.ROOT_DIR)
-        # open("last_downloaded_checksum", "w").write(zlib.crc32(buffer.seek(0).read()))
-        hostname = socket.gethostname()
-        await self.account_interface.mark_account_claimed(self.number, hostname)
-        logging.debug("marked account as claimed, asserting that this is the case")
-        assert await self.is_claimed()
-        return
 
-    def tarball_data(self) -> Optional[bytes]:
-        """Tarball our data files"""
+    async def extract_manifest(self, manifest: dict) -> int:
+        """
+        Fetch the chunks a manifest refers to (from the local cache when we have them)
+        and reassemble our files from them. Returns the bytes found in the cache
+        """
+        hashes = {
+            digest for entry in manifest["files"].values() for digest in entry["chunks"]
+        }
+        chunks: dict[str, bytes] = {}
+        if self.cache:
+            chunks = await asyncio.to_thread(self.cache.get_chunks, self.number, hashes)
+        cached = sum(map(len, chunks.values()))
+        if needed := list(hashes - chunks.keys()):
+            records = await self.chunk_interface.get_chunks(needed) or []
+            fetched = {record.get("hash"): record.get("data") for record in records}
+            chunks.update(fetched)
+            await self.cache_chunks(fetched, hashes)
+        if missing := hashes - chunks.keys():
+            raise DatastoreError(f"{len(missing)} chunks in manifest aren't stored")
+        await asyncio.to_thread(write_manifest, manifest, chunks, utils.ROOT_DIR)
+        logging.info(
+            "expected file %s exists: %s",
+            self.filepath,
+            self.filepath in manifest["files"],
+        )
+        self.stored_chunks = hashes
+        return cached
+
+    async def cache_chunks(self, chunks: dict[str, bytes], keep: set[str]) -> None:
+        if not self.cache:
+            return
+        try:
+            await asyncio.to_thread(self.cache.put_chunks, self.number, chunks, keep)
+        except OSError as e:
+            logging.warning("couldn't cache datastore chunks: %s", e)
+
+    def paths(self) -> list[str]:
+        return [self.filepath, self.filepath + ".d"]
+
+    async def snapshot(self) -> Optional[list[Entry]]:
+        "With memfs, a point-in-time copy of our files. Otherwise None, to read from disk"
+        if self.snapshot_files:
+            return await self.snapshot_files(self.paths())
+        return None
+
+    async def archive(self) -> Optional[memoryview]:
+        """
+        Compressed archive of our files. memfs builds it from memory if it can,
+        otherwise we build it in a thread so the event loop keeps handling messages
+        """
+        if self.archive_files:
+            if not self.is_registered_locally():
+                logging.error("datastore not registered. not uploading")
+                return None
+            data = await self.archive_files(self.paths(), *archive_compression())
+            if data is not None:
+                return data
+            logging.warning("memfs didn't send an archive, building it here")
+        return await asyncio.to_thread(self.tarball_data, await self.snapshot())
+
+    def tarball_data(
+        self, entries: Optional[Iterable[Entry]] = None
+    ) -> Optional[memoryview]:
+        """
+        Tarball our data files (or entries, if given), compressing them as they're added.
+        This blocks, so run it in a thread
+        """
         if not self.is_registered_locally():
             logging.error("datastore not registered. not uploading")
             return None
         # fixme: check if the last thing we downloaded/uploaded
         # is older than the last thing in the db
+        if not os.path.exists(self.filepath + ".d"):
+            logging.info("ignoring no %s", self.filepath + ".d")
         buffer = BytesIO()
-        tarball = TarFile(fileobj=buffer, mode="w")
-        try:
-            tarball.add(self.filepath)
-            try:
-                tarball.add(self.filepath + ".d")
-            except FileNotFoundError:
-                logging.info("ignoring no %s", self.filepath + ".d")
-        except FileNotFoundError:
-            logging.warning(
-                "couldn't find %s in %s, adding data instead",
-                self.filepath + ".d",
-                os.getcwd(),
-            )
-            tarball.add("data")
-        fnames = [member.name for member in tarball.getmembers()]
+        compression, level = archive_compression()
+        with compressed_writer(buffer, compression, level) as stream:
+            fnames = write_tarball(entries or disk_entries(self.paths()), stream)
         logging.debug(fnames[:2])
-        tarball.close()
-        buffer.seek(0)
-        data = buffer.read()
-        return data
+        # the compressed archive is the only copy we keep in memory
+        return buffer.getbuffer()
+
+    async def upload_chunks(self, entries: Optional[list[Entry]] = None) -> None:
+        """
+        Puts account datastore in postgresql as a manifest of file chunks,
+        only sending chunks that aren't already stored
+        """
+        if not self.is_registered_locally():
+            logging.error("datastore not registered. not uploading")
+            return
+        if not self.chunk_table_ready:
+            await self.chunk_interface.create_table()
+            self.chunk_table_ready = True
+        manifest, chunks = await asyncio.to_thread(
+            build_manifest, entries or disk_entries(self.paths())
+        )
+        new = [digest for digest in chunks if digest not in self.stored_chunks]
+        if new:
+            records = await self.chunk_interface.get_stored_hashes(new) or []
+            stored = {record.get("hash") for record in records}
+            new = [digest for digest in new if digest not in stored]
+        if new:
+            await self.chunk_interface.put_chunks(new, [chunks[d] for d in new])
+        manifest_data = json.dumps(manifest)
+        record = await self.account_interface.upload_manifest(
+            self.number, manifest_data
+        )
+        self.stored_chunks.update(chunks)
+        # chunks we didn't send may still be missing from the cache, so cache them all
+        await self.cache_chunks(chunks, set(chunks))
+        if record:
+            timestamp = record[0].get("last_update_ms")
+            await self.cache_put(timestamp, "manifest", manifest_data.encode())
+        kb = round(sum(len(chunks[digest]) for digest in new) / 1024, 1)
+        logging.debug(
+            "saved %s of %s chunks (%s kb) of datastore to postgres",
+            len(new),
+            len(chunks),
+            kb,
+        )
 
     async def upload(self) -> Any:
         """Puts account datastore in postgresql."""
-        data = self.tarball_data()
+        await self.migrate()
+        if utils.get_secret("INCREMENTAL_DATASTORE"):
+            return await self.upload_chunks(await self.snapshot())
+        start = time.time()
+        data = await self.archive()
         if not data:
             return
+        archive_histogram.observe(time.time() - start)
+        logging.info("archived datastore in %.3fs", time.time() - start)
         kb = round(len(data) / 1024, 1)
         # maybe something like:
         # upload and return registered timestamp. write timestamp locally. when uploading, check that the last_updated_ts in postgres matches the file
@@ -210,8 +715,10 @@ class SignalDatastore:
         # or:
         # open("last_uploaded_checksum", "w").write(zlib.crc32(buffer.seek(0).read()))
         # you could formalize this as "present the previous checksum to upload" as a db procedure
-        await self.account_interface.upload(self.number, data)
-        logging.debug("saved %s kb of tarballed datastore to supabase", kb)
+        record = await self.account_interface.upload(self.number, data)
+        logging.debug("saved %s kb of compressed datastore to supabase", kb)
+        if record:
+            await self.cache_put(record[0].get("last_update_ms"), "archive", data)
         return
 
     async def mark_freed(self) -> list:
@@ -242,18 +749,23 @@ def setup_tmpdir() -> None:
     return
 
 
-async def getFreeSignalDatastore() -> SignalDatastore:
+async def lease_free_accounts(count: int, node: Optional[str] = None) -> list[str]:
+    "Claim up to count free accounts for node (this host by default)"
     interface = get_account_interface()
     await interface.free_accounts_not_updated_in_the_last_hour()
-    record = await interface.get_free_account()
-    if not record:
+    records = await interface.lease_free_accounts(node or socket.gethostname(), count)
+    return [record.get("id") for record in records or []]
+
+
+async def getFreeSignalDatastore() -> SignalDatastore:
+    numbers = await lease_free_accounts(1)
+    if not numbers:
         raise Exception("no free accounts")
         # alternatively, register an account...
         # could put some of register.py/signalcaptcha handler here...
-    number = record[0].get("id")
-    logging.info(number)
-    assert number
-    return SignalDatastore(number)
+    logging.info(numbers[0])
+    # already claimed for us, so download's claim goes through right away
+    return SignalDatastore(numbers[0])
 
 
 # maybe a config about where we're running:
@@ -336,6 +848,27 @@ async def free(ns: argparse.Namespace) -> None:
     await get_account_interface().mark_account_freed(ns.number)
 
 
+@subcommand(
+    [
+        argument("--count", type=int, default=1, help="how many accounts to lease"),
+        argument("--node", help="node name to claim them for, default this host"),
+    ]
+)
+async def lease(ns: argparse.Namespace) -> None:
+    """
+    claim free accounts for a node and print their numbers, one per line,
+    so many workers can be started at once without racing for the same account
+    """
+    for number in await lease_free_accounts(ns.count, ns.node):
+        print(number)
+
+
+@subcommand()
+async def migrate(_args: argparse.Namespace) -> None:
+    "add the columns (like manifest) that newer versions use to the accounts table"
+    await add_missing_columns(get_account_interface())
+
+
 async def _set_note(number: str, note: str) -> None:
     await get_account_interface().execute(
         "update signal_accounts set notes=$1 where id=$2",
@@ -388,13 +921,172 @@ async def sync(ns: argparse.Namespace) -> None:
         await datastore.mark_freed()
 
 
+def percentiles(samples: list[float]) -> dict[str, float]:
+    "nearest-rank p50, p90, p99 and max"
+    ordered = sorted(samples)
+    ranks = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+    result = {
+        name: ordered[min(len(ordered) - 1, int(rank * len(ordered)))]
+        for name, rank in ranks.items()
+    }
+    result["max"] = ordered[-1]
+    return result
+
+
+async def time_bench_runs(
+    store: SignalDatastore, scratch: str, runs: int
+) -> tuple[int, dict[str, list[float]]]:
+    """
+    Archive store's files, upload them as scratch, download and extract them runs
+    times, then delete scratch. Returns the archive size and the time each phase took
+    """
+    timings: dict[str, list[float]] = {
+        "archive": [],
+        "upload": [],
+        "download": [],
+        "extract": [],
+    }
+    size = 0
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            data = await asyncio.to_thread(store.tarball_data)
+            timings["archive"].append(time.perf_counter() - start)
+            if not data:
+                return 0, timings
+            size = len(data)
+            start = time.perf_counter()
+            await store.account_interface.upload(scratch, data)
+            timings["upload"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            record = await store.account_interface.get_datastore(scratch)
+            timings["download"].append(time.perf_counter() - start)
+            with tempfile.TemporaryDirectory() as out:
+                start = time.perf_counter()
+                await asyncio.to_thread(
+                    extract_tarball, record[0].get("datastore"), out
+                )
+                timings["extract"].append(time.perf_counter() - start)
+    finally:
+        await store.account_interface.delete_account(scratch)
+    return size, timings
+
+
+@subcommand(
+    [
+        argument("--path", help="directory that contains data/, default ."),
+        argument("--number", help="account to benchmark, default the first in data/"),
+        argument("--runs", type=int, default=10),
+    ]
+)
+async def bench(ns: argparse.Namespace) -> None:
+    """
+    time archiving, uploading, downloading and extracting a local datastore.
+    uploads go to a scratch row that is deleted afterwards, but point
+    DATABASE_URL at a local postgres anyway
+    """
+    if ns.path:
+        os.chdir(ns.path)
+    num = ns.number or sorted(os.listdir("data"))[0]
+    store = SignalDatastore(num)
+    await store.migrate()
+    size, timings = await time_bench_runs(store, f"bench-{store.number}", ns.runs)
+    if not size:
+        return
+    compression, level = archive_compression()
+    print(f"{store.number}: {size / 1024:.0f} kb archive, {compression} {level}")
+    print(
+        f"{'phase':<10} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'max s':>8} {'MB/s':>8}"
+    )
+    for phase, samples in timings.items():
+        stats = percentiles(samples)
+        rate = size / stats["p50"] / 1024 / 1024 if stats["p50"] else 0.0
+        print(
+            f"{phase:<10} {stats['p50']:8.3f} {stats['p90']:8.3f}"
+            f" {stats['p99']:8.3f} {stats['max']:8.3f} {rate:8.1f}"
+        )
+
+
+async def verify_account(
+    interface: pghelp.PGInterface, chunk_interface: pghelp.PGInterface, number: str
+) -> tuple[int, Optional[str]]:
+    "Returns the stored size of number's datastore and what's wrong with it, if anything"
+    record = await interface.get_datastore(number)
+    if not record:
+        return 0, "no record"
+    if manifest_data := record[0].get("manifest"):
+        return await verify_manifest(chunk_interface, number, manifest_data)
+    data = record[0].get("datastore")
+    if not data:
+        return 0, "empty"
+    return len(data), await asyncio.to_thread(verify_archive, number, data)
+
+
+async def verify_manifest(
+    chunk_interface: pghelp.PGInterface, number: str, manifest_data: str
+) -> tuple[int, Optional[str]]:
+    "Fetch a manifest's chunks like a download would, so they count towards MB/s"
+    manifest = json.loads(manifest_data)
+    files = manifest["files"].values()
+    hashes = list({digest for entry in files for digest in entry["chunks"]})
+    chunks = await chunk_interface.get_chunks(hashes) or []
+    size = len(manifest_data) + sum(len(chunk.get("data")) for chunk in chunks)
+    if missing := len(hashes) - len(chunks):
+        return size, f"{missing} chunks missing"
+    if f"data/{number}" not in manifest["files"]:
+        return size, f"data/{number} missing from manifest"
+    return size, None
+
+
+def verify_archive(number: str, data: bytes) -> Optional[str]:
+    "What's wrong with an archive, if anything. This blocks"
+    try:
+        names = archive_names(data)
+    except Exception as e:  # pylint: disable=broad-except
+        return f"unreadable archive: {e!r}"
+    if f"data/{number}" not in names:
+        return f"data/{number} missing from archive"
+    return None
+
+
+async def verify_accounts(concurrency: int) -> list[tuple[str, int, Optional[str]]]:
+    "(number, stored size, problem or None) for every account, checking concurrency at once"
+    interface = get_account_interface()
+    chunk_interface = get_chunk_interface()
+    await add_missing_columns(interface)
+    numbers = [record.get("id") for record in await interface.list_ids() or []]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(number: str) -> tuple[str, int, Optional[str]]:
+        async with semaphore:
+            size, problem = await verify_account(interface, chunk_interface, number)
+            return number, size, problem
+
+    return await asyncio.gather(*map(check, numbers))
+
+
+@subcommand([argument("--concurrency", type=int, default=4)])
+async def verify(ns: argparse.Namespace) -> None:
+    "check that every account's stored datastore can be read and has its files"
+    start = time.perf_counter()
+    results = await verify_accounts(ns.concurrency)
+    elapsed = time.perf_counter() - start
+    for number, _, problem in results:
+        if problem:
+            print(f"{number}: {problem}")
+    total = sum(size for _, size, _ in results)
+    bad = sum(1 for *_, problem in results if problem)
+    print(
+        f"verified {len(results)} accounts, {bad} bad, {total / 1024 / 1024:.1f} MB"
+        f" in {elapsed:.1f}s ({total / (elapsed or 1) / 1024 / 1024:.1f} MB/s)"
+    )
+
+
 upload_parser = subparser.add_parser("upload")
 upload_parser.add_argument("--path")
 upload_parser.add_argument("--number")
 # download_parser = subparser.add_parser("download")
 # download_parser.add_argument("--number")
-# migrate_parser = subparser.add_parser("migrate")
-# migrate_parser.add_argument("--create")
 
 
 if __name__ == "__main__":
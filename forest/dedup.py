@@ -18,22 +18,17 @@ prod = forest_tables.RoutingManager(database=utils.get_secret("DATABASE_URL"))
 
 
 async def dedup() -> None:
-    dup_stage = [
-        record.get("id")
-        for record in (await staging.execute("select id from routing"))
-        if record in (await prod.execute("select id from routing"))
-    ]
-    dup_dev = [
-        record.get("id")
-        for record in (await dev.execute("select id from routing"))
-        if record in (await staging.execute("select id from routing"))
-    ]
+    query = "select id from routing"
+    prod_ids = {record.get("id") for record in await prod.execute(query)}
+    staging_ids = {record.get("id") for record in await staging.execute(query)}
+    dev_ids = {record.get("id") for record in await dev.execute(query)}
+    dup_stage = sorted(staging_ids & prod_ids)
+    dup_dev = sorted(dev_ids & staging_ids)
     for number in dup_stage:
         print(f"deleting duplicate record {number} from staging")
-        await staging.delete(number)
     for number in dup_dev:
         print(f"deleting duplicate record {number} from staging")
-        await staging.delete(number)
+    await staging.delete_many(dup_stage + dup_dev)
 
 
 if __name__ == "__main__":
@@ -24,6 +24,8 @@ import os
 import platform
 import signal
 import stat
+import threading
+import time
 import traceback
 from ctypes import *
 from ctypes.util import find_library
@@ -404,6 +406,42 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+class Py_buffer(Structure):
+    _fields_ = [
+        ("buf", c_void_p),
+        ("obj", py_object),
+        ("len", c_ssize_t),
+        ("itemsize", c_ssize_t),
+        ("readonly", c_int),
+        ("ndim", c_int),
+        ("format", c_char_p),
+        ("shape", POINTER(c_ssize_t)),
+        ("strides", POINTER(c_ssize_t)),
+        ("suboffsets", POINTER(c_ssize_t)),
+        ("internal", c_void_p),
+    ]
+
+
+_get_buffer = pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = (py_object, POINTER(Py_buffer), c_int)
+_get_buffer.restype = c_int
+_release_buffer = pythonapi.PyBuffer_Release
+_release_buffer.argtypes = (POINTER(Py_buffer),)
+_release_buffer.restype = None
+
+
+def copy_from_buffer(dest, data, size):
+    """Copies size bytes from any C-contiguous buffer, readonly or not, to dest
+    without an intermediate bytes object. Raises BufferError otherwise"""
+
+    view = Py_buffer()
+    _get_buffer(data, byref(view), 0)  # PyBUF_SIMPLE
+    try:
+        memmove(dest, view.buf, size)
+    finally:
+        _release_buffer(byref(view))
+
+
 def fuse_get_context():
     "Returns a (uid, gid, pid) tuple"
 
@@ -605,12 +643,24 @@ class FUSE(object):
             size,
         )
 
-        data = create_string_buffer(ret, retsize)
-        memmove(buf, data, retsize)
+        # copy straight from the result's memory into the kernel's buffer
+        if isinstance(ret, bytes):
+            memmove(buf, ret, retsize)
+        else:
+            try:
+                copy_from_buffer(buf, ret, retsize)
+            except BufferError:
+                # not contiguous, so there's no single address to copy from
+                memmove(buf, memoryview(ret).tobytes(), retsize)
         return retsize
 
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
+        if getattr(self.operations, "zero_copy_writes", False):
+            # a view of the kernel's buffer, only valid during this call
+            address = cast(buf, c_void_p).value
+            data = memoryview((c_char * size).from_address(address)).cast("B")
+        else:
+            data = string_at(buf, size)
 
         if self.raw_fi:
             fh = fip.contents
@@ -819,8 +869,14 @@ class Operations(object):
 
     When in doubt of what an operation should do, check the FUSE header file
     or the corresponding system call man page.
+
+    Set zero_copy_writes to have write receive a memoryview of the kernel's
+    buffer instead of bytes. It's only valid during the call, so copy what you keep.
+    read may return bytes, a bytearray, or a memoryview.
     """
 
+    zero_copy_writes = False
+
     def __call__(self, op, *args):
         if not hasattr(self, op):
             raise FuseOSError(errno.EFAULT)
@@ -989,30 +1045,102 @@ class Operations(object):
         raise FuseOSError(errno.EROFS)
 
 
+def process_key(pid):
+    """
+    pid's start time and the device and inode of its executable. The start time
+    tells apart processes that reuse a pid, and the executable changes on exec
+    """
+    with open("/proc/%d/stat" % pid) as f:
+        stat = f.read()
+    exe = os.stat("/proc/%d/exe" % pid)
+    # the command name before the fields we want is in parentheses and may have spaces
+    return int(stat.rpartition(")")[2].split()[19]), exe.st_dev, exe.st_ino
+
+
+class ProcessStarting(Exception):
+    "Raised with an uncached (exe, cmdline) whose cmdline isn't filled in yet"
+
+
+@functools.lru_cache(maxsize=256)
+def cached_process_info(pid, key):
+    """
+    exe and cmdline of pid while it has key. Failures and the empty cmdline of a
+    process that's still starting aren't cached
+    """
+    link = os.readlink("/proc/%d/exe" % pid)
+    with open("/proc/%d/cmdline" % pid) as f:
+        cmdline = f.read().split("\x00")
+    if not cmdline[0]:
+        raise ProcessStarting(link, cmdline)
+    return link, cmdline
+
+
+def process_info(pid):
+    "exe and cmdline of pid, cached so each op doesn't have to read them from /proc"
+    try:
+        # the key is read before cmdline, so a cmdline read mid-exec is cached
+        # under the old executable's key, which the next op won't match
+        return cached_process_info(pid, process_key(pid))
+    except ProcessStarting as e:
+        return e.args
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
 def get_caller():
     uid, gid, pid = fuse_get_context()
-    try:
-        link = os.readlink("/proc/%d/exe" % pid)
-        cmdline = open("/proc/%d/cmdline" % pid).read().split("\x00")
-    except OSError:
-        link = None
-        cmdline = None
-    return link, cmdline, uid, gid, pid
+    return (*process_info(pid), uid, gid, pid)
+
+
+class EventBatcher:
+    """
+    Puts events on queue in lists, once max_events have been collected
+    or max_delay seconds after the first one, whichever comes first
+    """
+
+    def __init__(self, queue, max_events=64, max_delay=0.1):
+        self.queue = queue
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.events = []
+        self.ready = threading.Condition()
+        # started on the first event, since FUSE daemonizing only keeps the main thread
+        self.thread = None
+
+    def put(self, event):
+        with self.ready:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.events.append(event)
+            if len(self.events) < self.max_events:
+                self.ready.notify()
+                return
+            batch, self.events = self.events, []
+        self.queue.put(batch)
+
+    def run(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.events)
+            time.sleep(self.max_delay)
+            with self.ready:
+                batch, self.events = self.events, []
+            if batch:
+                self.queue.put(batch)
 
 
 class LoggingMixIn:
+    """
+    Puts ["->", op, path, repr(args), exe, cmdline, uid, gid, pid] on self.logqueue
+    before each op in self.log_ops, or before every op if log_ops is None
+    """
+
     log = logging.getLogger("fuse.log-mixin")
+    log_ops = None
 
     def __call__(self, op, path, *args):
-        if hasattr(self, "logqueue") and self.logqueue:
-            self.logqueue.put(["->", op, path, repr(args), *get_caller()])
-        ret = "[Unhandled Exception]"
-        try:
-            ret = getattr(self, op)(path, *args)
-            return ret
-        except OSError as e:
-            ret = str(e)
-            raise
-        finally:
-            if hasattr(self, "logqueue") and self.logqueue:
-                self.logqueue.put(["<-", op, repr(ret)])
+        logqueue = getattr(self, "logqueue", None)
+        if logqueue and (self.log_ops is None or op in self.log_ops):
+            logqueue.put(["->", op, path, repr(args), *get_caller()])
+        return getattr(self, op)(path, *args)
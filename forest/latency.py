@@ -0,0 +1,92 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+In-memory latency digests, so admins get one summary per interval
+instead of one Signal message per command
+"""
+import random
+from typing import Optional
+
+
+class LatencySketch:
+    """Counts observations and keeps a bounded uniform sample of them
+    (reservoir sampling), which is enough to estimate percentiles"""
+
+    def __init__(self, size: int = 512) -> None:
+        self.size = size
+        self.count = 0
+        self.samples: list[float] = []
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+            return
+        # keep each of the `count` values seen so far with equal probability
+        index = random.randrange(self.count)
+        if index < self.size:
+            self.samples[index] = value
+
+    def quantile(self, q: float) -> float:
+        """Nearest-rank estimate of the q-th quantile (0 <= q <= 1)"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def describe(self) -> str:
+        p50, p95, p99 = (self.quantile(q) for q in (0.5, 0.95, 0.99))
+        return f"p50/p95/p99 {p50:.3f}/{p95:.3f}/{p99:.3f}s"
+
+
+class LatencyDigest:
+    """
+    Per-command python and roundtrip latency sketches for one reporting interval.
+    If alert_threshold is set, observe returns an alert the first time
+    a command's roundtrip p99 exceeds it during the interval.
+    """
+
+    def __init__(self, alert_threshold: float = 0.0, size: int = 512) -> None:
+        self.alert_threshold = alert_threshold
+        self.size = size
+        self.python: dict[str, LatencySketch] = {}
+        self.roundtrip: dict[str, LatencySketch] = {}
+        self.alerted: set[str] = set()
+
+    def observe(
+        self, command: str, roundtrip_delta: float, python_delta: Optional[float]
+    ) -> Optional[str]:
+        roundtrip = self.roundtrip.setdefault(command, LatencySketch(self.size))
+        roundtrip.add(roundtrip_delta)
+        if python_delta is not None:
+            self.python.setdefault(command, LatencySketch(self.size)).add(python_delta)
+        if (
+            self.alert_threshold
+            and command not in self.alerted
+            and roundtrip.quantile(0.99) > self.alert_threshold
+        ):
+            self.alerted.add(command)
+            return (
+                f"latency alert: {command} roundtrip p99 is "
+                f"{roundtrip.quantile(0.99):.3f}s (threshold {self.alert_threshold}s)"
+            )
+        return None
+
+    def summary(self) -> str:
+        lines = []
+        by_count = sorted(self.roundtrip.items(), key=lambda item: -item[1].count)
+        for command, roundtrip in by_count:
+            line = f"{command or '<none>'}: n={roundtrip.count}"
+            if command in self.python:
+                line += f", python {self.python[command].describe()}"
+            lines.append(line + f", roundtrip {roundtrip.describe()}")
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        self.python.clear()
+        self.roundtrip.clear()
+        self.alerted.clear()
+
+    def __bool__(self) -> bool:
+        return bool(self.roundtrip)
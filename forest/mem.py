@@ -10,15 +10,20 @@
 # THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import errno
+import itertools
 import logging
 import os
 import stat
 import sys
+import threading
 import time
 
-from forest.fuse import FUSE, FuseOSError, LoggingMixIn, Operations, get_caller
+from forest.fuse import FUSE, FuseOSError, LoggingMixIn, Operations, fuse_file_info
 
 BLOCK_SIZE = 4096
+# file contents are kept in extents of up to this many bytes.
+# FUSE reads at most 128k at a time, so aligned reads stay within one extent
+EXTENT_SIZE = 128 * 1024
 
 
 class Property(dict):
@@ -56,19 +61,231 @@ class File(object):
     def __init__(self, data, properties):
         self.data = data
         self.properties = properties
+        # held while changing data
+        self.lock = threading.Lock()
+
+
+class SharedLock(object):
+    "Held shared by each operation, and exclusively by snapshots"
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.sharers = 0
+        self.exclusive = False
+
+    def acquire_shared(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.exclusive)
+            self.sharers += 1
+
+    def release_shared(self):
+        with self.cond:
+            self.sharers -= 1
+            if not self.sharers:
+                self.cond.notify_all()
+
+    def __enter__(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.exclusive)
+            self.exclusive = True
+            self.cond.wait_for(lambda: not self.sharers)
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.exclusive = False
+            self.cond.notify_all()
+
+
+def split(path):
+    "(parent, name) of a normalized path"
+    parent, _, name = path.rpartition("/")
+    return parent or "/", name
+
+
+def normalize(path):
+    return path.rstrip("/") or "/"
+
+
+def exported(extent):
+    "Whether a memoryview of the bytearray extent is still alive"
+    # bytearrays can't be resized while they're exported, and appending usually
+    # fits in what's already allocated
+    try:
+        extent.append(0)
+    except BufferError:
+        return True
+    del extent[-1]
+    return False
+
+
+class Extents(object):
+    """
+    File contents as a sparse list of extents. Writes overwrite in place, holes
+    read as zeros, and reads within one extent are memoryview slices of it.
+    Each extent is only as long as the furthest byte written to it
+    """
+
+    def __init__(self):
+        self.extents = {}
+        self.size = 0
+        # bytes actually held in extents
+        self.allocated = 0
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return bytes(self.read(0, self.size))
+
+    def resize(self, index, extent, length):
+        "Grow or shrink an extent, copying it if a reader still has a view of it"
+        self.allocated += length - len(extent)
+        try:
+            if length > len(extent):
+                extent.extend(bytes(length - len(extent)))
+            else:
+                del extent[length:]
+        except BufferError:
+            extent = bytearray(extent[:length]) + bytes(max(0, length - len(extent)))
+            self.extents[index] = extent
+        return extent
+
+    def writable(self, index):
+        "The extent at index, if any, copied first if a reader still has a view of it"
+        extent = self.extents.get(index)
+        if extent is not None and exported(extent):
+            extent = self.extents[index] = bytearray(extent)
+        return extent
+
+    def write(self, offset, data):
+        index, start = divmod(offset, EXTENT_SIZE)
+        end = start + len(data)
+        extent = self.writable(index)
+        if extent is not None and end <= len(extent):
+            # overwriting bytes that are already there, the common case
+            extent[start:end] = data
+            return len(data)
+        if extent is not None and start == len(extent) and end <= EXTENT_SIZE:
+            # appending, the other common case
+            try:
+                extent += data
+            except BufferError:
+                pass
+            else:
+                self.allocated += len(data)
+                self.size = max(self.size, offset + len(data))
+                return len(data)
+        view = memoryview(data)
+        position = offset
+        while view:
+            index, start = divmod(position, EXTENT_SIZE)
+            count = min(EXTENT_SIZE - start, len(view))
+            extent = self.writable(index)
+            if extent is None:
+                extent = self.extents[index] = bytearray()
+            if len(extent) < start + count:
+                extent = self.resize(index, extent, start + count)
+            extent[start : start + count] = view[:count]
+            view = view[count:]
+            position += count
+        self.size = max(self.size, position)
+        return len(data)
+
+    def view(self, offset, size):
+        """
+        A memoryview of the bytes asked for if they're all in one extent, else None.
+        Take it under the file's lock; writes while the view is alive copy the
+        extent instead of changing what the view sees
+        """
+        end = min(offset + size, self.size)
+        index, start = divmod(offset, EXTENT_SIZE)
+        extent = self.extents.get(index)
+        if extent is None or offset >= end or (end - 1) // EXTENT_SIZE != index:
+            return None
+        if start + end - offset > len(extent):
+            return None
+        return memoryview(extent)[start : start + end - offset]
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b""
+        view = self.view(offset, size)
+        if view is not None:
+            return view
+        out = bytearray(end - offset)
+        for index in range(offset // EXTENT_SIZE, (end - 1) // EXTENT_SIZE + 1):
+            extent = self.extents.get(index)
+            if not extent:
+                continue
+            base = index * EXTENT_SIZE
+            lo, hi = max(offset, base), min(end, base + len(extent))
+            if lo < hi:
+                piece = memoryview(extent)[lo - base : hi - base]
+                out[lo - offset : hi - offset] = piece
+        return out
+
+    def growth(self, offset, size):
+        "How many more bytes writing size bytes at offset would allocate"
+        total = 0
+        position, end = offset, offset + size
+        while position < end:
+            index, start = divmod(position, EXTENT_SIZE)
+            count = min(EXTENT_SIZE - start, end - position)
+            extent = self.extents.get(index)
+            total += max(0, start + count - (len(extent) if extent is not None else 0))
+            position += count
+        return total
+
+    def truncate(self, length):
+        last = (length - 1) // EXTENT_SIZE if length else -1
+        for index in [index for index in self.extents if index > last]:
+            self.allocated -= len(self.extents.pop(index))
+        extent = self.writable(last)
+        if extent is not None and len(extent) > length - last * EXTENT_SIZE:
+            self.resize(last, extent, length - last * EXTENT_SIZE)
+        self.size = length
 
 
 class Memory(LoggingMixIn, Operations):
+    # write copies data into extents, so it can take a view of the kernel's buffer
+    zero_copy_writes = True
+
     def __unicode__(self):
         return str(self)
 
-    def __init__(self, livelock=None, logqueue=None) -> None:
+    def __init__(
+        self,
+        livelock=None,
+        logqueue=None,
+        on_init=None,
+        log_ops=None,
+        keep_cache=False,
+        direct_io=False,
+        quota=0,
+        usage_interval=5.0,
+    ) -> None:
         self.filesystem = {}
-        self.fd = 0
+        # next() on a count is atomic, so threads never get the same fd
+        self.fds = itertools.count(1)
         now = time.time()
         self.logqueue = logqueue
+        # ops to put on logqueue, or None for all of them
+        self.log_ops = log_ops
+        # set on each open file when mounted with raw_fi=True. nothing changes files
+        # behind the kernel's back, so it can keep their pages cached between opens
+        self.keep_cache = keep_cache
+        self.direct_io = direct_io
         self.livelock = livelock
-        self.filesystem["/"] = Directory(
+        # called once mounted, after FUSE has daemonized (which only keeps the main thread)
+        self.on_init = on_init
+        # held shared by each operation (libfuse may run several at once), and
+        # exclusively by snapshots, so they see the filesystem between operations
+        self.lock = SharedLock()
+        # held while adding, removing or listing files and directories.
+        # lookups are a single dict get, which doesn't need it
+        self.tree_lock = threading.RLock()
+        root = Directory(
             files={},
             directories={},
             properties=Property(
@@ -82,10 +299,58 @@ class Memory(LoggingMixIn, Operations):
                 st_uid=os.getuid(),
             ),
         )
+        self.filesystem["/"] = root
+        # every file and directory by path, so lookups don't walk the tree
+        self.index = {"/": root}
+        # bytes held in file extents, the most that's ever been held, and the
+        # most that can be (or 0 for no limit). writes past quota fail with ENOSPC
+        self.used = 0
+        self.peak = 0
+        self.quota = quota
+        self.usage_lock = threading.Lock()
+        # usage is put on logqueue as ["usage", used, peak, quota] at most this often
+        self.usage_interval = usage_interval
+        self.last_usage_report = 0.0
+
+    def __call__(self, op, path, *args):
+        self.lock.acquire_shared()
+        try:
+            return super().__call__(op, path, *args)
+        finally:
+            self.lock.release_shared()
+
+    def snapshot(self, paths):
+        """
+        Copy the files and directories under paths at a single point in time.
+        Returns (path, st_mode, mtime, contents) tuples, parents before children,
+        with None as the contents of directories
+        """
+        entries = []
+        with self.lock:
+            stack = list(reversed(paths))
+            while stack:
+                path = stack.pop()
+                fileobj = self.get_file(path)
+                if fileobj and stat.S_ISREG(fileobj.properties.st_mode):
+                    props = fileobj.properties
+                    entries.append(
+                        (path, props.st_mode, props.st_mtime, bytes(fileobj.data))
+                    )
+                    continue
+                dirobj = self.get_dir(path)
+                if not dirobj:
+                    continue
+                props = dirobj.properties
+                entries.append((path, props.st_mode, props.st_mtime, None))
+                children = sorted([*dirobj.directories, *dirobj.files], reverse=True)
+                stack.extend(f"{path}/{name}" for name in children)
+        return entries
 
     def init(self, path) -> None:
         if self.livelock is not None:
             self.livelock.release()
+        if self.on_init is not None:
+            self.on_init(self)
 
     def chmod(self, path, mode):
         item = self.get_file(path)
@@ -105,13 +370,65 @@ class Memory(LoggingMixIn, Operations):
             item.properties.st_gid = gid
         return 0
 
-    def create(self, path, mode):
-        filename = path.split("/")[-1]
-        dirname = "/".join(path.split("/")[:-1])
+    def add(self, path, item):
+        "Put item at path in its parent directory and the index. Hold tree_lock"
+        dirname, name = split(path)
+        dirobj = self.get_dir(dirname)
+        if isinstance(item, Directory):
+            dirobj.directories[name] = item
+        else:
+            dirobj.files[name] = item
+        self.index[path] = item
+        return dirobj
+
+    def remove(self, path, free=True):
+        """
+        Take whatever is at path out of its parent and the index, with its children,
+        no longer counting a file's extents as used if free. Hold tree_lock
+        """
+        dirname, name = split(path)
         dirobj = self.get_dir(dirname)
+        item = self.index.pop(path)
+        if isinstance(item, File):
+            dirobj.files.pop(name)
+            if free:
+                self.free_extents(item)
+            return item
+        dirobj.directories.pop(name)
+        if item.files or item.directories:
+            prefix = path + "/"
+            for child in [key for key in self.index if key.startswith(prefix)]:
+                if free:
+                    self.free_extents(self.index[child])
+                del self.index[child]
+        return item
+
+    def free_extents(self, item):
+        "Stop counting item's extents as used, if it's a file with any"
+        if isinstance(item, File) and isinstance(item.data, Extents):
+            with item.lock:
+                self.release(item.data.allocated)
+
+    def check_empty(self, path):
+        "Raise ENOTEMPTY if there's a directory with anything in it at path"
+        item = self.get_dir(path)
+        if item and (item.files or item.directories):
+            raise FuseOSError(errno.ENOTEMPTY)
+
+    def file_handle(self, fi):
+        "A new fh, set on fi along with our caching flags if FUSE passed one (raw_fi)"
+        fh = next(self.fds)
+        if not isinstance(fi, fuse_file_info):
+            return fh
+        fi.fh = fh
+        fi.keep_cache = int(self.keep_cache)
+        fi.direct_io = int(self.direct_io)
+        return 0
+
+    def create(self, path, mode, fi=None):
         now = time.time()
-        dirobj.files[filename] = File(
-            data=bytearray(),
+        file = File(
+            data=Extents(),
             properties=Property(
                 st_mode=stat.S_IFREG | mode,
                 st_nlink=1,
@@ -121,8 +438,9 @@ class Memory(LoggingMixIn, Operations):
                 st_atime=now,
             ),
         )
-        self.fd += 1
-        return self.fd
+        with self.tree_lock:
+            self.add(path, file)
+        return self.file_handle(fi)
 
     def getattr(self, path, fh=None):
         st = self.get_file(path)
@@ -150,12 +468,8 @@ class Memory(LoggingMixIn, Operations):
         return list(attrs.keys())
 
     def mkdir(self, path, mode):
-        path = path.rstrip("/")
-        newdir = path.split("/")[-1]
-        dirname = "/".join(path.split("/")[:-1])
-        dirobj = self.get_dir(dirname)
         now = time.time()
-        dirobj.directories[newdir] = Directory(
+        directory = Directory(
             files={},
             directories={},
             properties=Property(
@@ -167,21 +481,24 @@ class Memory(LoggingMixIn, Operations):
                 st_atime=now,
             ),
         )
-        dirobj.properties.st_nlink += 1
+        with self.tree_lock:
+            dirobj = self.add(normalize(path), directory)
+            dirobj.properties.st_nlink += 1
 
     def open(self, path, flags):
-        logging.debug("opening", get_caller())
-        self.fd += 1
-        return self.fd
+        # flags is the fuse_file_info with raw_fi
+        return self.file_handle(flags)
 
     def read(self, path, size, offset, fh):
         fileobj = self.get_file(path)
-        return bytes(fileobj.data[offset : (offset + size)])
+        # reads within an extent return a memoryview slice instead of a copy
+        with fileobj.lock:
+            return fileobj.data.read(offset, size)
 
     def readdir(self, path, fh):
         st = self.get_dir(path)
-        caller_info = get_caller()
-        return [".", ".."] + [x for x in st.files] + [x for x in st.directories]
+        with self.tree_lock:
+            return [".", ".."] + [x for x in st.files] + [x for x in st.directories]
 
     def readlink(self, path):
         st = self.get_file(path)
@@ -198,21 +515,35 @@ class Memory(LoggingMixIn, Operations):
             pass
 
     def rename(self, old, new):
-        oldname = old.split("/")[-1]
-        newname = new.split("/")[-1]
-        parentname = "/".join(old.split("/")[:-1])
-        parentobj = self.get_dir(parentname)
-        if self.get_file(old):
-            parentobj.files[newname] = parentobj.files.pop(oldname)
-        elif self.get_dir(old):
-            parentobj.directories[newname] = parentobj.directories.pop(oldname)
+        with self.tree_lock:
+            self.move(normalize(old), normalize(new))
+
+    def move(self, old, new):
+        "rename normalized paths. Hold tree_lock"
+        if old not in self.index:
+            raise FuseOSError(errno.ENOENT)
+        self.check_empty(new)
+        prefix = old + "/"
+        moved = {
+            new + key[len(old) :]: item
+            for key, item in self.index.items()
+            if key.startswith(prefix)
+        }
+        item = self.remove(old, free=False)
+        if new in self.index:
+            self.remove(new)
+        self.add(new, item)
+        self.index.update(moved)
+        if isinstance(item, Directory) and split(old)[0] != split(new)[0]:
+            self.get_dir(split(old)[0]).properties.st_nlink -= 1
+            self.get_dir(split(new)[0]).properties.st_nlink += 1
 
     def rmdir(self, path):
-        parentname = "/".join(path.split("/")[:-1])
-        parentobj = self.get_dir(parentname)
-        dirname = path.split("/")[-1]
-        parentobj.directories.pop(dirname)
-        parentobj.properties.st_nlink -= 1
+        path = normalize(path)
+        with self.tree_lock:
+            self.check_empty(path)
+            self.remove(path)
+            self.get_dir(split(path)[0]).properties.st_nlink -= 1
 
     def setxattr(self, path, name, value, options, position=0):
         st = self.get_file(path)
@@ -222,14 +553,25 @@ class Memory(LoggingMixIn, Operations):
         attrs[name] = value
 
     def statfs(self, path):
-        return dict(f_bsize=BLOCK_SIZE, f_blocks=4096, f_bavail=4096)
+        # without a quota, the limit is the machine's memory
+        ram = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        capacity = self.quota or ram
+        free = max(0, capacity - self.used) // BLOCK_SIZE
+        return dict(
+            f_bsize=BLOCK_SIZE,
+            f_frsize=BLOCK_SIZE,
+            f_blocks=capacity // BLOCK_SIZE,
+            f_bfree=free,
+            f_bavail=free,
+            f_files=len(self.index),
+            f_ffree=2**32,
+            f_favail=2**32,
+            f_namemax=255,
+        )
 
     def symlink(self, target, source):
-        targetname = target.split("/")[-1]
-        targetdir = "/".join(target.split("/")[:-1])
-        targetdirobj = self.get_dir(targetdir)
         now = time.time()
-        targetdirobj.files[targetname] = File(
+        link = File(
             data=source,
             properties=Property(
                 st_mode=stat.S_IFLNK,
@@ -238,21 +580,25 @@ class Memory(LoggingMixIn, Operations):
                 st_ctime=now,
                 st_mtime=now,
                 st_atime=now,
-                st_blocks=len(source) // BLOCK_SIZE,
+                st_blocks=-(-len(source) // 512),
             ),
         )
+        with self.tree_lock:
+            self.add(target, link)
 
     def truncate(self, path, length, fh=None):
         st = self.get_file(path)
-        st.data = st.data[:length]
-        st.properties.st_size = length
-        st.properties.st_blocks = length // BLOCK_SIZE
+        with st.lock:
+            allocated = st.data.allocated
+            st.data.truncate(length)
+            self.release(allocated - st.data.allocated)
+            self.update_size(st)
+        self.report_usage()
 
     def unlink(self, path):
-        dirname = "/".join(path.split("/")[:-1])
-        filename = path.split("/")[-1]
-        st = self.get_dir(dirname)
-        st.files.pop(filename)
+        with self.tree_lock:
+            self.remove(path)
+        self.report_usage()
 
     def utimens(self, path, times=None):
         now = time.time()
@@ -263,37 +609,47 @@ class Memory(LoggingMixIn, Operations):
 
     def write(self, path, data, offset, fh):
         st = self.get_file(path)
-        st.data[offset:] = data
-        st.properties.st_size = len(st.data)
-        st.properties.st_blocks = len(st.data) // BLOCK_SIZE
-        return len(data)
+        with st.lock:
+            self.reserve(st.data.growth(offset, len(data)))
+            written = st.data.write(offset, data)
+            self.update_size(st)
+        self.report_usage()
+        return written
+
+    def reserve(self, size):
+        "Count size more bytes as used, or raise ENOSPC if that would go over quota"
+        if not size:
+            return
+        with self.usage_lock:
+            if self.quota and self.used + size > self.quota:
+                raise FuseOSError(errno.ENOSPC)
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        with self.usage_lock:
+            self.used -= size
+
+    def report_usage(self):
+        "Put usage on logqueue if it's been usage_interval since we last did"
+        now = time.monotonic()
+        if not self.logqueue or now - self.last_usage_report < self.usage_interval:
+            return
+        self.last_usage_report = now
+        self.logqueue.put(["usage", self.used, self.peak, self.quota])
+
+    def update_size(self, st):
+        st.properties.st_size = st.data.size
+        # st_blocks counts 512-byte units actually allocated
+        st.properties.st_blocks = -(-st.data.allocated // 512)
 
     def get_file(self, path):
-        if path[-1] == "/":
-            return None
-        else:
-            patharray = path.split("/")
-            filename = patharray.pop()
-            dirname = "/".join(path.split("/")[:-1])
-            location = self.get_dir(dirname)
-            if location and filename in location.files:
-                return location.files[filename]
-            return None
+        item = self.index.get(path)
+        return item if isinstance(item, File) else None
 
     def get_dir(self, path):
-        path = path.rstrip("/")
-        patharray = path.split("/")
-        if len(patharray) <= 1:
-            return self.filesystem["/"]
-        patharray.pop(0)
-        location = self.filesystem["/"]
-        while patharray:
-            dirpath = patharray.pop(0)
-            if dirpath in location.directories:
-                location = location.directories[dirpath]
-            else:
-                return None
-        return location
+        item = self.index.get(normalize(path))
+        return item if isinstance(item, Directory) else None
 
 
 if __name__ == "__main__":
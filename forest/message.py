@@ -4,12 +4,15 @@ We're using this because you can have `{"attachments": null}` in JSON, which
 breaks our typing if we expect Message.attachments to be list[str].
 Using `or` like this is a bit of a hack, but it's what we've got.
 """
+import functools
 import shlex
 import unicodedata
 import json
 from typing import Optional
 
-from forest.utils import logging
+from forest.utils import get_sampled_logger, logging
+
+message_logger = get_sampled_logger("forest.messages")
 
 
 def unicode_character_name(i: int) -> str:
@@ -19,9 +22,14 @@ def unicode_character_name(i: int) -> str:
         return ""
 
 
-unicode_quotes = [
-    chr(i) for i in range(0, 0x10FFF) if "QUOTATION MARK" in unicode_character_name(i)
-]
+@functools.cache
+def unicode_quotes() -> list[str]:
+    "Scanning the unicode table takes tens of ms, so only do it when a message needs it"
+    return [
+        chr(i)
+        for i in range(0, 0x10FFF)
+        if "QUOTATION MARK" in unicode_character_name(i)
+    ]
 
 
 class Message:
@@ -62,7 +70,7 @@ class Message:
             except (json.JSONDecodeError, AssertionError):
                 # replace quote
                 clean_quote_text = self.text
-                for quote in unicode_quotes:
+                for quote in unicode_quotes():
                     clean_quote_text.replace(quote, "'")
                 arg0, *self.tokens = shlex.split(clean_quote_text)
         except ValueError:
@@ -146,7 +154,8 @@ class AuxinMessage(Message):
         else:
             self.payment = {}
         if self.text:
-            logging.info(self)  # "parsed a message with body: '%s'", self.text)
+            # lazily formats to_dict(), and only if the record isn't sampled out
+            message_logger.info("%s", self)
         super().__init__(blob)
 
 
@@ -176,5 +185,6 @@ class StdioMessage(Message):
         self.payment = msg.get("payment")
         # self.reactions: dict[str, str] = {}
         if self.text:
-            logging.info(self)  # "parsed a message with body: '%s'", self.text)
+            # lazily formats to_dict(), and only if the record isn't sampled out
+            message_logger.info("%s", self)
         super().__init__(blob)
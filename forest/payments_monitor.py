@@ -4,23 +4,33 @@
 
 import asyncio
 import base64
-import json
+import datetime
+import functools
 import logging
 import random
 import ssl
 import time
-from typing import Optional
+from typing import TYPE_CHECKING, Optional, Sequence
 
 import aiohttp
 import asyncpg
 
-import mc_util
-from forest import utils
-from forest.pghelp import Loop, PGExpressions, PGInterface
+from forest import codec, utils
+from forest.pghelp import Loop, PGExpressions, PGInterface, WriteBuffer
 
-if not utils.get_secret("ROOTCRT"):
-    ssl_context: Optional[ssl.SSLContext] = None
+if TYPE_CHECKING:
+    import mc_util
 else:
+    # protobufs are slow to load, so wait until the first payment
+    mc_util = utils.lazy_import("mc_util")
+
+
+@functools.cache
+def get_ssl_context() -> Optional[ssl.SSLContext]:
+    """Write full-service certificates and build an SSL context for them.
+    Done on the first full-service request rather than on import"""
+    if not utils.get_secret("ROOTCRT"):
+        return None
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
     root = open("rootcrt.pem", "wb")
     root.write(base64.b64decode(utils.get_secret("ROOTCRT")))
@@ -32,6 +42,7 @@ else:
     ssl_context.load_verify_locations("rootcrt.pem")
     ssl_context.verify_mode = ssl.CERT_REQUIRED
     ssl_context.load_cert_chain(certfile="client.full.pem")
+    return ssl_context
 
 
 DATABASE_URL = utils.get_secret("DATABASE_URL")
@@ -51,7 +62,17 @@ LedgerPGExpressions = PGExpressions(
         VALUES($1, $2, $3, $4, CURRENT_TIMESTAMP);",
     get_usd_balance="SELECT COALESCE(SUM(amount_usd_cents)/100, 0.0) AS balance \
         FROM {self.table} WHERE account=$1",
+    get_usd_balances="SELECT account, COALESCE(SUM(amount_usd_cents)/100, 0.0) AS balance \
+        FROM {self.table} WHERE account = ANY($1) GROUP BY account",
 )
+PMOB_TX_COLUMNS = ("account", "amount_usd_cents", "amount_pmob", "memo", "ts")
+
+
+def utc_now() -> datetime.datetime:
+    """The time in UTC, like CURRENT_TIMESTAMP on our UTC databases. ts is a TIMESTAMP
+    without time zone, which asyncpg only accepts naive datetimes for"""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
 
 InvoicePGEExpressions = PGExpressions(
     table="invoices",
@@ -63,6 +84,8 @@ InvoicePGEExpressions = PGExpressions(
         unique(unique_pmob))",
     create_invoice="INSERT INTO {self.table} (account, unique_pmob, memo) VALUES($1, $2, $3)",
     get_invoice_by_amount="SELECT invoice_id, account FROM {self.table} WHERE unique_pmob=$1",
+    get_invoices_by_amount="SELECT invoice_id, account, unique_pmob FROM {self.table} \
+        WHERE unique_pmob = ANY($1)",
 )
 
 
@@ -79,6 +102,30 @@ class LedgerManager(PGInterface):
         loop: Loop = None,
     ) -> None:
         super().__init__(queries, database, loop)
+        # payments arriving around the same time are written in one COPY
+        self.pmob_tx_buffer = WriteBuffer(self.put_pmob_txs)
+
+    async def put_pmob_txs(self, txs: Sequence[Sequence]) -> None:
+        """COPY (account, amount_usd_cents, amount_pmob, memo, ts) rows into the ledger"""
+        await self.copy_rows(PMOB_TX_COLUMNS, txs)
+
+    async def buffer_pmob_tx(  # pylint: disable=too-many-arguments
+        self,
+        account: str,
+        amount_usd_cents: int,
+        amount_pmob: int,
+        memo: Optional[str],
+        *,
+        wait: bool = True,
+    ) -> None:
+        """Like put_pmob_tx, but batched with other transactions. ts is when
+        this was called rather than when the batch is written. If wait, return
+        once the transaction is written"""
+        tx = (account, amount_usd_cents, amount_pmob, memo, utc_now())
+        if wait:
+            await self.pmob_tx_buffer.put(tx)
+        else:
+            self.pmob_tx_buffer.put_nowait(tx)
 
 
 class Mobster:
@@ -104,16 +151,16 @@ class Mobster:
 
     async def req(self, data: dict) -> dict:
         better_data = {"jsonrpc": "2.0", "id": 1, **data}
-        async with aiohttp.TCPConnector(ssl=ssl_context) as conn:
+        async with aiohttp.TCPConnector(ssl=get_ssl_context()) as conn:
             async with aiohttp.ClientSession(connector=conn) as sess:
                 # this can hang (forever?) if there's no full-service at that url
                 mob_req = sess.post(
                     self.url,
-                    data=json.dumps(better_data),
+                    data=codec.dumps(better_data),
                     headers={"Content-Type": "application/json"},
                 )
                 async with mob_req as resp:
-                    return await resp.json()
+                    return await resp.json(loads=codec.loads)
 
     rate_cache: tuple[int, Optional[float]] = (0, None)
 
@@ -125,13 +172,13 @@ class Mobster:
         try:
             url = "https://big.one/api/xn/v1/asset_pairs/8e900cb1-6331-4fe7-853c-d678ba136b2f"
             last_val = await aiohttp.ClientSession().get(url)
-            resp_json = await last_val.json()
+            resp_json = await last_val.json(loads=codec.loads)
             mob_rate = float(resp_json.get("data").get("ticker").get("close"))
         except (
             aiohttp.ClientError,
             KeyError,
             TypeError,
-            json.JSONDecodeError,
+            codec.JSONDecodeError,
         ) as e:
             logging.error(e)
             # big.one goes down sometimes, if it does... make up a price
@@ -368,6 +415,7 @@ class Mobster:
         account_id = await self.get_account()
         while True:
             latest_transactions = await self.get_transactions(account_id)
+            unobserved_txs = []
             for transaction in latest_transactions:
                 if transaction not in last_transactions:
                     unobserved_tx = latest_transactions.get(transaction, {})
@@ -379,20 +427,32 @@ class Mobster:
                             v = v[:16]
                         short_tx[k] = v
                     logging.info(short_tx)
-                    value_pmob = int(short_tx["value_pmob"])
-                    invoice = await self.invoice_manager.get_invoice_by_amount(
-                        value_pmob
-                    )
-                    if invoice:
-                        credit = await self.pmob2usd(value_pmob)
-                        # (account, amount_usd_cent, amount_pmob, memo)
-                        await self.ledger_manager.put_pmob_tx(
-                            invoice[0].get("account"),
-                            int(credit * 100),
-                            value_pmob,
-                            short_tx["transaction_log_id"],
-                        )
-                    # otherwise check if it's related to signal pay
-                    # otherwise, complain about this unsolicited payment to an admin or something
+                    unobserved_txs.append(short_tx)
+            await self.credit_invoices(unobserved_txs)
             last_transactions = latest_transactions.copy()
             await asyncio.sleep(10)
+
+    async def credit_invoices(self, txs: list[dict]) -> None:
+        "Look up every invoice txs pay in one query and credit them in one COPY"
+        amounts = [int(tx["value_pmob"]) for tx in txs]
+        invoices = {}
+        if amounts:
+            found = await self.invoice_manager.get_invoices_by_amount(amounts)
+            invoices = {invoice.get("unique_pmob"): invoice for invoice in found}
+        ledger_rows = []
+        for tx, value_pmob in zip(txs, amounts):
+            if value_pmob in invoices:
+                credit = await self.pmob2usd(value_pmob)
+                ledger_rows.append(
+                    (
+                        invoices[value_pmob].get("account"),
+                        int(credit * 100),
+                        value_pmob,
+                        tx["transaction_log_id"],
+                        utc_now(),
+                    )
+                )
+            # otherwise check if it's related to signal pay
+            # otherwise, complain about this unsolicited payment to an admin or something
+        if ledger_rows:
+            await self.ledger_manager.put_pmob_txs(ledger_rows)
@@ -5,7 +5,6 @@
 import asyncio
 import gzip
 import hashlib
-import json
 import os
 import time
 from typing import Union, Any, Optional, cast, List
@@ -14,6 +13,8 @@ import aiohttp
 import base58
 from Crypto.Cipher import AES, _mode_eax
 
+from forest import codec
+
 NAMESPACE = os.getenv("FLY_APP_NAME") or open("/etc/hostname").read().strip()
 SALT = os.getenv("SALT", "ECmG8HtNNMWb4o2bzyMqCmPA6KTYJPCkd")
 # build your AESKEY envvar with this: cat /dev/urandom | head -c 32 | base58
@@ -115,7 +116,7 @@ class fastpKVStoreClient:
             async with self.conn.patch(
                 f"{self.url}?key_=eq.{key}&namespace=eq.{self.namespace}",
                 headers=self.headers,
-                data=json.dumps(
+                data=codec.dumps(
                     dict(
                         value=data,
                         updated_at=time.time(),
@@ -123,11 +124,11 @@ class fastpKVStoreClient:
                     )
                 ),
             ) as resp:
-                return await resp.json()
+                return await resp.json(loads=codec.loads)
         async with self.conn.post(
             f"{self.url}",
             headers=self.headers,
-            data=json.dumps(
+            data=codec.dumps(
                 dict(
                     key_=key,
                     value=data,
@@ -144,7 +145,7 @@ class fastpKVStoreClient:
                 async with self.conn.patch(
                     f"{self.url}?key_=eq.{key}&namespace=eq.{self.namespace}",
                     headers=self.headers,
-                    data=json.dumps(
+                    data=codec.dumps(
                         dict(
                             value=data,
                             updated_at=time.time(),
@@ -152,8 +153,8 @@ class fastpKVStoreClient:
                         )
                     ),
                 ) as resp:
-                    return await resp.json()
-            return json.loads(resp_text)
+                    return await resp.json(loads=codec.loads)
+            return codec.loads(resp_text)
 
     async def get(self, key: str) -> str:
         """Get and return value of an object with the specified key and namespace"""
@@ -222,7 +223,7 @@ class aPersistDict:
             key = f"Persist_{self.tag}_{NAMESPACE}"
             result = await self.client.get(key)
             if result:
-                self.dict_ = json.loads(result)
+                self.dict_ = codec.loads(result)
             self.dict_.update(**kwargs)
 
     async def get(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
@@ -291,7 +292,7 @@ class aPersistDict:
         elif key and value is None and key in self.dict_:
             self.dict_.pop(key)
         key = f"Persist_{self.tag}_{NAMESPACE}"
-        value = json.dumps(self.dict_)
+        value = codec.dumps(self.dict_)
         return await self.client.post(key, value)
 
     async def set(self, key: str, value: Any) -> Any:
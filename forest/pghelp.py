@@ -6,8 +6,23 @@ import asyncio
 import copy
 import logging
 import os
+import time
+import weakref
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from typing import Any, AsyncGenerator, Callable, Optional, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    Sequence,
+    Union,
+)
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Gauge, Histogram
 
 try:
     import asyncpg
@@ -24,6 +39,55 @@ Loop = Optional[asyncio.events.AbstractEventLoop]
 AUTOCREATE = "true" in os.getenv("AUTOCREATE_TABLES", "false").lower()
 MAX_RESP_LOG_LEN = int(os.getenv("MAX_RESP_LOG_LEN", "256"))
 LOG_LEVEL_DEBUG = bool(os.getenv("DEBUG", None))
+# every interface on the same DATABASE_URL shares one pool of this size
+POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+# idle connections are closed after this many seconds, and connections are
+# replaced after this many queries
+POOL_MAX_IDLE = float(os.getenv("PG_POOL_MAX_IDLE", "300"))
+POOL_MAX_QUERIES = int(os.getenv("PG_POOL_MAX_QUERIES", "50000"))
+STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+# WriteBuffers write once this many rows are queued, or this many seconds after
+# the first one
+WRITE_BATCH_ROWS = int(os.getenv("PG_WRITE_BATCH_ROWS", "500"))
+WRITE_BATCH_DELAY = float(os.getenv("PG_WRITE_BATCH_DELAY", "0.05"))
+TIMEOUT = 180
+# results of cacheable expressions kept in process, across all interfaces
+QUERY_CACHE_SIZE = int(os.getenv("PG_CACHE_SIZE", "1024"))
+# tell other processes which cached reads a write invalidated, and listen for theirs
+QUERY_CACHE_NOTIFY = "true" in os.getenv("PG_CACHE_NOTIFY", "false").lower()
+CACHE_CHANNEL = "pghelp_cache_invalidate"
+# queries slower than this are logged with their arguments redacted and kept in
+# slow_queries. with PG_SLOW_QUERY_EXPLAIN, their EXPLAIN (ANALYZE, BUFFERS) plan
+# is recorded too, at most once per expression per EXPLAIN_INTERVAL seconds.
+# plans can include argument values, so they're only kept there, never logged
+SLOW_QUERY_SECONDS = float(os.getenv("PG_SLOW_QUERY_MS", "500")) / 1000
+SLOW_QUERY_EXPLAIN = "true" in os.getenv("PG_SLOW_QUERY_EXPLAIN", "false").lower()
+EXPLAIN_INTERVAL = 600
+
+pool_connections = Gauge(
+    "pg_pool_connections", "open connections in the pool", ["pool"]
+)
+pool_idle = Gauge("pg_pool_idle_connections", "idle connections in the pool", ["pool"])
+pool_max = Gauge(
+    "pg_pool_max_connections", "most connections the pool will open", ["pool"]
+)
+pool_waiting = Gauge("pg_pool_waiting", "callers waiting for a connection", ["pool"])
+acquire_histogram = Histogram(
+    "pg_pool_acquire_seconds", "Time waiting for a pooled connection", ["pool"]
+)
+query_histogram = Histogram(
+    "pg_query_seconds",
+    "Time running each expression, once a connection was acquired",
+    ["table", "query"],
+)
+slow_query_counter = Counter(
+    "pg_slow_queries", "queries slower than PG_SLOW_QUERY_MS", ["table", "query"]
+)
+cache_hits = Counter("pg_cache_hits", "cacheable queries served from cache", ["query"])
+cache_misses = Counter(
+    "pg_cache_misses", "cacheable queries sent to postgres", ["query"]
+)
 
 
 def get_logger(name: str) -> logging.Logger:
@@ -38,15 +102,165 @@ def get_logger(name: str) -> logging.Logger:
     return logger
 
 
-pools: list[asyncpg.Pool] = []
+pools: dict[str, asyncpg.Pool] = {}
+pending_pools: dict[str, asyncio.Future] = {}
+pool_names: dict[asyncpg.Pool, str] = {}
+
+
+def pool_name(database: str) -> str:
+    "metrics label for a DSN, without the credentials"
+    url = urlsplit(database)
+    return f"{url.hostname or ''}{url.path}" or "default"
+
+
+async def create_pool(database: str) -> asyncpg.Pool:
+    try:
+        pool = await asyncpg.create_pool(
+            database,
+            min_size=min(POOL_MIN_SIZE, POOL_MAX_SIZE),
+            max_size=POOL_MAX_SIZE,
+            max_queries=POOL_MAX_QUERIES,
+            max_inactive_connection_lifetime=POOL_MAX_IDLE,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+        )
+    finally:
+        pending_pools.pop(database, None)
+    pools[database] = pool
+    name = pool_names[pool] = pool_name(database)
+    pool_connections.labels(name).set_function(pool.get_size)
+    pool_idle.labels(name).set_function(pool.get_idle_size)
+    pool_max.labels(name).set(POOL_MAX_SIZE)
+    return pool
+
+
+async def get_pool(database: str) -> asyncpg.Pool:
+    """The process-wide pool for database, created by whoever asks first"""
+    if database in pools:
+        return pools[database]
+    if database not in pending_pools:
+        pending_pools[database] = asyncio.ensure_future(create_pool(database))
+    return await asyncio.shield(pending_pools[database])
+
+
+@asynccontextmanager
+async def acquire(pool: asyncpg.Pool) -> AsyncGenerator:
+    """pool.acquire, recording how long we waited for the connection"""
+    name = pool_names.get(pool, "default")
+    pool_waiting.labels(name).inc()
+    start = time.time()
+    try:
+        connection = await pool.acquire()
+    finally:
+        pool_waiting.labels(name).dec()
+    acquire_histogram.labels(name).observe(time.time() - start)
+    try:
+        yield connection
+    finally:
+        await pool.release(connection)
+
+
+async def close_pool(database: str) -> None:
+    pool = pools.pop(database, None)
+    if not pool:
+        return
+    name = pool_names.pop(pool)
+    for gauge in (pool_connections, pool_idle, pool_max, pool_waiting):
+        try:
+            gauge.remove(name)
+        except KeyError:
+            pass
+    try:
+        await pool.close()
+    except (asyncpg.PostgresError, asyncpg.InternalClientError) as e:
+        logging.error(e)
 
 
 async def close_pools() -> None:
-    for pool in pools:
+    """Write out buffered rows, stop listening for cache invalidations, then close
+    every pool. This is the one place pools are shut down"""
+    for buffer in list(buffers):
+        await buffer.close()
+    for listener in invalidation_listeners.values():
+        listener.cancel()
+    invalidation_listeners.clear()
+    for task in explains:
+        task.cancel()
+    for database in list(pools):
+        await close_pool(database)
+
+
+class WriteBuffer:
+    """
+    Collects rows from many writers and passes them to write in one list, once
+    max_rows are queued or max_delay seconds after the first one, whichever
+    comes first. Writers that need the row to be written await put, which returns
+    once its batch is; others use put_nowait
+    """
+
+    def __init__(
+        self,
+        write: Callable[[list[Sequence]], Awaitable[Any]],
+        max_rows: int = WRITE_BATCH_ROWS,
+        max_delay: float = WRITE_BATCH_DELAY,
+    ) -> None:
+        self.write = write
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows: list[Sequence] = []
+        # done when the rows currently queued are written
+        self.written: Optional[asyncio.Future] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flushes: set[asyncio.Task] = set()
+        buffers.add(self)
+
+    def put_nowait(self, row: Sequence) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if not self.rows:
+            self.written = loop.create_future()
+            self.timer = loop.call_later(self.max_delay, self.start_flush)
+        self.rows.append(row)
+        assert self.written
+        written = self.written
+        if len(self.rows) >= self.max_rows:
+            self.start_flush()
+        return written
+
+    async def put(self, row: Sequence) -> None:
+        await asyncio.shield(self.put_nowait(row))
+
+    def start_flush(self) -> None:
+        """Take the queued rows and write them in the background"""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        rows, written = self.rows, self.written
+        self.rows, self.written = [], None
+        if not rows or not written:
+            return
+        task = asyncio.create_task(self.write_batch(rows, written))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def write_batch(self, rows: list[Sequence], written: asyncio.Future) -> None:
         try:
-            await pool.close()
-        except (asyncpg.PostgresError, asyncpg.InternalClientError) as e:
-            logging.error(e)
+            await self.write(rows)
+        except Exception as e:  # pylint: disable=broad-except
+            # whatever went wrong, writers awaiting put need to hear about it
+            logging.error(f"failed to write {len(rows)} buffered rows: {e}")
+            written.set_exception(e)
+            # put_nowait callers don't look at it, and it was logged just now
+            written.exception()
+        else:
+            written.set_result(len(rows))
+
+    async def close(self) -> None:
+        self.start_flush()
+        if self.flushes:
+            await asyncio.wait(self.flushes)
+
+
+# for close_pools to flush. a buffer with rows queued is kept alive by its timer
+buffers: "weakref.WeakSet[WriteBuffer]" = weakref.WeakSet()
 
 
 class SimpleInterface:
@@ -57,15 +271,127 @@ class SimpleInterface:
     @asynccontextmanager
     async def get_connection(self) -> AsyncGenerator:
         if not self.pool:
-            self.pool = await asyncpg.create_pool(self.database)
-            pools.append(self.pool)
-        async with self.pool.acquire() as conn:
+            self.pool = await get_pool(self.database)
+        async with acquire(self.pool) as conn:
             yield conn
 
 
+class QueryCache:
+    """
+    Results of cacheable expressions, keyed by (database, table, expression, args),
+    evicting the least recently used past max_size
+    """
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple, tuple[float, Any]] = OrderedDict()
+        # bumped on every invalidation, so reads that were in flight don't put
+        # results from before the write
+        self.generations: dict[str, int] = {}
+
+    def get(self, key: tuple) -> Any:
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def generation(self, database: str) -> int:
+        return self.generations.get(database, 0)
+
+    def put(self, key: tuple, value: Any, ttl: float, generation: int) -> None:
+        if generation != self.generation(key[0]):
+            return
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(
+        self,
+        database: str,
+        table: Optional[str] = None,
+        names: Optional[Sequence[str]] = None,
+    ) -> None:
+        """Drop the cached results of names in table, or all of table's, or all
+        of database's"""
+        self.generations[database] = self.generation(database) + 1
+        stale = [
+            key
+            for key in self.entries
+            if key[0] == database
+            and (table is None or key[1] == table)
+            and (names is None or key[2] in names)
+        ]
+        for key in stale:
+            del self.entries[key]
+
+
+query_cache = QueryCache()
+invalidation_listeners: dict[str, asyncio.Task] = {}
+
+
+async def listen_for_invalidations(database: str) -> None:
+    """Drop the cached reads that other processes' writes invalidate, for as long
+    as the process runs. Uses its own connection rather than holding one from
+    the pool"""
+
+    def invalidate(_: Any, __: int, ___: str, payload: str) -> None:
+        table, *names = payload.split()
+        query_cache.invalidate(database, table, names)
+
+    while True:
+        try:
+            connection = await asyncpg.connect(database)
+            try:
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+                await connection.add_listener(CACHE_CHANNEL, invalidate)
+                # anything could have changed while we weren't listening
+                query_cache.invalidate(database)
+                await lost.wait()
+            finally:
+                await connection.close()
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            logging.warning(f"lost cache invalidation listener: {e}")
+        await asyncio.sleep(5)
+
+
+slow_queries: deque[dict] = deque(maxlen=100)
+explains: set[asyncio.Task] = set()
+last_explained: dict[tuple[str, str], float] = {}
+
+
+def redact(args: Sequence) -> str:
+    "argument types and sizes, without their values"
+    redacted = []
+    for arg in args:
+        kind = type(arg).__name__
+        redacted.append(f"{kind}({len(arg)})" if hasattr(arg, "__len__") else kind)
+    return ", ".join(redacted)
+
+
 class PGExpressions(dict):
-    def __init__(self, table: str = "", **kwargs: str) -> None:
+    """
+    Named SQL statements for a table. Reads listed in cache_ttl are cached for that
+    many seconds, and writes listed in invalidates drop the cached results of the
+    named reads, e.g. cache_ttl={"get_id": 60}, invalidates={"set_id": ["get_id"]}
+    """
+
+    def __init__(
+        self,
+        table: str = "",
+        cache_ttl: Optional[dict[str, float]] = None,
+        invalidates: Optional[dict[str, Sequence[str]]] = None,
+        **kwargs: str,
+    ) -> None:
         self.table = table
+        self.cache_ttl = cache_ttl or {}
+        self.invalidates = invalidates or {}
         self.logger = get_logger(f"{self.table}_expressions")
         super().__init__(**kwargs)
         if "exists" not in self:
@@ -87,7 +413,10 @@ class PGInterface:
     - and an optional event loop"""
 
     def __init__(
-        self, query_strings: PGExpressions, database: str = "", loop: Loop = None
+        self,
+        query_strings: PGExpressions,
+        database: Union[str, dict] = "",
+        loop: Loop = None,
     ) -> None:
         """Accepts a PGExpressions argument containing postgresql expressions, a database string, and an optional event loop."""
 
@@ -99,12 +428,13 @@ class PGInterface:
         self.table = self.queries.table
         self.MAX_RESP_LOG_LEN = MAX_RESP_LOG_LEN
         # self.loop.create_task(self.connect_pg())
-        self.pool = None
+        self.pool: Optional[asyncpg.Pool] = None
         if isinstance(database, dict):
             self.invocations: list[dict] = []
         self.logger = get_logger(
             f'{self.table}{"_fake" if not self.pool else ""}_interface'
         )
+        self.compile_queries()
 
     def finish_init(self) -> None:
         """Optionally triggers creating tables and checks existence."""
@@ -121,50 +451,176 @@ class PGInterface:
         for k in self.queries:
             if AUTOCREATE and "create" in k and "index" in k:
                 self.logger.info(f"creating index via {k}")
-                self.__getattribute__(f"sync_{k}")()
+                getattr(self, f"sync_{k}")()
 
     async def connect_pg(self) -> None:
-        self.pool = await asyncpg.create_pool(self.database)
-        pools.append(self.pool)
+        if isinstance(self.database, str):
+            self.pool = await get_pool(self.database)
 
     async def execute(
         self,
         qstring: str,
-        *args: str,
+        *args: Any,
+        name: str = "execute",
     ) -> Optional[list[asyncpg.Record]]:
-        """Invoke the asyncpg connection's `execute` given a provided query string and set of arguments"""
-        timeout: int = 180
+        """Fetch the rows for a provided query string and set of arguments on a pooled
+        connection, timed as name"""
         if not self.pool and not isinstance(self.database, dict):
             await self.connect_pg()
         if self.pool:
-            async with self.pool.acquire() as connection:
-                # try:
-                # except asyncpg.TooManyConnectionsError:
-                # await connection.execute(
-                #     """SELECT pg_terminate_backend(pg_stat_activity.pid)
-                #     FROM pg_stat_activity
-                #     WHERE pg_stat_activity.datname = 'postgres'
-                #     AND pid <> pg_backend_pid();"""
-                # )
-                # return self.execute(qstring, *args, timeout=timeout)
-                # _execute takes query, args, limit, timeout
-                result = await connection._execute(
-                    qstring, args, 0, timeout, return_status=True
-                )
-                # list[asyncpg.Record], str, bool
-                return result[0]
+            async with self.timed_connection(name, qstring, args) as connection:
+                # fetch goes through the connection's statement cache, so repeated
+                # statements are prepared once per connection
+                return await connection.fetch(qstring, *args, timeout=TIMEOUT)
         return None
 
+    @asynccontextmanager
+    async def timed_connection(
+        self, name: str, statement: str, args: Sequence = (), explainable: bool = True
+    ) -> AsyncGenerator:
+        """A pooled connection. What the block does with it is timed as name,
+        separately from waiting for the connection, and recorded if it's slow,
+        whether it succeeds or fails"""
+        if not self.pool:
+            await self.connect_pg()
+        assert self.pool
+        requested = time.time()
+        async with acquire(self.pool) as connection:
+            start = time.time()
+            waited = start - requested
+            failed = True
+            try:
+                yield connection
+                failed = False
+            finally:
+                elapsed = time.time() - start
+                query_histogram.labels(self.table, name).observe(elapsed)
+                if elapsed > SLOW_QUERY_SECONDS:
+                    self.record_slow_query(
+                        name, statement, args, elapsed, waited, failed, explainable
+                    )
+
+    def record_slow_query(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        name: str,
+        statement: str,
+        args: Sequence,
+        elapsed: float,
+        waited: float,
+        failed: bool,
+        explainable: bool,
+    ) -> None:
+        "Log and keep a slow query. Failed ones aren't explained, which would rerun them"
+        slow_query_counter.labels(self.table, name).inc()
+        record = {
+            "table": self.table,
+            "query": name,
+            "ms": round(elapsed * 1000),
+            "acquire_ms": round(waited * 1000),
+            "args": redact(args),
+            "failed": failed,
+            "plan": None,
+        }
+        slow_queries.append(record)
+        self.logger.warning(
+            f"slow {'failed ' if failed else ''}query {name}: {record['ms']}ms "
+            f"(after {record['acquire_ms']}ms waiting for a connection) "
+            f"with ({record['args']})"
+        )
+        explain_ok = statement.split(maxsplit=1)[0].lower() in (
+            "select",
+            "insert",
+            "update",
+            "delete",
+            "with",
+        )
+        key = (self.table, name)
+        due = time.time() - last_explained.get(key, 0) > EXPLAIN_INTERVAL
+        if SLOW_QUERY_EXPLAIN and explainable and not failed and explain_ok and due:
+            last_explained[key] = time.time()
+            task = asyncio.create_task(self.explain(statement, args, record))
+            explains.add(task)
+            task.add_done_callback(explains.discard)
+
+    async def explain(self, statement: str, args: Sequence, record: dict) -> None:
+        """Record the plan for a slow query in record, in a transaction that's
+        rolled back, since ANALYZE runs the statement"""
+        assert self.pool
+        try:
+            async with acquire(self.pool) as connection:
+                transaction = connection.transaction()
+                await transaction.start()
+                try:
+                    rows = await connection.fetch(
+                        f"EXPLAIN (ANALYZE, BUFFERS) {statement}",
+                        *args,
+                        timeout=TIMEOUT,
+                    )
+                finally:
+                    await transaction.rollback()
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            self.logger.warning(f"couldn't explain {record['query']}: {e}")
+            return
+        record["plan"] = "\n".join(row[0] for row in rows)
+        self.logger.debug(f"recorded the plan for slow query {record['query']}")
+
+    async def execute_batch(self, name: str, rows: Iterable[Sequence]) -> None:
+        """Run the statement called name once for each row of arguments, in one
+        round trip"""
+        if isinstance(self.database, dict):
+            for row in rows:
+                getattr(self, name)(*row)
+            return
+        statement = self.queries.get_query(name)
+        rows = list(rows)
+        async with self.timed_connection(name, statement, [rows], False) as connection:
+            await connection.executemany(statement, rows, timeout=TIMEOUT)
+        if name in self.queries.invalidates:
+            await self.invalidate(self.queries.invalidates[name])
+
+    async def copy_rows(self, columns: Sequence[str], rows: Iterable[Sequence]) -> None:
+        """Bulk insert rows of columns into self.table with COPY"""
+        if isinstance(self.database, dict):
+            self.invocations.append({"copy_rows": ((columns, list(rows)), {})})
+            return
+        rows = list(rows)
+        async with self.timed_connection(
+            "copy_rows", "COPY", [rows], False
+        ) as connection:
+            await connection.copy_records_to_table(
+                self.table, records=rows, columns=list(columns), timeout=TIMEOUT
+            )
+
+    @asynccontextmanager
+    async def listen(
+        self, channel: str, callback: Callable[[Any, int, str, str], None]
+    ) -> AsyncGenerator:
+        """Hold a connection that LISTENs on channel for the duration of the block,
+        calling callback(connection, pid, channel, payload) for each notification"""
+        if not self.pool and not isinstance(self.database, dict):
+            await self.connect_pg()
+        if not self.pool:
+            yield
+            return
+        async with acquire(self.pool) as connection:
+            await connection.add_listener(channel, callback)
+            try:
+                yield
+            finally:
+                await connection.remove_listener(channel, callback)
+
     def sync_execute(self, qstring: str, *args: Any) -> asyncpg.Record:
         """Synchronous wrapper for `self.execute`"""
         ret = self.loop.run_until_complete(self.execute(qstring, *args))
         return ret
 
     def sync_close(self) -> Any:
+        """Close the pool this interface uses, which is shared with every other
+        interface on the same database"""
         self.logger.info(f"closing connection: {self.pool}")
-        if self.pool:
-            ret = self.loop.run_until_complete(self.pool.close())
-            return ret
+        if self.pool and isinstance(self.database, str):
+            self.pool = None
+            return self.loop.run_until_complete(close_pool(self.database))
         return None
 
     def truncate(self, thing: str) -> str:
@@ -176,70 +632,119 @@ class PGInterface:
             )
         return thing
 
-    def __getattribute__(self, key: str) -> Callable[..., asyncpg.Record]:
-        """Implicitly define methods on this class for every statement in self.query_strings.
-        If method is prefaced with "sync_": wrap as a synchronous function call.
-        If statement in self.query_strings looks like an f-string, treat it
-        as such by evaling before passing to `executer`."""
-        try:
-            return object.__getattribute__(self, key)
-        except AttributeError:
-            pass
-        if key.startswith(
-            "sync_"
-        ):  # sync_ prefix implicitly wraps query as synchronous
-            qstring = key.replace("sync_", "")
-            executer = self.sync_execute
-        else:
-            executer = self.execute
-            qstring = key
-        try:
-            statement = self.queries.get_query(qstring)
-        except KeyError as e:
-            raise ValueError(f"No statement of name {qstring} or {key} found!") from e
-        if not self.pool and isinstance(self.database, dict):
-            canned_response = self.database.get(qstring, [[None]]).pop(0)
-            if qstring in self.database and not self.database.get(qstring, []):
-                self.database.pop(qstring)
-
-            def return_canned(*args: Any, **kwargs: Any) -> Any:
-                self.invocations.append({qstring: (args, kwargs)})
-                if callable(canned_response):
-                    resp = canned_response(*args, **kwargs)
-                else:
-                    resp = canned_response
-                short_strresp = self.truncate(f"{resp}")
-                self.logger.info(
-                    f"returning `{short_strresp}` for expression: "
-                    f"`{qstring}` eval'd with `{args}` & `{kwargs}`"
-                )
-                return resp
-
-            return return_canned
-        if "$1" in statement or "{" in statement and "}" in statement:
-
-            def executer_with_args(*args: Any) -> Any:
-                """Closure over 'statement' in local state for application to arguments.
-                Allows deferred execution of f-strs, allowing PGExpresssions to operate on `args`."""
-                rebuilt_statement = eval(f'f"{statement}"')  # pylint: disable=eval-used
-                if (
-                    rebuilt_statement != statement
-                    and "args" in statement
-                    and "$1" not in statement
-                ):
-                    args = ()
-                resp = executer(rebuilt_statement, *args)
+    def compile_queries(self) -> None:
+        """Bind a coroutine method and a sync_ wrapper for every statement in
+        self.queries, so calls don't rebuild anything"""
+        for name in self.queries:
+            if not hasattr(type(self), name):
+                self.__dict__[name] = self.compile_query(name)
+            if not hasattr(type(self), f"sync_{name}"):
+                self.__dict__[f"sync_{name}"] = self.compile_sync_query(name)
+
+    def compile_query(self, name: str) -> Callable[..., Any]:
+        """Render the statement once. Queries go through the connection's
+        statement cache, so each connection prepares a statement once and reuses it"""
+        statement = self.queries.get_query(name)
+        if isinstance(self.database, dict):
+            return self.compile_canned(name)
+        if name in self.queries.cache_ttl:
+            return self.compile_cached_query(name, statement)
+        invalidated = self.queries.invalidates.get(name)
+
+        async def query(*args: Any) -> Optional[list[asyncpg.Record]]:
+            resp = await self.execute(statement, *args, name=name)
+            if invalidated:
+                await self.invalidate(invalidated)
+            if LOG_LEVEL_DEBUG:
                 short_strresp = self.truncate(f"{resp}")
                 short_args = self.truncate(str(args))
-                self.logger.debug(
-                    f"{rebuilt_statement} {short_args} -> {short_strresp}"
-                )
+                self.logger.debug(f"{name} {short_args} -> {short_strresp}")
+            return resp
+
+        query.__name__ = query.__qualname__ = name
+        return query
+
+    def compile_cached_query(self, name: str, statement: str) -> Callable[..., Any]:
+        """Serve repeated reads from query_cache for up to the expression's TTL"""
+        assert isinstance(self.database, str)
+        database, ttl = self.database, self.queries.cache_ttl[name]
+        hits, misses = cache_hits.labels(name), cache_misses.labels(name)
+
+        async def cached_query(*args: Any) -> Optional[list[asyncpg.Record]]:
+            key = (database, self.table, name, args)
+            resp = query_cache.get(key)
+            if resp is not None:
+                hits.inc()
                 return resp
+            misses.inc()
+            if QUERY_CACHE_NOTIFY and database not in invalidation_listeners:
+                invalidation_listeners[database] = asyncio.create_task(
+                    listen_for_invalidations(database)
+                )
+            generation = query_cache.generation(database)
+            resp = await self.execute(statement, *args, name=name)
+            if resp is not None:
+                query_cache.put(key, resp, ttl, generation)
+            return resp
+
+        cached_query.__name__ = cached_query.__qualname__ = name
+        return cached_query
+
+    async def invalidate(self, names: Sequence[str]) -> None:
+        """Drop cached results of the reads called names, here and, if
+        PG_CACHE_NOTIFY is set, in every other process"""
+        if not isinstance(self.database, str):
+            return
+        query_cache.invalidate(self.database, self.table, names)
+        if QUERY_CACHE_NOTIFY:
+            payload = " ".join([self.table, *names])
+            await self.execute(
+                "SELECT pg_notify($1, $2)", CACHE_CHANNEL, payload, name="cache_notify"
+            )
 
-            return executer_with_args
-
-        def executer_without_args() -> Any:
-            """Closure over local state for executer without arguments."""
-            return executer(statement)
-
-        return executer_without_args
+    def compile_sync_query(self, name: str) -> Callable[..., Any]:
+        query = self.__dict__.get(name) or self.compile_query(name)
+        if isinstance(self.database, dict):
+            return query
+
+        def sync_query(*args: Any) -> Any:
+            return self.loop.run_until_complete(query(*args))
+
+        sync_query.__name__ = sync_query.__qualname__ = f"sync_{name}"
+        return sync_query
+
+    def compile_canned(self, name: str) -> Callable[..., Any]:
+        """In fake mode, return the next canned response for name on each call"""
+        assert isinstance(self.database, dict)
+        database = self.database
+
+        def return_canned(*args: Any, **kwargs: Any) -> Any:
+            canned_response = database.get(name, [[None]]).pop(0)
+            if name in database and not database.get(name, []):
+                database.pop(name)
+            self.invocations.append({name: (args, kwargs)})
+            if callable(canned_response):
+                resp = canned_response(*args, **kwargs)
+            else:
+                resp = canned_response
+            short_strresp = self.truncate(f"{resp}")
+            self.logger.info(
+                f"returning `{short_strresp}` for expression: "
+                f"`{name}` eval'd with `{args}` & `{kwargs}`"
+            )
+            return resp
+
+        return return_canned
+
+    def __getattr__(self, key: str) -> Callable[..., asyncpg.Record]:
+        """Only reached for statements added to self.queries after construction;
+        compile and keep them like the rest"""
+        name = key.removeprefix("sync_")
+        if key.startswith("__") or name not in self.__dict__.get("queries", {}):
+            raise AttributeError(f"No statement of name {name} or {key} found!")
+        if key.startswith("sync_"):
+            method = self.compile_sync_query(name)
+        else:
+            method = self.compile_query(name)
+        self.__dict__[key] = method
+        return method
@@ -0,0 +1,76 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Per-user token buckets, so one user (or an echo bot we're stuck in a loop with)
+can't monopolize handlers, full-service and our outgoing rate limit
+"""
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+
+
+class Throttle:
+    """
+    Each identity gets `burst` messages, refilled at `rate` messages per second.
+    Buckets are kept in least recently used order. A bucket that's been idle long enough
+    to refill is indistinguishable from a new one, so those are evicted as we go,
+    and max_identities bounds memory if many users are active at once.
+    """
+
+    def __init__(self, rate: float, burst: float, max_identities: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_identities = max_identities
+        self.buckets: OrderedDict[str, Bucket] = OrderedDict()
+
+    def refill_time(self) -> float:
+        return self.burst / self.rate
+
+    def evict(self, now: float) -> None:
+        "Drop idle buckets, and the least recently used ones over max_identities"
+        while self.buckets:
+            oldest = next(iter(self.buckets.values()))
+            idle = now - oldest.updated
+            if idle < self.refill_time() and len(self.buckets) <= self.max_identities:
+                return
+            self.buckets.popitem(last=False)
+
+    def bucket(self, key: str, now: float) -> Bucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket(self.burst, now)
+        else:
+            self.buckets.move_to_end(key)
+            elapsed = now - bucket.updated
+            bucket.tokens = min(self.burst, bucket.tokens + elapsed * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def admit(self, key: str, now: Optional[float] = None) -> bool:
+        "Take a token from key's bucket if there is one"
+        now = time.monotonic() if now is None else now
+        # update key's bucket first, so it's the most recently used and isn't evicted
+        bucket = self.bucket(key, now)
+        self.evict(now)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, key: str, now: Optional[float] = None) -> float:
+        "Seconds until key will be admitted again"
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = bucket.tokens + (now - bucket.updated) * self.rate
+        return max(0.0, (1 - tokens) / self.rate)
@@ -1,12 +1,21 @@
 #!/usr/bin/python3.9
 # Copyright (c) 2021 MobileCoin Inc.
 # Copyright (c) 2021 The Forest Team
+import atexit
 import functools
+import importlib.util
+import json
 import logging
 import os
+import queue
 import shutil
+import sys
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Optional, cast
+from types import ModuleType
+from typing import Iterator, Optional, cast
 
 import phonenumbers as pn
 from phonenumbers import NumberParseException
@@ -21,18 +30,102 @@ def FuckAiohttp(record: logging.LogRecord) -> bool:
     return True
 
 
+class JSONFormatter(logging.Formatter):
+    "Format records as JSON lines"
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "module": record.module,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RateSampler(logging.Filter):
+    """Let at most `rate` records a second through, and note how many were
+    suppressed on the next record that gets through"""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+        self.window_start = 0.0
+        self.passed = 0
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.created - self.window_start >= 1:
+            self.window_start = record.created
+            self.passed = 0
+        if self.passed >= self.rate:
+            self.suppressed += 1
+            return False
+        self.passed += 1
+        if self.suppressed:
+            record.msg = f"{record.msg} [{self.suppressed} similar suppressed]"
+            self.suppressed = 0
+        return True
+
+
 logger_class = logging.getLoggerClass()
 
 logger = logging.getLogger()
 logger.setLevel("DEBUG")
-fmt = logging.Formatter("{levelname} {module}:{lineno}: {message}", style="{")
+fmt: logging.Formatter = logging.Formatter(
+    "{levelname} {module}:{lineno}: {message}", style="{"
+)
+if os.getenv("LOG_JSON"):
+    fmt = JSONFormatter()
 console_handler = logging.StreamHandler()
 console_handler.setLevel(
     ((os.getenv("LOGLEVEL") or os.getenv("LOG_LEVEL")) or "DEBUG").upper()
 )
 console_handler.setFormatter(fmt)
 console_handler.addFilter(FuckAiohttp)
-logger.addHandler(console_handler)
+
+# records are put on a queue and written by a listener thread,
+# so that formatting and I/O doesn't happen on the event loop
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+logger.addHandler(queue_handler)
+log_listener = QueueListener(log_queue, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+def add_log_handler(new_handler: logging.Handler) -> None:
+    "Write records to another handler from the listener thread"
+    log_listener.handlers = (*log_listener.handlers, new_handler)
+    # skip building records at levels no handler would write
+    logger.setLevel(min(each.level for each in log_listener.handlers))
+
+
+def restart_log_listener() -> None:
+    "The listener thread doesn't survive fork, so forked processes need their own"
+    global log_listener  # pylint: disable=global-statement
+    new_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler.queue = new_queue
+    log_listener = QueueListener(
+        new_queue, *log_listener.handlers, respect_handler_level=True
+    )
+    log_listener.start()
+
+
+os.register_at_fork(after_in_child=restart_log_listener)
+logger.setLevel(console_handler.level)
+
+
+@functools.cache
+def get_sampled_logger(name: str) -> logging.Logger:
+    """A logger for high-volume events like raw blobs and outbound commands.
+    Passes at most LOG_SAMPLE_RATE records per second (default 10)"""
+    sampled = logging.getLogger(name)
+    sampled.addFilter(RateSampler(float(get_secret("LOG_SAMPLE_RATE") or 10)))
+    return sampled
 
 
 #### Configure Parameters
@@ -109,27 +202,62 @@ else:
     )
 
 
-if Path(SIGNAL).exists():
-    SIGNAL_PATH = str(Path(SIGNAL).absolute())
-elif Path(ROOT_DIR) / SIGNAL:
-    SIGNAL_PATH = str(Path(ROOT_DIR) / SIGNAL)
-elif which := shutil.which(SIGNAL):
-    SIGNAL_PATH = which
-else:
-    raise FileNotFoundError(
-        f"Couldn't find a {SIGNAL} executable in the working directory, {ROOT_DIR}, or as an executable. "
-        f"Install {SIGNAL} or try symlinking {SIGNAL} to the working directory"
-    )
+#### Configure logging to file
 
 
-#### Configure logging to file
+def start_file_logging() -> None:
+    """Also write logs to debug.log if LOGFILES is set or we're running on fly.
+    Called on app startup rather than on import, so importing doesn't create files"""
+    if get_secret("LOGFILES") or not LOCAL:
+        handler = logging.FileHandler("debug.log")
+        handler.setLevel("DEBUG")
+        handler.setFormatter(fmt)
+        handler.addFilter(FuckAiohttp)
+        add_log_handler(handler)
+
 
-if get_secret("LOGFILES") or not LOCAL:
-    handler = logging.FileHandler("debug.log")
-    handler.setLevel("DEBUG")
-    handler.setFormatter(fmt)
-    handler.addFilter(FuckAiohttp)
-    logger.addHandler(handler)
+#### Startup bookkeeping
+
+startup_timings: dict[str, float] = {}
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    "Record how long a startup step took, logged by log_startup_timings"
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+        logging.debug(
+            "startup phase %s took %.1fms", name, 1000 * startup_timings[name]
+        )
+
+
+def log_startup_timings() -> None:
+    "Log how long each recorded startup phase took, once the bot is up"
+    if startup_timings:
+        phases = ", ".join(
+            f"{name} {1000 * seconds:.1f}ms"
+            for name, seconds in startup_timings.items()
+        )
+        logging.info("startup took %s", phases)
+
+
+def lazy_import(name: str) -> Optional[ModuleType]:
+    """Import a module on first attribute access instead of now, for heavy
+    optional subsystems. Returns None if the module isn't installed."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
 
 def signal_format(raw_number: str) -> Optional[str]:
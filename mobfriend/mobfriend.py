@@ -231,7 +231,7 @@ class MobFriend(QuestionBot):
         if payment_notif_sent:
             logging.info(payment_notif_sent)
             delta = (payment_notif_sent.timestamp - msg.timestamp) / 1000
-            await self.admin(f"payment delta: {delta}")
+            await self.report_latency("payment", delta)
             self.signal_roundtrip_latency.append((msg.timestamp, "payment", delta))
         return None
 
@@ -899,11 +899,13 @@ class Tiamat(PayBot):
         """
         amount_mob = float(mc_util.pmob2mob(amount_pmob))
         amount_usd_cents = round(amount_mob * await self.mobster.get_rate() * 100)
-        await self.mobster.ledger_manager.put_mob_tx(
+        # receipts are only for review, so don't wait for the batch to be written
+        await self.mobster.ledger_manager.buffer_pmob_tx(
             message.source,
             amount_usd_cents,
             amount_pmob,
             message.payment.get("note"),
+            wait=False,
         )
 
     async def response_monitor(self) -> None:
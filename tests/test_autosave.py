@@ -0,0 +1,35 @@
+import multiprocessing
+import os
+import stat
+import threading
+
+import pytest
+
+try:
+    from forest import datastore, mem
+    from forest.autosave import receive_archive, send_archive
+except OSError:  # no libfuse
+    pytest.skip("autosave needs libfuse", allow_module_level=True)
+
+
+def test_archive_streams_from_memfs_over_a_pipe() -> None:
+    backend = mem.Memory()
+    backend.mkdir("/+15551234567.d", 0o700)
+    backend.create("/+15551234567.d/identity", stat.S_IFREG | 0o600)
+    backend.write("/+15551234567.d/identity", os.urandom(3 * 1024 * 1024), 0, 0)
+    received, sent = multiprocessing.Pipe(duplex=False)
+    result: list = []
+    reader = threading.Thread(target=lambda: result.append(receive_archive(received)))
+    reader.start()
+    send_archive(backend, ["/+15551234567.d"], "data", "gzip", 1, sent)
+    reader.join()
+    names = datastore.archive_names(result[0])
+    assert names == ["data/+15551234567.d", "data/+15551234567.d/identity"]
+
+
+def test_archive_gives_up_when_memfs_dies_or_stalls() -> None:
+    received, sent = multiprocessing.Pipe(duplex=False)
+    sent.send_bytes(b"partial")
+    assert receive_archive(received, timeout=0.1) is None
+    sent.close()  # memfs exited partway through
+    assert receive_archive(received, timeout=5) is None
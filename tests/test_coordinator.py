@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+from forest.coordinator import UploadCoordinator
+
+
+@pytest.mark.asyncio
+async def test_uploads_are_debounced_and_single_flight() -> None:
+    uploads = []
+
+    async def upload() -> None:
+        uploads.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.05)
+
+    coordinator = UploadCoordinator(upload, debounce=0.02, max_staleness=0.1)
+    for _ in range(5):
+        coordinator.trigger()
+    await asyncio.sleep(0.03)
+    assert len(uploads) == 1
+    # while that upload runs, more triggers become one trailing upload
+    for _ in range(5):
+        coordinator.trigger()
+    await asyncio.sleep(0.15)
+    assert len(uploads) == 2
+    # a constant stream of triggers still uploads every max_staleness
+    for _ in range(25):
+        coordinator.trigger()
+        await asyncio.sleep(0.01)
+    assert len(uploads) >= 3
+    await coordinator.shutdown()
+    assert coordinator.dirty_since is None
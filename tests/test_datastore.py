@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import pathlib
+from io import BytesIO
+from typing import Any
+
+import pytest
+
+from forest import datastore
+
+
+def test_manifest_roundtrip(tmp_path: pathlib.Path, monkeypatch: Any) -> None:
+    monkeypatch.chdir(tmp_path)
+    account = pathlib.Path("data/+15551234567.d")
+    (account / "attachments").mkdir(parents=True)
+    (account / "empty").mkdir()
+    (account / "recipients-store").write_text('{"recipients": []}')
+    big = os.urandom(datastore.CHUNK_SIZE + 1)
+    (account / "attachments" / "big").write_bytes(big)
+    manifest, chunks = datastore.build_manifest(datastore.disk_entries([str(account)]))
+    assert len(manifest["files"][str(account / "attachments" / "big")]["chunks"]) == 2
+    assert len(chunks) == 3
+    datastore.write_manifest(manifest, chunks, str(tmp_path / "out"))
+    out = tmp_path / "out" / account
+    assert (out / "attachments" / "big").read_bytes() == big
+    assert (out / "recipients-store").read_text() == '{"recipients": []}'
+    assert (out / "empty").is_dir()
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd"])
+def test_archive_formats(compression: str) -> None:
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    buffer = BytesIO()
+    with datastore.compressed_writer(buffer, compression, 3) as stream:
+        stream.write(b"tarball" * 100)
+    assert buffer.getvalue().startswith(datastore.ARCHIVE_MAGIC)
+    assert datastore.decompressed_reader(buffer.getvalue()).read() == b"tarball" * 100
+    # rows from before archives had a header
+    assert datastore.decompressed_reader(b"legacy tarball").read() == b"legacy tarball"
+
+
+def test_zstd_without_zstandard(monkeypatch: Any) -> None:
+    monkeypatch.setattr(datastore, "zstandard", None)
+    with pytest.raises(datastore.DatastoreError):
+        with datastore.compressed_writer(BytesIO(), "zstd", 3):
+            pass
+    header = datastore.ARCHIVE_MAGIC + bytes([datastore.ARCHIVE_VERSION]) + b"z"
+    with pytest.raises(datastore.DatastoreError):
+        datastore.decompressed_reader(header)
+    assert datastore.archive_compression()[0] == "gzip"
+
+
+def test_tarball_from_snapshot(tmp_path: pathlib.Path) -> None:
+    entries = [
+        ("data/+15551234567", 0o100600, 0.0, b'{"registered": true}'),
+        ("data/+15551234567.d", 0o40700, 0.0, None),
+        ("data/+15551234567.d/identity", 0o100600, 0.0, b"key"),
+    ]
+    buffer = BytesIO()
+    with datastore.compressed_writer(buffer, "gzip", 1) as stream:
+        datastore.write_tarball(entries, stream)
+    names = datastore.extract_tarball(buffer.getvalue(), str(tmp_path))
+    assert names == [name for name, *_ in entries]
+    assert (tmp_path / "data/+15551234567.d/identity").read_bytes() == b"key"
+
+
+def test_cache_keeps_latest_version(tmp_path: pathlib.Path) -> None:
+    cache = datastore.DatastoreCache(str(tmp_path))
+    cache.put("+15551234567", 1, "archive", b"old")
+    cache.put("+15551234567", 2, "manifest", b"{}")
+    assert cache.get("+15551234567", 1) is None
+    assert cache.get("+15551234567", 2) == ("manifest", b"{}")
+    cache.put_chunks("+15551234567", {"a": b"1", "b": b"2"}, {"a", "b"})
+    cache.put_chunks("+15551234567", {"c": b"3"}, {"b", "c"})
+    assert cache.get_chunks("+15551234567", ["a", "b", "c"]) == {"b": b"2", "c": b"3"}
+
+
+def test_cache_is_private(tmp_path: pathlib.Path) -> None:
+    cache = datastore.DatastoreCache(str(tmp_path / "cache"))
+    cache.put("+15551234567", 1, "archive", b"keys")
+    cache.put_chunks("+15551234567", {"a": b"1"}, {"a"})
+    assert (tmp_path / "cache").stat().st_mode & 0o777 == 0o700
+    paths = [cache.path("+15551234567", 1, "archive")]
+    paths.append(tmp_path / "cache" / "chunks" / "+15551234567" / "a")
+    assert all(path.stat().st_mode & 0o777 == 0o600 for path in paths)
+
+
+def test_archive_names_and_percentiles() -> None:
+    buffer = BytesIO()
+    with datastore.compressed_writer(buffer, "gzip", 1) as stream:
+        datastore.write_tarball([("data/+15551234567", 0o100600, 0.0, b"{}")], stream)
+    assert datastore.archive_names(buffer.getvalue()) == ["data/+15551234567"]
+    stats = datastore.percentiles([float(i) for i in range(1, 101)])
+    assert stats == {"p50": 51.0, "p90": 91.0, "p99": 100.0, "max": 100.0}
+
+
+class FakeInterface:
+    def __init__(self, record: dict, chunks: dict[str, bytes]) -> None:
+        self.record = record
+        self.chunks = chunks
+
+    async def get_datastore(self, number: str) -> list[dict]:
+        return [self.record]
+
+    async def get_chunks(self, hashes: list[str]) -> list[dict]:
+        return [{"hash": h, "data": self.chunks[h]} for h in hashes if h in self.chunks]
+
+
+def test_verify_account_formats() -> None:
+    number = "+15551234567"
+    entries = [(f"data/{number}", 0o100600, 0.0, b'{"registered": true}')]
+    manifest, chunks = datastore.build_manifest(entries)
+    manifest_data = json.dumps(manifest)
+    buffer = BytesIO()
+    with datastore.compressed_writer(buffer, "gzip", 1) as stream:
+        datastore.write_tarball(entries, stream)
+    loop = asyncio.new_event_loop()
+
+    def verify(record: dict, stored: dict[str, bytes]) -> tuple:
+        interface: Any = FakeInterface(record, stored)
+        return loop.run_until_complete(
+            datastore.verify_account(interface, interface, number)
+        )
+
+    size = len(manifest_data) + len(entries[0][3] or b"")
+    assert verify({"manifest": manifest_data}, chunks) == (size, None)
+    assert verify({"manifest": manifest_data}, {})[1] == "1 chunks missing"
+    # accounts without a data/<number>.d directory are fine in either format
+    archive = buffer.getvalue()
+    assert verify({"datastore": archive}, {}) == (len(archive), None)
+    empty = json.dumps(datastore.build_manifest([])[0])
+    assert verify({"manifest": empty}, {})[1] == f"data/{number} missing from manifest"
+
+
+def test_columns_are_only_added_when_missing() -> None:
+    migrations = []
+
+    class Columns:
+        table = "signal_accounts"
+
+        def __init__(self, count: int) -> None:
+            self.count = count
+
+        async def count_columns(self) -> list[dict]:
+            return [{"columns": self.count}]
+
+        async def migrate(self) -> None:
+            migrations.append(self.count)
+
+    loop = asyncio.new_event_loop()
+    for count in (3, 2):
+        interface: Any = Columns(count)
+        loop.run_until_complete(datastore.add_missing_columns(interface))
+    assert migrations == [2]
@@ -0,0 +1,28 @@
+from forest.latency import LatencyDigest, LatencySketch
+
+
+def test_sketch_quantiles() -> None:
+    sketch = LatencySketch(size=1000)
+    for i in range(1, 101):
+        sketch.add(i / 100)
+    assert sketch.count == 100
+    assert sketch.quantile(0.5) == 0.51
+    assert sketch.quantile(0.99) == 1.0
+
+
+def test_sketch_is_bounded() -> None:
+    sketch = LatencySketch(size=10)
+    for i in range(1000):
+        sketch.add(i)
+    assert sketch.count == 1000
+    assert len(sketch.samples) == 10
+
+
+def test_digest_alerts_once() -> None:
+    digest = LatencyDigest(alert_threshold=2.0)
+    assert digest.observe("ping", 0.5, 0.01) is None
+    assert "ping" in (digest.observe("ping", 3.0, 0.01) or "")
+    assert digest.observe("ping", 3.0, 0.01) is None
+    assert "ping: n=3" in digest.summary()
+    digest.reset()
+    assert not digest
@@ -0,0 +1,254 @@
+import ctypes
+import errno
+import multiprocessing
+import os
+import pathlib
+import shutil
+import stat
+import subprocess
+import threading
+import time
+
+import pytest
+
+try:
+    from forest import fuse, mem
+except OSError:  # no libfuse
+    pytest.skip("memfs needs libfuse", allow_module_level=True)
+
+
+def test_index_follows_renames_and_removals() -> None:
+    backend = mem.Memory()
+    backend.mkdir("/a", 0o755)
+    backend.mkdir("/a/b", 0o755)
+    backend.create("/a/b/f", stat.S_IFREG | 0o644)
+    backend.write("/a/b/f", b"hello", 0, 0)
+    backend.mkdir("/c", 0o755)
+    backend.rename("/a/b", "/c/d")
+    assert backend.get_dir("/a/b") is None and backend.get_file("/a/b/f") is None
+    assert backend.read("/c/d/f", 5, 0, 0) == b"hello"
+    assert "d" in backend.get_dir("/c").directories
+    backend.unlink("/c/d/f")
+    backend.rmdir("/c/d")
+    assert sorted(backend.index) == ["/", "/a", "/c"]
+
+
+def test_only_empty_directories_are_removed_or_replaced() -> None:
+    backend = mem.Memory()
+    for path in ("/a", "/a/b", "/c", "/c/d"):
+        backend.mkdir(path, 0o755)
+    backend.create("/a/b/f", stat.S_IFREG | 0o644)
+    backend.write("/a/b/f", b"x" * 5000, 0, 0)
+    for remove in (lambda: backend.rmdir("/a"), lambda: backend.rename("/c", "/a")):
+        with pytest.raises(OSError) as error:
+            remove()
+        assert error.value.errno == errno.ENOTEMPTY
+    assert backend.read("/a/b/f", 1, 0, 0) == b"x"
+    backend.rename("/a/b", "/c/d")
+    assert backend.get_file("/c/d/f") and backend.used == 5000
+    with backend.tree_lock:
+        backend.remove("/c")
+    assert sorted(backend.index) == ["/", "/a"] and backend.used == 0
+
+
+def test_extents_overwrite_in_place_and_stay_sparse() -> None:
+    backend = mem.Memory()
+    backend.create("/f", stat.S_IFREG | 0o644)
+    backend.write("/f", b"a" * 10, 0, 0)
+    backend.write("/f", b"bb", 4, 0)
+    assert bytes(backend.read("/f", 10, 0, 0)) == b"aaaabbaaaa"
+    far = 3 * mem.EXTENT_SIZE + 5
+    backend.write("/f", b"end", far, 0)
+    attrs = backend.getattr("/f")
+    assert attrs["st_size"] == far + 3
+    # the hole in between isn't allocated, and reads as zeros
+    assert attrs["st_blocks"] == 1
+    assert bytes(backend.read("/f", 4, far - 1, 0)) == b"\0end"
+    backend.truncate("/f", 6)
+    assert bytes(backend.get_file("/f").data) == b"aaaabb"
+
+
+def test_views_from_reads_dont_change_under_writes() -> None:
+    backend = mem.Memory()
+    backend.create("/f", stat.S_IFREG | 0o644)
+    backend.write("/f", b"a" * 10, 0, 0)
+    view = backend.read("/f", 10, 0, 0)
+    assert isinstance(view, memoryview)
+    backend.write("/f", b"bb", 4, 0)
+    backend.truncate("/f", 2)
+    backend.write("/f", b"c" * 20, 2, 0)
+    assert bytes(view) == b"a" * 10
+    assert bytes(backend.read("/f", 22, 0, 0)) == b"aa" + b"c" * 20
+    # once the view is gone, writes go back to changing the extent in place
+    del view
+    extent = backend.get_file("/f").data.extents[0]
+    backend.write("/f", b"d", 0, 0)
+    assert backend.get_file("/f").data.extents[0] is extent
+
+
+def test_only_logged_ops_are_batched_onto_the_queue(monkeypatch) -> None:
+    batches: list = []
+
+    class Queue:
+        def put(self, batch: list) -> None:
+            batches.append(batch)
+
+    monkeypatch.setattr(fuse, "get_caller", lambda: ("/app/signal-cli", [], 0, 0, 1))
+    events = fuse.EventBatcher(Queue(), max_events=2, max_delay=60)
+    backend = mem.Memory(logqueue=events, log_ops={"fsync"})
+    backend("create", "/f", stat.S_IFREG | 0o644)
+    for _ in range(10):
+        backend("getattr", "/f", None)
+        backend("fsync", "/f", 0, 0)
+    assert len(batches) == 5
+    assert all(event[1] == "fsync" for batch in batches for event in batch)
+
+
+def test_operations_from_many_threads() -> None:
+    backend = mem.Memory()
+    errors: list = []
+
+    def worker(i: int) -> None:
+        data = bytes([i]) * (3 * mem.EXTENT_SIZE)
+        for j in range(20):
+            path = f"/{i}-{j % 3}"
+            if j < 3:
+                backend("create", path, stat.S_IFREG | 0o644)
+            backend("write", path, data, 0, 0)
+            if bytes(backend("read", path, len(data), 0, 0)) != data:
+                errors.append(path)
+            backend("readdir", "/", 0)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    snapshots = [backend.snapshot(["/0-0"]) for _ in range(20)]
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(backend.index) == 1 + 8 * 3
+    assert all(len(snapshot) <= 1 for snapshot in snapshots)
+
+
+def serve(mountpoint: str) -> None:
+    fuse.FUSE(mem.Memory(), mountpoint, foreground=True)
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/dev/fuse") or not shutil.which("fusermount"),
+    reason="needs /dev/fuse and fusermount",
+)
+def test_parallel_readers_and_writers_through_a_mount(tmp_path: pathlib.Path) -> None:
+    proc = multiprocessing.Process(target=serve, args=(str(tmp_path),))
+    proc.start()
+    try:
+        deadline = time.time() + 10
+        while not os.path.ismount(tmp_path):
+            assert time.time() < deadline and proc.is_alive(), "memfs didn't mount"
+            time.sleep(0.05)
+        errors: list = []
+
+        def worker(i: int) -> None:
+            data = bytes([i]) * (1024 * 1024)
+            path = tmp_path / str(i)
+            for _ in range(4):
+                path.write_bytes(data)
+                if path.read_bytes() != data:
+                    errors.append(i)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert sorted(os.listdir(tmp_path)) == sorted(map(str, range(8)))
+    finally:
+        subprocess.run(["fusermount", "-u", str(tmp_path)], check=False)
+        proc.join(10)
+
+
+def test_bridge_passes_views_both_ways() -> None:
+    backend = mem.Memory()
+    backend.create("/f", stat.S_IFREG | 0o644)
+    bridge = fuse.FUSE.__new__(fuse.FUSE)
+    bridge.operations, bridge.raw_fi, bridge.encoding = backend, True, "utf-8"
+    info = fuse.fuse_file_info()
+    info_ptr = ctypes.pointer(info)
+    kernel = ctypes.create_string_buffer(b"hello", 5)
+    as_bytes = ctypes.POINTER(ctypes.c_byte)
+    written = bridge.write(b"/f", ctypes.cast(kernel, as_bytes), 5, 0, info_ptr)
+    assert written == 5
+    kernel[0] = b"j"  # the write kept a copy, not the kernel's buffer
+    out = ctypes.create_string_buffer(5)
+    read = bridge.read(b"/f", ctypes.cast(out, as_bytes), 5, 0, info_ptr)
+    assert (read, out.raw) == (5, b"hello")
+    # the bridge has let go of its view, so the extent isn't copied on the next write
+    assert not mem.exported(backend.get_file("/f").data.extents[0])
+    assert backend.open("/f", info) == 0 and info.keep_cache == 0
+
+
+def test_bridge_copies_readonly_and_strided_views() -> None:
+    class Views(fuse.Operations):
+        def __init__(self, result: memoryview) -> None:
+            self.result = result
+
+        def read(self, path: str, size: int, offset: int, fh: int) -> memoryview:
+            return self.result
+
+    bridge = fuse.FUSE.__new__(fuse.FUSE)
+    bridge.raw_fi, bridge.encoding = True, "utf-8"
+    info_ptr = ctypes.pointer(fuse.fuse_file_info())
+    as_bytes = ctypes.POINTER(ctypes.c_byte)
+    for result in (memoryview(b"xhello")[1:], memoryview(b"hxexlxlxo")[::2]):
+        bridge.operations = Views(result)
+        out = ctypes.create_string_buffer(5)
+        read = bridge.read(b"/f", ctypes.cast(out, as_bytes), 5, 0, info_ptr)
+        assert (read, out.raw) == (5, b"hello")
+
+
+def test_usage_is_counted_and_quota_enforced() -> None:
+    events: list = []
+
+    class Queue:
+        def put(self, event: list) -> None:
+            events.append(event)
+
+    backend = mem.Memory(logqueue=Queue(), log_ops=set(), quota=8192, usage_interval=0)
+    backend.create("/a", stat.S_IFREG | 0o644)
+    backend.write("/a", b"x" * 5000, 0, 0)
+    backend.write("/a", b"y" * 100, 0, 0)  # overwriting doesn't allocate more
+    assert backend.getattr("/a")["st_blocks"] == 10
+    backend.create("/b", stat.S_IFREG | 0o644)
+    with pytest.raises(OSError) as error:
+        backend.write("/b", b"z" * 4000, 0, 0)
+    assert error.value.errno == errno.ENOSPC
+    backend.rename("/a", "/c")
+    assert backend.used == 5000
+    backend.truncate("/c", 1000)
+    assert backend.used == 1000
+    backend.write("/b", b"z" * 4000, 0, 0)
+    backend.unlink("/c")
+    assert (backend.used, backend.peak) == (4000, 5000)
+    assert events[-1] == ["usage", 4000, 5000, 8192]
+    assert backend.statfs("/")["f_bavail"] == (8192 - 4000) // mem.BLOCK_SIZE
+
+
+def test_process_info_is_keyed_by_process() -> None:
+    fuse.cached_process_info.cache_clear()
+    assert fuse.process_info(os.getpid())[0] == os.readlink("/proc/self/exe")
+    proc = subprocess.Popen(["sleep", "5"])
+    try:
+        # until sleep has exec'd, we'd see python's exe or an empty cmdline
+        deadline = time.time() + 5
+        while fuse.process_info(proc.pid)[1][0] != "sleep" and time.time() < deadline:
+            time.sleep(0.01)
+        assert fuse.process_info(proc.pid)[1][0] == "sleep"
+        assert fuse.process_key(proc.pid) != fuse.process_key(os.getpid())
+    finally:
+        proc.kill()
+        proc.wait()
+    # lookups for a pid that's gone fail and aren't cached
+    cached = fuse.cached_process_info.cache_info().currsize
+    assert fuse.process_info(proc.pid) == (None, None)
+    assert fuse.cached_process_info.cache_info().currsize == cached
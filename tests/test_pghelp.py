@@ -0,0 +1,178 @@
+import asyncio
+import gc
+from typing import Any
+
+import pytest
+from prometheus_client import REGISTRY
+
+from forest import pghelp
+
+TestPGExpressions = pghelp.PGExpressions(
+    table="test_table",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY);",
+    get_id="SELECT id FROM {self.table} WHERE id=$1;",
+    count="SELECT count(*) FROM {self.table};",
+)
+
+
+class RecordingInterface(pghelp.PGInterface):
+    async def execute(self, qstring: str, *args: Any, **kwargs: Any) -> Any:
+        return [(qstring, args)]
+
+
+def test_queries_are_compiled_once() -> None:
+    loop = asyncio.new_event_loop()
+    interface = RecordingInterface(TestPGExpressions, "postgres://unused", loop)
+    assert interface.get_id is interface.get_id
+    assert loop.run_until_complete(interface.get_id("a")) == [
+        ("SELECT id FROM test_table WHERE id=$1;", ("a",))
+    ]
+    assert interface.sync_count() == [("SELECT count(*) FROM test_table;", ())]
+    try:
+        interface.not_a_query()
+        assert False
+    except AttributeError:
+        pass
+
+
+def test_canned_responses_are_served_per_call() -> None:
+    interface = pghelp.PGInterface(
+        TestPGExpressions, {"get_id": [["a"], ["b"]]}, asyncio.new_event_loop()
+    )
+    assert interface.get_id("x") == ["a"]
+    assert interface.get_id("y") == ["b"]
+    assert interface.get_id("z") == [None]
+    assert interface.invocations[0] == {"get_id": (("x",), {})}
+
+
+class FakeConnection:
+    async def fetch(self, qstring: str, *args: Any, **kwargs: Any) -> list:
+        return [(qstring, args)]
+
+
+class FakePool:
+    closed = False
+
+    def get_size(self) -> int:
+        return 1
+
+    def get_idle_size(self) -> int:
+        return 1
+
+    async def acquire(self) -> FakeConnection:
+        return FakeConnection()
+
+    async def release(self, connection: Any) -> None:
+        pass
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+def test_interfaces_share_a_pool_per_database(monkeypatch: Any) -> None:
+    created = []
+
+    async def create_pool(database: str, **kwargs: Any) -> FakePool:
+        await asyncio.sleep(0)
+        created.append((database, kwargs))
+        return FakePool()
+
+    monkeypatch.setattr(pghelp.asyncpg, "create_pool", create_pool)
+
+    async def connect() -> None:
+        interfaces = [
+            RecordingInterface(TestPGExpressions, "postgres://db/forest")
+            for _ in range(3)
+        ] + [RecordingInterface(TestPGExpressions, "postgres://db/other")]
+        await asyncio.gather(*(interface.connect_pg() for interface in interfaces))
+        assert len(created) == 2
+        assert interfaces[0].pool is interfaces[2].pool
+        assert interfaces[0].pool is not interfaces[3].pool
+        pool = interfaces[0].pool
+        async with pghelp.acquire(pool) as connection:
+            assert await connection.fetch("SELECT 1")
+        await pghelp.close_pools()
+        assert pool.closed and not pghelp.pools
+
+    asyncio.new_event_loop().run_until_complete(connect())
+    assert created[0][1]["max_size"] == pghelp.POOL_MAX_SIZE
+
+
+def test_write_buffer_batches_by_size_and_time() -> None:
+    batches: list[list] = []
+
+    async def write(rows: list) -> None:
+        batches.append(rows)
+
+    async def produce() -> None:
+        buffer = pghelp.WriteBuffer(write, max_rows=3, max_delay=0.01)
+        await asyncio.gather(*(buffer.put((i,)) for i in range(4)))
+        assert batches == [[(0,), (1,), (2,)], [(3,)]]
+        buffer.put_nowait((4,))
+        await buffer.close()
+        assert batches[-1] == [(4,)]
+        assert buffer in pghelp.buffers
+
+    asyncio.new_event_loop().run_until_complete(produce())
+    gc.collect()
+    assert not pghelp.buffers
+
+
+def test_cached_reads_are_invalidated_by_writes() -> None:
+    expressions = pghelp.PGExpressions(
+        table="cached_table",
+        cache_ttl={"get_id": 60},
+        invalidates={"set_id": ["get_id"]},
+        get_id="SELECT id FROM {self.table} WHERE id=$1;",
+        set_id="UPDATE {self.table} SET id=$2 WHERE id=$1;",
+    )
+    calls = []
+
+    class CountingInterface(pghelp.PGInterface):
+        async def execute(self, qstring: str, *args: Any, **kwargs: Any) -> Any:
+            calls.append(qstring)
+            return [len(calls)]
+
+    loop = asyncio.new_event_loop()
+    interface = CountingInterface(expressions, "postgres://db/cached", loop)
+    assert loop.run_until_complete(interface.get_id("a")) == [1]
+    assert loop.run_until_complete(interface.get_id("a")) == [1]
+    assert loop.run_until_complete(interface.get_id("b")) == [2]
+    loop.run_until_complete(interface.set_id("a", "c"))
+    assert loop.run_until_complete(interface.get_id("a")) == [4]
+    assert len(calls) == 4
+
+
+def test_queries_are_timed_and_slow_ones_redacted(monkeypatch: Any) -> None:
+    monkeypatch.setattr(pghelp, "SLOW_QUERY_SECONDS", 0)
+    loop = asyncio.new_event_loop()
+    interface = pghelp.PGInterface(TestPGExpressions, "postgres://db/timed", loop)
+    interface.pool = FakePool()
+    loop.run_until_complete(interface.get_id("+15551234567"))
+    labels = {"table": "test_table", "query": "get_id"}
+    assert REGISTRY.get_sample_value("pg_query_seconds_count", labels) == 1
+    slow = pghelp.slow_queries[-1]
+    assert slow["query"] == "get_id" and slow["args"] == "str(12)"
+    assert "+15551234567" not in str(slow)
+
+
+def test_failed_queries_are_timed_and_recorded(monkeypatch: Any) -> None:
+    monkeypatch.setattr(pghelp, "SLOW_QUERY_SECONDS", 0)
+
+    class FailingConnection(FakeConnection):
+        async def fetch(self, qstring: str, *args: Any, **kwargs: Any) -> list:
+            raise TimeoutError
+
+    class FailingPool(FakePool):
+        async def acquire(self) -> FakeConnection:
+            return FailingConnection()
+
+    loop = asyncio.new_event_loop()
+    interface = pghelp.PGInterface(TestPGExpressions, "postgres://db/failing", loop)
+    interface.pool = FailingPool()
+    with pytest.raises(TimeoutError):
+        loop.run_until_complete(interface.count())
+    labels = {"table": "test_table", "query": "count"}
+    assert REGISTRY.get_sample_value("pg_query_seconds_count", labels) == 1
+    assert pghelp.slow_queries[-1]["query"] == "count"
+    assert pghelp.slow_queries[-1]["failed"]
@@ -0,0 +1,31 @@
+from forest.throttle import Throttle
+
+
+def test_burst_then_refill() -> None:
+    throttle = Throttle(rate=1, burst=3)
+    assert all(throttle.admit("alice", now=0) for _ in range(3))
+    assert not throttle.admit("alice", now=0)
+    assert throttle.admit("bob", now=0)
+    assert throttle.wait_time("alice", now=0.5) == 0.5
+    assert throttle.admit("alice", now=1)
+    assert not throttle.admit("alice", now=1)
+
+
+def test_idle_buckets_are_evicted() -> None:
+    throttle = Throttle(rate=1, burst=2, max_identities=2)
+    throttle.admit("alice", now=0)
+    throttle.admit("bob", now=1)
+    throttle.admit("carol", now=1.5)
+    # alice was the least recently used when carol went over max_identities
+    assert list(throttle.buckets) == ["bob", "carol"]
+    throttle.admit("dave", now=10)
+    assert list(throttle.buckets) == ["dave"]
+
+
+def test_full_table_doesnt_refill_the_sender() -> None:
+    throttle = Throttle(rate=1, burst=2, max_identities=2)
+    assert throttle.admit("alice", now=0) and throttle.admit("alice", now=0)
+    throttle.admit("bob", now=0)
+    # alice is the least recently used, but her drained bucket is kept
+    assert not throttle.admit("alice", now=0)
+    assert list(throttle.buckets) == ["bob", "alice"]
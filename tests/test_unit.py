@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import os
 import pathlib
 from importlib import reload
@@ -26,6 +27,15 @@ def test_root(tmp_path: pathlib.Path) -> None:
     assert reload(utils).ROOT_DIR == "/app"
 
 
+def test_rate_sampler() -> None:
+    sampler = utils.RateSampler(rate=2)
+    record = logging.LogRecord("blobs", logging.INFO, __file__, 0, "blob", None, None)
+    assert [sampler.filter(record) for _ in range(4)] == [True, True, False, False]
+    record.created += 1
+    assert sampler.filter(record)
+    assert "2 similar suppressed" in record.msg
+
+
 class MockMessage(Message):
     def __init__(self, text: str) -> None:
         self.text = text